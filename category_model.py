@@ -0,0 +1,395 @@
+import argparse
+import json
+import os
+import re
+import zlib
+from db_client import get_db_client
+from db_fetcher import get_tables_with_status_column
+from logger_config import setup_logger
+
+try:
+    import numpy as np
+except ImportError:  # Без numpy локальная классификация отключена, все записи идут в assign_category
+    np = None
+
+# Настройка логгера для этого модуля
+logger = setup_logger('category_model', 'logs/category_model.log')
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_model.json")
+MODEL_DIR = os.getenv(
+    "CATEGORY_MODEL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "category_models")
+)
+
+# Признаки: хэшированные униграммы и биграммы слов
+N_FEATURES = 2 ** 17
+_WORD_RE = re.compile(r"\w+")
+
+# Обучение: логистическая регрессия «один против всех» мини-батчами
+BATCH_SIZE = 128
+LEARNING_RATE = 1.0
+L2 = 1e-4
+EPOCHS_FULL = 8
+EPOCHS_INCREMENTAL = 3
+
+# Метка в data записи, что категории выставлены локальной моделью (такие записи не идут в обучение)
+LOCAL_SOURCE = "local"
+
+# Настройки и mtime файла, из которого они загружены
+_config = {}
+_config_mtime = None
+# Загруженные модели: {портал: (mtime файла, модель)}
+_models = {}
+
+
+def get_model_config(portal: str = None) -> dict:
+    """
+    Возвращает настройки локальной классификации из category_model.json: раздел default,
+    дополненный настройками портала (portals). Файл перечитывается только при изменении его mtime.
+      - enabled: использовать ли модель;
+      - threshold: минимальная уверенность, при которой запись классифицируется без LLM;
+      - dialogue_threshold: то же для записей без резюме (до исправления, см. predict_categories с dialogue_only);
+        подбирается отдельно (eval --dialogue-only), null — такие записи локально не классифицируются;
+      - min_examples: минимальное число размеченных LLM записей для использования модели;
+      - min_category_examples: минимальное число примеров каждой категории портала.
+    """
+    global _config, _config_mtime
+
+    mtime = os.stat(CONFIG_PATH).st_mtime
+    if mtime != _config_mtime:
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            _config = json.load(f)
+        _config_mtime = mtime
+        logger.info(f"Загружены настройки локальной классификации из {CONFIG_PATH}")
+
+    return {**_config.get("default", {}), **_config.get("portals", {}).get(portal, {})}
+
+
+def _model_path(portal: str) -> str:
+    return os.path.join(MODEL_DIR, f"{portal}.npz")
+
+
+def vectorize(text: str) -> tuple:
+    """
+    Превращает текст в разреженный вектор признаков: индексы хэшированных (crc32) униграмм и биграмм
+    слов и их веса (1 + log tf), нормированные по L2.
+
+    :return: Кортеж (индексы, веса) — массивы numpy одинаковой длины.
+    """
+    words = _WORD_RE.findall((text or "").lower().replace("ё", "е"))
+    tokens = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    counts = {}
+    for token in tokens:
+        index = zlib.crc32(token.encode("utf-8")) % N_FEATURES
+        counts[index] = counts.get(index, 0) + 1
+
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    norm = np.linalg.norm(values)
+    return indices, (values / norm if norm else values).astype(np.float32)
+
+
+def record_text(record: dict) -> str:
+    """
+    Текст записи для классификации: резюме и диалог.
+    """
+    return f"{record.get('summary') or ''}\n{record.get('dialogue') or ''}"
+
+
+def _logits(model: dict, rows: list):
+    """
+    Считает логиты модели для списка разреженных векторов rows: (число строк, число категорий).
+    """
+    lengths = [len(indices) for indices, _ in rows]
+    indices = np.concatenate([indices for indices, _ in rows])
+    values = np.concatenate([values for _, values in rows])
+    row_ids = np.repeat(np.arange(len(rows)), lengths)
+
+    logits = np.zeros((len(rows), model["weights"].shape[1]), dtype=np.float32)
+    np.add.at(logits, row_ids, values[:, None] * model["weights"][indices])
+    return logits + model["bias"], indices, values, row_ids
+
+
+def _sigmoid(values):
+    return 1 / (1 + np.exp(-np.clip(values, -30, 30)))
+
+
+def _ensure_categories(model: dict, category_ids: list):
+    """
+    Добавляет в модель нулевые веса для категорий, которых она ещё не видела.
+    """
+    new_ids = [category_id for category_id in category_ids if category_id not in model["category_ids"]]
+    if not new_ids:
+        return
+    model["category_ids"] = model["category_ids"] + new_ids
+    model["weights"] = np.hstack([model["weights"], np.zeros((N_FEATURES, len(new_ids)), dtype=np.float32)])
+    model["bias"] = np.concatenate([model["bias"], np.zeros(len(new_ids), dtype=np.float32)])
+    model["positives"] = np.concatenate([model["positives"], np.zeros(len(new_ids), dtype=np.int64)])
+
+
+def _new_model() -> dict:
+    return {
+        "weights": np.zeros((N_FEATURES, 0), dtype=np.float32),
+        "bias": np.zeros(0, dtype=np.float32),
+        "category_ids": [],
+        "positives": np.zeros(0, dtype=np.int64),
+        "examples": 0,
+        "trained_until": None
+    }
+
+
+def fit(model: dict, examples: list, epochs: int, seed: int = 0) -> dict:
+    """
+    Дообучает модель (логистическая регрессия «один против всех» на хэшированных признаках,
+    SGD мини-батчами) на примерах [(текст, [id категорий]), ...]. Веса модели используются
+    как начальные, поэтому повторный вызов на новых записях — инкрементальное обучение.
+    """
+    if not examples:
+        return model
+    _ensure_categories(model, list(dict.fromkeys(category_id for _, labels in examples for category_id in labels)))
+
+    rows = [vectorize(text) for text, _ in examples]
+    positions = {category_id: index for index, category_id in enumerate(model["category_ids"])}
+    targets = np.zeros((len(examples), len(positions)), dtype=np.float32)
+    for row, (_, labels) in enumerate(examples):
+        for category_id in labels:
+            targets[row, positions[category_id]] = 1
+
+    rng = np.random.default_rng(seed)
+    for _ in range(epochs):
+        order = rng.permutation(len(rows))
+        for start in range(0, len(order), BATCH_SIZE):
+            batch = order[start:start + BATCH_SIZE]
+            logits, indices, values, row_ids = _logits(model, [rows[i] for i in batch])
+            errors = _sigmoid(logits) - targets[batch]
+            touched = np.unique(indices)
+            model["weights"][touched] *= 1 - LEARNING_RATE * L2
+            np.add.at(model["weights"], indices, -LEARNING_RATE * values[:, None] * errors[row_ids])
+            model["bias"] -= LEARNING_RATE * errors.mean(axis=0)
+
+    model["positives"] = model["positives"] + targets.sum(axis=0).astype(np.int64)
+    model["examples"] += len(examples)
+    return model
+
+
+def predict(model: dict, text: str) -> tuple[list, float]:
+    """
+    Предсказывает категории текста.
+
+    :return: Кортеж (id категорий с вероятностью >= 0.5, уверенность) — уверенность равна минимуму
+             по категориям из max(p, 1 - p), т.е. насколько модель уверена в каждом решении «да/нет».
+    """
+    logits, _, _, _ = _logits(model, [vectorize(text)])
+    probabilities = _sigmoid(logits[0])
+    selected = [category_id for category_id, p in zip(model["category_ids"], probabilities) if p >= 0.5]
+    confidence = float(np.min(np.maximum(probabilities, 1 - probabilities))) if len(probabilities) else 0.0
+    return selected, confidence
+
+
+def save_model(portal: str, model: dict):
+    """
+    Сохраняет модель портала в MODEL_DIR (через временный файл, чтобы не оставить повреждённую модель).
+    """
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    path = _model_path(portal)
+    temporary_path = f"{path}.tmp.npz"
+    np.savez_compressed(
+        temporary_path,
+        weights=model["weights"],
+        bias=model["bias"],
+        category_ids=np.array(model["category_ids"], dtype=np.int64),
+        positives=model["positives"],
+        examples=np.array(model["examples"]),
+        trained_until=np.array(model["trained_until"] or "")
+    )
+    os.replace(temporary_path, path)
+
+
+def load_model(portal: str) -> dict | None:
+    """
+    Возвращает сохранённую модель портала (перечитывается при изменении файла) или None.
+    """
+    path = _model_path(portal)
+    if np is None or not os.path.exists(path):
+        return None
+    mtime = os.stat(path).st_mtime
+    cached = _models.get(portal)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with np.load(path) as stored:
+        model = {
+            "weights": stored["weights"],
+            "bias": stored["bias"],
+            "category_ids": [int(category_id) for category_id in stored["category_ids"]],
+            "positives": stored["positives"],
+            "examples": int(stored["examples"]),
+            "trained_until": str(stored["trained_until"]) or None
+        }
+    _models[portal] = (mtime, model)
+    return model
+
+
+def fetch_labelled_records(portal: str, since: str = None) -> list[dict]:
+    """
+    Выгружает готовые записи портала, категории которых выставила LLM (без меток LOCAL_SOURCE),
+    в порядке перехода в статус ready; since — выгружать только записи, ставшие готовыми позже указанного времени.
+
+    Время готовности — data.status_at (см. db_data_uploader.upload_records_from_dict), у записей без него — дата звонка.
+    По дате звонка отбирать нельзя: запись старого звонка может стать готовой после записей новых звонков.
+    """
+    processed_at = "coalesce((data->>'status_at')::timestamp, date)"
+    conditions = ["status = 'ready'", "data ? 'categories'", "coalesce(data->>'categories_source', '') <> %s"]
+    params = [LOCAL_SOURCE]
+    if since:
+        conditions.append(f"{processed_at} > %s")
+        params.append(since)
+
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {processed_at}, dialogue, summary, data->'categories'
+                FROM {portal}
+                WHERE {" AND ".join(conditions)}
+                ORDER BY 1;
+            """, params)
+            rows = cur.fetchall()
+
+    return [
+        {"processed_at": processed_at, "dialogue": dialogue, "summary": summary,
+         "categories": [category["id"] for category in categories or [] if isinstance(category, dict)]}
+        for processed_at, dialogue, summary, categories in rows
+    ]
+
+
+def train_portal(portal: str, full: bool = False) -> int:
+    """
+    Обучает модель портала на записях, размеченных LLM. По умолчанию инкрементально: сохранённая модель
+    дообучается только на записях, ставших готовыми после её trained_until; full=True — обучение с нуля на всех записях.
+
+    :return: Количество использованных записей.
+    """
+    model = None if full else load_model(portal)
+    fetched = fetch_labelled_records(portal, model["trained_until"] if model else None)
+    records = [record for record in fetched if record["categories"]]
+    if not records:
+        return 0
+
+    epochs = EPOCHS_INCREMENTAL if model else EPOCHS_FULL
+    model = fit(model or _new_model(), [(record_text(record), record["categories"]) for record in records], epochs)
+    model["trained_until"] = str(fetched[-1]["processed_at"])
+    save_model(portal, model)
+    logger.info(f"Портал {portal}: модель категорий обучена на {len(records)} записях (всего {model['examples']})")
+    return len(records)
+
+
+def update_category_models(portals: list[str] = None) -> int:
+    """
+    Инкрементально дообучает модели категорий порталов (по умолчанию — всех таблиц с колонкой status)
+    на записях, размеченных LLM с прошлого обучения. Вызывается в начале цикла анализа.
+
+    :return: Общее количество новых примеров.
+    """
+    if np is None:
+        return 0
+    total = 0
+    for portal in portals or get_tables_with_status_column():
+        if not get_model_config(portal).get("enabled", False):
+            continue
+        try:
+            total += train_portal(portal)
+        except Exception as e:
+            logger.warning(f"Портал {portal}: не удалось обучить модель категорий: {e}")
+    return total
+
+
+def predict_categories(portal: str, record: dict, categories: list, dialogue_only: bool = False) -> list[dict] | None:
+    """
+    Классифицирует запись локальной моделью портала, если модель достаточно обучена и уверена.
+
+    :param categories: Текущие категории портала [{id, name, ...}, ...].
+    :param dialogue_only: У записи есть только диалог (резюме ещё не составлено). Модель обучена на резюме
+                          и диалоге (record_text), поэтому уверенность сравнивается с отдельным порогом
+                          dialogue_threshold, подобранным на одних диалогах.
+    :return: Выбранные категории [{id, name}, ...] или None — запись нужно классифицировать через LLM.
+    """
+    config = get_model_config(portal)
+    threshold = config.get("dialogue_threshold" if dialogue_only else "threshold", 1.0)
+    if not config.get("enabled", False) or threshold is None:
+        return None
+    model = load_model(portal)
+    if model is None or model["examples"] < config.get("min_examples", 0):
+        return None
+
+    # Категорию, которой модель почти не видела, она не сможет ни выбрать, ни уверенно отвергнуть
+    positives = dict(zip(model["category_ids"], model["positives"]))
+    if any(positives.get(category["id"], 0) < config.get("min_category_examples", 0) for category in categories):
+        return None
+
+    text = (record.get("dialogue") or "") if dialogue_only else record_text(record)
+    selected_ids, confidence = predict(model, text)
+    current = {category["id"]: category for category in categories}
+    selected = [{"id": category_id, "name": current[category_id]["name"]}
+                for category_id in selected_ids if category_id in current]
+    if not selected or confidence < threshold:
+        return None
+    return selected
+
+
+def evaluate_portal(portal: str, thresholds: list[float], test_share: float = 0.2,
+                    dialogue_only: bool = False) -> list[dict]:
+    """
+    Офлайн-оценка: модель обучается с нуля на старых (1 - test_share) записях, размеченных LLM,
+    и проверяется на более новых. Для каждого порога уверенности считает долю записей, которые
+    классифицировались бы без LLM (coverage), и долю полного совпадения набора категорий с LLM среди них (agreement).
+    dialogue_only — проверка только по диалогу, без резюме (для подбора dialogue_threshold).
+    """
+    records = [record for record in fetch_labelled_records(portal) if record["categories"]]
+    split = int(len(records) * (1 - test_share))
+    train, test = records[:split], records[split:]
+    if not train or not test:
+        return []
+
+    model = fit(_new_model(), [(record_text(record), record["categories"]) for record in train], EPOCHS_FULL)
+    predictions = [predict(model, (record["dialogue"] or "") if dialogue_only else record_text(record))
+                   for record in test]
+
+    report = []
+    for threshold in thresholds:
+        covered = [(set(selected), set(record["categories"]))
+                   for (selected, confidence), record in zip(predictions, test)
+                   if selected and confidence >= threshold]
+        agreed = sum(selected == expected for selected, expected in covered)
+        report.append({
+            "threshold": threshold,
+            "coverage": round(len(covered) / len(test), 3),
+            "agreement": round(agreed / len(covered), 3) if covered else None,
+            "train": len(train),
+            "test": len(test)
+        })
+    return report
+
+
+if __name__ == "__main__":
+    # python category_model.py eval [--portal advertpro] — согласие локальной модели с разметкой LLM по порогам
+    # python category_model.py eval --dialogue-only — то же по одному диалогу (порог dialogue_threshold)
+    # python category_model.py train [--full] — (до)обучение моделей порталов
+    parser = argparse.ArgumentParser(description="Локальная модель категорий")
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument("--portal", action="append", help="Портал (по умолчанию все)")
+    parser.add_argument("--full", action="store_true", help="Обучить с нуля")
+    parser.add_argument("--thresholds", default="0.8,0.9,0.95,0.97,0.99")
+    parser.add_argument("--dialogue-only", action="store_true", help="Оценивать по диалогу без резюме")
+    args = parser.parse_args()
+
+    if np is None:
+        raise SystemExit("Для локальной модели категорий нужен numpy")
+
+    for portal_name in args.portal or get_tables_with_status_column():
+        if args.command == "train":
+            print(f"{portal_name}: обучено на {train_portal(portal_name, full=args.full)} записях")
+            continue
+        thresholds = [float(value) for value in args.thresholds.split(",")]
+        for row in evaluate_portal(portal_name, thresholds, dialogue_only=args.dialogue_only):
+            print(f"{portal_name}: порог {row['threshold']}, без LLM {row['coverage']:.1%}, "
+                  f"совпадение с LLM {row['agreement']}, обучение/проверка {row['train']}/{row['test']}")
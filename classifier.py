@@ -1,6 +1,5 @@
 import asyncio
-from functools import partial
-from llm_router import llm_request
+from llm_routing import route_request
 import json
 
 PROMPT1 = """
@@ -21,26 +20,69 @@ PROMPT4 = """
 """
 
 PROMPT5 = """
-Ответ выдай строго в виде списка следующего синтаксиса (без доп символов и кавычек, синтаксис списка должен быть с таким 
-же набором квадратных скобок и двойных кавычек, обрамлять список в доп символы запрещено):
-["Категория 1", "Категория 2"]
+Ответ выдай строго в виде словаря следующего синтаксиса (без доп символов и кавычек, синтаксис словаря должен быть с таким 
+же набором фигурных и квадратных скобок и двойных кавычек, обрамлять словарь в доп символы запрещено):
+{"categories": ["Категория 1", "Категория 2"]}
 """
 
+# Инструкции для классификации нескольких диалогов одним запросом (см. assign_categories_packed)
+PACKED_PROMPT = """
+Ниже приведены несколько независимых диалогов, у каждого свой id. Классифицируй каждый диалог отдельно,
+не перенося сведения из одного диалога в другой.
+Ответ выдай строго в виде словаря следующего синтаксиса:
+{"results": [{"id": "id диалога", "categories": ["Категория 1", "Категория 2"]}, ...]}
+В results должен быть ровно один элемент на каждый диалог.
+"""
+
+
+# Стадия анализа: модель классификации выбирается по таблице маршрутов (см. llm_routing)
+STAGE = "classification"
+
+# Схема ответа для структурированного вывода (см. llm_router.allm_request)
+CATEGORY_SCHEMA = {
+    "name": "selected_categories",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "categories": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["categories"],
+        "additionalProperties": False
+    }
+}
+
+
+PACKED_CATEGORY_SCHEMA = {
+    "name": "packed_selected_categories",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string"},
+                        "categories": {"type": "array", "items": {"type": "string"}}
+                    },
+                    "required": ["id", "categories"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["results"],
+        "additionalProperties": False
+    }
+}
+
+# Прогноз размера ответа на один диалог в пакетном запросе
+OUTPUT_TOKENS_PER_DIALOG = 40
 
-async def assign_category(text: str, categories: dict, summary: str = None) -> dict:
+
+def _categories_json(categories: dict) -> str:
     """
-    Асинхронная функция, которая:
-      1. Принимает text (строка с диалогом), categories (словарь категорий), и опционально summary (резюме предыдущих разговоров)
-      2. Формирует единый запрос, состоящий из:
-         PROMPT1 + PROMPT2 + PROMPT3 + summary (если есть) + текст диалога + PROMPT4 + JSON-представление словаря + PROMPT5
-      3. Делает синхронный запрос через deepseek_request (через run_in_executor)
-      4. Ожидает ответ, содержащий список имен выбранных категорий
-      5. Находит полные объекты категорий из исходного словаря, сопоставляя их по имени, и возвращает только поля "id" и "name"
-      6. Возвращает словарь с полем "categories" (список выбранных объектов) и "cost" (стоимость запроса)
+    Возвращает JSON-представление категорий (только name и prompt) для промпта.
     """
-    loop = asyncio.get_running_loop()
-
-    # Формируем упрощенный словарь категорий только с name и prompt
     simplified_categories = {
         "categories": [
             {
@@ -50,46 +92,53 @@ async def assign_category(text: str, categories: dict, summary: str = None) -> d
             for category in categories.get("categories", [])
         ]
     }
-    
-    # Преобразуем упрощенный словарь в JSON строку
-    categories_str = json.dumps(simplified_categories, ensure_ascii=False, indent=4)
+    return json.dumps(simplified_categories, ensure_ascii=False, indent=4)
 
-    # Формируем секцию диалога с введением (если есть summary)
-    dialog_section = f"{PROMPT2}"
-    
-    if summary and summary.strip():
-        dialog_section += f"{PROMPT3}\n{summary.strip()}"
-    
-    dialog_section += f"{text}"
 
-    # Формируем единый промпт
-    combined_prompt = (
+def build_category_messages(text: str, categories: dict, summary: str = None) -> list:
+    """
+    Формирует сообщения запроса на классификацию в виде стабильного префикса и переменного суффикса,
+    чтобы префикс попадал в кэш провайдера (одинаков для всех диалогов портала):
+      - system: PROMPT1 + PROMPT4 + JSON-представление словаря категорий + PROMPT5;
+      - user: PROMPT3 + summary (если есть) + PROMPT2 + текст диалога.
+    """
+    # Упрощенный словарь категорий (только name и prompt) в виде JSON строки
+    categories_str = _categories_json(categories)
+
+    # Стабильная часть: инструкции и категории
+    instructions = (
         f"{PROMPT1}"
-        f"{dialog_section}"
         f"{PROMPT4}\n{categories_str}"
         f"{PROMPT5}"
     )
 
-    messages = [
-        {"role": "user", "content": combined_prompt}
+    # Переменная часть: введение (если есть summary) и диалог
+    dialog_section = ""
+    if summary and summary.strip():
+        dialog_section += f"{PROMPT3}\n{summary.strip()}"
+    dialog_section += f"{PROMPT2}{text}"
+
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": dialog_section}
     ]
 
-    # Выполняем синхронный запрос через llm
-    result = await loop.run_in_executor(
-        None,
-        partial(llm_request,
-                model="gpt-4o-mini",
-                messages=messages)
-    )
 
-    # Извлекаем ответ и стоимость
-    answer_text = result["content"]
-    try:
-        # Ожидаем, что ответ — это JSON список имен категорий, например:
-        # ["Продвижение сайтов новый клиент", "Аренда сайтов новый клиент"]
-        selected_names = json.loads(answer_text)
-    except json.JSONDecodeError:
-        selected_names = []
+def parse_category_response(answer, categories: dict) -> list:
+    """
+    Разбирает ответ нейросети и возвращает полные объекты выбранных категорий с полями "id" и "name".
+    answer — либо уже разобранный по CATEGORY_SCHEMA объект {"categories": [...]},
+    либо текст ответа (JSON-список имён категорий или тот же объект).
+    """
+    if isinstance(answer, str):
+        try:
+            # Ожидаем JSON-объект {"categories": [...]} (старые ответы — JSON-список имён категорий), например:
+            # {"categories": ["Продвижение сайтов новый клиент", "Аренда сайтов новый клиент"]}
+            answer = json.loads(answer)
+        except json.JSONDecodeError:
+            answer = []
+
+    selected_names = answer.get("categories", []) if isinstance(answer, dict) else answer
 
     # Находим полные объекты категорий, сопоставляя по полю "name" и оставляя только "id" и "name"
     selected_categories = []
@@ -100,11 +149,109 @@ async def assign_category(text: str, categories: dict, summary: str = None) -> d
                 "name": category["name"]
             })
 
+    return selected_categories
+
+
+def build_packed_category_messages(items: list, categories: dict) -> list:
+    """
+    Формирует один запрос на классификацию нескольких диалогов портала:
+      - system: PROMPT1 + PROMPT4 + JSON категорий + PACKED_PROMPT (тот же префикс категорий, что и в
+        build_category_messages);
+      - user: диалоги с их id, у каждого — введение (если есть summary) и текст.
+
+    :param items: [{"id": str, "text": диалог, "summary": контекст или None}, ...]
+    """
+    instructions = (
+        f"{PROMPT1}"
+        f"{PROMPT4}\n{_categories_json(categories)}"
+        f"{PACKED_PROMPT}"
+    )
+
+    sections = []
+    for item in items:
+        section = f"Диалог id={item['id']}:\n"
+        if item.get("summary") and item["summary"].strip():
+            section += f"{PROMPT3}\n{item['summary'].strip()}"
+        section += f"{PROMPT2}{item['text']}"
+        sections.append(section)
+
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": "\n\n".join(sections)}
+    ]
+
+
+def validate_category_answer(answer: dict, categories: dict):
+    """
+    Проверяет ответ классификации и выбрасывает ValueError, если ответ не словарь {"categories": [...]}
+    или модель вернула категории, которых нет в списке (непрошедший проверку ответ повторяется на premium-модели).
+    """
+    if not isinstance(answer, dict) or not isinstance(answer.get("categories", []), list):
+        raise ValueError(f"Ответ классификации не в формате {{\"categories\": [...]}}: {answer!r}")
+    known_names = {category["name"] for category in categories.get("categories", [])}
+    unknown_names = [name for name in answer.get("categories", []) if name not in known_names]
+    if unknown_names:
+        raise ValueError(f"Категории вне списка: {unknown_names}")
+
+
+async def assign_category(text: str, categories: dict, summary: str = None, hedge: bool = False,
+                          portal: str = None) -> dict:
+    """
+    Асинхронная функция, которая:
+      1. Принимает text (строка с диалогом), categories (словарь категорий), и опционально summary (резюме предыдущих разговоров)
+      2. Формирует единый запрос (см. build_category_messages)
+      3. Делает асинхронный запрос к модели из таблицы маршрутов (с учётом портала portal);
+         если ответ не прошёл проверку validate_category_answer, запрос повторяется на premium-модели
+      4. Ожидает ответ, содержащий список имен выбранных категорий
+      5. Находит полные объекты категорий из исходного словаря, сопоставляя их по имени, и возвращает только поля "id" и "name"
+      6. Возвращает словарь с полем "categories" (список выбранных объектов) и "cost" (стоимость запроса)
+    """
+    messages = build_category_messages(text, categories, summary)
+
+    def parse(response: dict) -> list:
+        validate_category_answer(response["parsed"], categories)
+        return parse_category_response(response["parsed"], categories)
+
+    # Выполняем асинхронный запрос через llm
+    selected_categories, result = await route_request(STAGE, messages, parse, portal=portal,
+                                                      response_format=CATEGORY_SCHEMA, hedge=hedge)
     cost = result["cost"]
 
     return {"categories": selected_categories, "cost": cost}
 
 
+async def assign_categories_packed(items: list, categories: dict, hedge: bool = False, portal: str = None) -> dict:
+    """
+    Классифицирует несколько диалогов одного портала одним запросом (см. build_packed_category_messages).
+
+    :param items: [{"id": str, "text": диалог, "summary": контекст или None}, ...]
+    :return: {id диалога: [{"id", "name"}, ...]} только для диалогов, ответ по которым есть и прошёл
+             проверку validate_category_answer; остальные нужно классифицировать по одному через assign_category.
+             Если пригодных ответов нет совсем, запрос повторяется на premium-модели.
+    """
+    messages = build_packed_category_messages(items, categories)
+    item_ids = {item["id"] for item in items}
+
+    def parse(response: dict) -> dict:
+        results = {}
+        for answer in response["parsed"].get("results", []):
+            item_id = str(answer.get("id"))
+            if item_id not in item_ids or item_id in results:
+                continue
+            try:
+                validate_category_answer(answer, categories)
+            except ValueError:
+                continue
+            results[item_id] = parse_category_response(answer, categories)
+        if not results:
+            raise ValueError("В пакетном ответе нет пригодных результатов")
+        return results
+
+    results, _ = await route_request(STAGE, messages, parse, portal=portal, response_format=PACKED_CATEGORY_SCHEMA,
+                                     expected_output_tokens=OUTPUT_TOKENS_PER_DIALOG * len(items), hedge=hedge)
+    return results
+
+
 # Пример вызова:
 if __name__ == "__main__":
     text_example = """
@@ -1,53 +1,168 @@
 import json
+import httpx
 import anthropic
+from anthropic import DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 from llm_response_cleaner import clean_llm_content
+from llm_pricing import compute_cost, normalize_usage
+from llm_rate_limiter import get_rate_limiter
 
+# Лимиты пула HTTP-соединений асинхронного клиента (должны покрывать max_concurrent_requests стадий)
+MAX_CONNECTIONS = 500
+MAX_KEEPALIVE_CONNECTIONS = 500
 
-def request_claude(model: str, messages: list[dict]) -> dict:
+# Лимит выходных токенов, если он не задан в таблице маршрутов
+DEFAULT_MAX_TOKENS = 8192
+
+# Клиенты создаются один раз на процесс и переиспользуют keep-alive соединения
+_client = None
+_async_client = None
+
+
+def get_client() -> anthropic.Anthropic:
     """
-    Синхронная функция, делающая запрос к Anthropic.
+    Возвращает синхронный клиент Anthropic, общий для всего процесса.
     """
-    load_dotenv()
-    client = anthropic.Anthropic()
-    result = client.messages.create(
-        model=model,
-        max_tokens=8192,
-        messages=messages
-    )
+    global _client
+    if _client is None:
+        load_dotenv()
+        _client = anthropic.Anthropic()
+    return _client
+
+
+def get_async_client() -> anthropic.AsyncAnthropic:
+    """
+    Возвращает асинхронный клиент Anthropic, общий для всего процесса.
+    Пул соединений рассчитан на MAX_CONNECTIONS одновременных запросов.
+    """
+    global _async_client
+    if _async_client is None:
+        load_dotenv()
+        _async_client = anthropic.AsyncAnthropic(
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS
+                )
+            )
+        )
+    return _async_client
+
+
+def _build_response(model: str, result, structured: bool = False) -> dict:
+    """
+    Извлекает ответ из результата messages.create и рассчитывает стоимость запроса.
+    Возвращает словарь с очищенным контентом, стоимостью, моделью и usage (см. llm_pricing.normalize_usage).
+    Для запросов со схемой ответа (structured=True) ответ берётся из вызова инструмента
+    и кладётся в ключ "parsed".
+    """
+    # Рассчитываем стоимость по единой таблице тарифов
+    total_cost = compute_cost(model, result.usage)
+
+    if structured:
+        parsed = next((block.input for block in result.content if block.type == "tool_use"), None)
+        if parsed is None:
+            raise Exception(f"Модель {model} не вернула ответ по схеме")
+        return {"content": json.dumps(parsed, ensure_ascii=False), "parsed": parsed, "cost": total_cost,
+                "model": model, "usage": normalize_usage(result.usage)}
+
     # Извлекаем сгенерированный ответ
     answer = result.content[0].text
 
     # Очищаем ответ (удаляем возможные обёртки ```json и т. п.)
     answer = clean_llm_content(answer)
 
-    # Загрузка тарифов из файла llm_price.json
-    with open("llm_pricing.json", "r", encoding="utf-8") as f:
-        pricing = json.load(f)
+    return {"content": answer, "cost": total_cost, "model": model, "usage": normalize_usage(result.usage)}
+
 
-    # Извлекаем информацию о токенах из ответа API
-    input_tokens = result.usage.input_tokens
-    output_tokens = result.usage.output_tokens
+def _prepare_messages(messages: list[dict]) -> tuple[list, list]:
+    """
+    Приводит сообщения к формату Anthropic и расставляет точки кэширования (cache_control):
+      - сообщения с ролью system переносятся в параметр system, последний блок помечается для кэша;
+      - подряд идущие сообщения одной роли объединяются в одно с несколькими текстовыми блоками;
+      - все сообщения, кроме последнего, считаются стабильным префиксом: точка кэширования
+        ставится на последний блок предпоследнего сообщения.
+    Возвращает (system, messages).
+    """
+    system = []
+    prepared = []
+    for message in messages:
+        content = message.get("content", "")
+        blocks = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        if message["role"] == "system":
+            system.extend(blocks)
+        elif prepared and prepared[-1]["role"] == message["role"]:
+            prepared[-1]["content"].extend(blocks)
+        else:
+            prepared.append({"role": message["role"], "content": list(blocks)})
+
+    cache_control = {"type": "ephemeral"}
+    if system:
+        system[-1] = {**system[-1], "cache_control": cache_control}
 
-    # Получаем тарифы для выбранной модели
-    model_pricing = pricing.get(model)
-    if not model_pricing:
-        raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
+    # Переменная часть — последний блок последнего сообщения, всё до него кэшируется
+    positions = [(mi, bi) for mi, message in enumerate(prepared) for bi in range(len(message["content"]))]
+    if len(positions) > 1:
+        mi, bi = positions[-2]
+        prepared[mi]["content"][bi] = {**prepared[mi]["content"][bi], "cache_control": cache_control}
 
-    input_rate = model_pricing.get("input_tokens")
-    output_rate = model_pricing.get("output_tokens")
+    return system, prepared
 
-    if input_rate is None or output_rate is None:
-        raise Exception(f"Не указаны тарифы для входных, кэшированных или выходных токенов для модели: {model}")
 
-    # Расчет стоимости:
-    # Стоимость некэшированных prompt_tokens
-    cost_input = (input_tokens / 1_000_000) * input_rate
-    # Стоимость output токенов
-    cost_output = (output_tokens / 1_000_000) * output_rate
-    total_cost = cost_input + cost_output
+def _request_params(response_format: dict = None, params: dict = None) -> dict:
+    """
+    Параметры messages.create: max_tokens и temperature из параметров генерации params (см. llm_routing)
+    и, для запроса со схемой ответа, схема как единственный инструмент, вызов которого модель обязана сделать.
+    """
+    params = params or {}
+    request_params = {"max_tokens": params.get("max_tokens") or DEFAULT_MAX_TOKENS}
+    if params.get("temperature") is not None:
+        request_params["temperature"] = params["temperature"]
+    if not response_format:
+        return request_params
+    return {
+        **request_params,
+        "tools": [{
+            "name": response_format["name"],
+            "description": "Вернуть ответ в структурированном виде",
+            "input_schema": response_format["schema"]
+        }],
+        "tool_choice": {"type": "tool", "name": response_format["name"]}
+    }
 
-    return {"content": answer, "cost": total_cost}
+
+def request_claude(model: str, messages: list[dict], response_format: dict = None, params: dict = None) -> dict:
+    """
+    Синхронная функция, делающая запрос к Anthropic.
+    Если передана схема ответа response_format ({"name", "schema"}), в ответе есть ключ "parsed".
+    """
+    system, messages = _prepare_messages(messages)
+    result = get_client().messages.create(
+        model=model,
+        system=system or anthropic.NOT_GIVEN,
+        messages=messages,
+        **_request_params(response_format, params)
+    )
+    return _build_response(model, result, structured=bool(response_format))
+
+
+async def arequest_claude(model: str, messages: list[dict], response_format: dict = None,
+                          params: dict = None) -> dict:
+    """
+    Асинхронная функция, делающая запрос к Anthropic через общий AsyncAnthropic клиент.
+    Если передана схема ответа response_format ({"name", "schema"}), в ответе есть ключ "parsed".
+    """
+    system, messages = _prepare_messages(messages)
+    raw_response = await get_async_client().messages.with_raw_response.create(
+        model=model,
+        system=system or anthropic.NOT_GIVEN,
+        messages=messages,
+        **_request_params(response_format, params)
+    )
+    # Передаём заголовки x-ratelimit-* общему ограничителю запросов
+    get_rate_limiter().update_from_headers(model, raw_response.headers)
+    result = raw_response.parse()
+    return _build_response(model, result, structured=bool(response_format))
 
 
 if __name__ == "__main__":
@@ -59,4 +174,4 @@ if __name__ == "__main__":
         ]
     )
 
-    print(completion)
\ No newline at end of file
+    print(completion)
@@ -1,91 +1,281 @@
 import asyncio
-from criterion_processor import process_client_data
+import inspect
+from criterion_processor import (
+    process_client_data,
+    process_client_criteria,
+    group_criteria,
+    criterion_needs_llm,
+    prompt_hash,
+    dialogue_hash,
+    make_fingerprint,
+    build_criterion_messages,
+    parse_criterion_response,
+    CRITERION_SCHEMA,
+    STAGE
+)
+from llm_routing import get_route, STANDARD
+from worker_pool import run_pool, retry_call
+from llm_batch import make_custom_id, submit_batch, collect_batch_results, get_pending_custom_ids, mark_batches_merged
 from logger_config import setup_logger
 
 # Настройка логгера для этого модуля
 logger = setup_logger('criteria_analyzer', 'logs/criteria_analyzer.log')
 
 
+def is_stale_result(crit_ref: dict, criterion: dict, current_dialogue_hash: str, retired_models=()) -> bool:
+    """
+    Проверяет по отпечатку (см. criterion_processor.make_fingerprint), устарел ли результат критерия:
+    изменился промпт критерия или текст диалога, либо ответ дала модель из retired_models.
+    Результаты без отпечатка (полученные до его появления) устаревшими не считаются.
+    """
+    fingerprint = crit_ref.get("fingerprint")
+    if not fingerprint:
+        return False
+    return (fingerprint.get("prompt") != prompt_hash(criterion)
+            or fingerprint.get("dialogue") != current_dialogue_hash
+            or fingerprint.get("model") in retired_models)
+
+
+def has_criterion_result(crit_ref: dict, criterion: dict, dialogue: str) -> bool:
+    """
+    Проверяет, есть ли у критерия записи актуальный результат: text и evaluation получены,
+    и с тех пор не менялись ни промпт критерия, ни текст диалога (см. is_stale_result).
+    """
+    if "text" not in crit_ref or "evaluation" not in crit_ref:
+        return False
+    return not is_stale_result(crit_ref, criterion, dialogue_hash(dialogue))
+
+
+def is_record_analyzed(record: dict) -> bool:
+    """
+    Проверяет, получены ли результаты по всем критериям записи.
+    Запись с неполными результатами остаётся в статусе fixed и дообрабатывается в следующем цикле.
+    """
+    return all("text" in c and "evaluation" in c for c in (record.get("data") or {}).get("criteria", []))
+
+
+def _store_criterion_result(crit_ref: dict, criterion: dict, dialogue: str, processed: dict | None):
+    """
+    Записывает результат критерия и его отпечаток в запись. Если результата нет (все попытки
+    провалились), убирает text и evaluation, чтобы критерий был запрошен заново в следующем цикле.
+    """
+    if processed is None:
+        for key in ("text", "evaluation", "fingerprint"):
+            crit_ref.pop(key, None)
+        return
+    crit_ref["text"] = processed.get("text")
+    crit_ref["evaluation"] = processed.get("evaluation")
+    crit_ref["fingerprint"] = make_fingerprint(criterion, processed.get("model"), dialogue)
+
+
 async def analyze_criteria(
     input_data: dict,
     max_retries: int,
     retry_delay: float,
-    max_concurrent_requests: int
+    max_concurrent_requests: int,
+    use_batch: bool = False,
+    hedge: bool = False,
+    multi_criteria: bool = False,
+    stage: str = STAGE,
+    sink=None
 ) -> dict:
     """
     Асинхронно обрабатывает данные клиентов из новой структуры словаря.
     Для каждого клиента и каждой записи проходит по списку критериев и
     запускает process_client_data. В результат записывает в каждое поле
-    критериев доп. ключи text и evaluation.
+    критериев доп. ключи text, evaluation и fingerprint (отпечаток: промпт, модель, диалог).
+
+    Обработка возобновляется с точностью до критерия: запрашиваются только критерии без
+    результата или с изменившимся промптом либо диалогом (см. has_criterion_result). У критериев, которые
+    не удалось обработать, text и evaluation отсутствуют, поэтому запись остаётся в статусе fixed.
 
     :param input_data: Словарь с данными клиентов. У каждого клиента есть:
                        - records: список разговоров,
                        - criteria: список определений критериев,
                        - categories, entities (игнорируются в этой функции).
     :param max_retries: Количество попыток при ошибке.
-    :param retry_delay: Задержка перед повтором в секундах.
-    :param max_concurrent_requests: Максимальное число параллельных запросов.
-    :return: То же самое input_data, но в каждом criterion добавлены поля
-             "text" и "evaluation".
+    :param retry_delay: Базовая задержка перед повтором в секундах (удваивается с каждой попыткой).
+                        Ответы 429 обрабатывает общий ограничитель llm_rate_limiter.
+    :param max_concurrent_requests: Максимальное число параллельных запросов (обработчиков пула, см. worker_pool).
+    :param use_batch: Выполнять запросы через OpenAI Batch API (см. analyze_criteria_batch).
+    :param hedge: Дублировать запросы, выполняющиеся дольше p95 задержки модели (см. llm_hedging).
+    :param multi_criteria: Оценивать все критерии записи (группами в пределах бюджета токенов)
+                           одним запросом; критерии, не попавшие в ответ, обрабатываются по отдельности.
+    :param stage: Стадия, по маршрутам которой выбираются модели (criteria или reanalysis, см. llm_routing).
+    :param sink: Функция (portal, record), обычная или корутинная. Вызывается, как только обработаны
+                 все критерии записи (часть из них могла остаться без результата, см. is_record_analyzed).
+    :return: То же самое input_data, но в каждом обработанном criterion добавлены поля
+             "text", "evaluation" и "fingerprint".
     """
-    semaphore = asyncio.Semaphore(max_concurrent_requests)
-    tasks = []
+    if use_batch:
+        return await analyze_criteria_batch(input_data)
+
+    counters = {"total": 0, "skipped": 0, "failed": 0}
+    # Сколько единиц работы по каждой записи ещё не завершено
+    remaining = {}
+
+    def iter_units():
+        """
+        Лениво перебирает записи и выдаёт единицы работы: один критерий или (при multi_criteria)
+        группу критериев записи. Критерии без запроса к нейросети и с актуальным результатом
+        обрабатываются сразу. Запись без единиц работы выдаётся пустой единицей, чтобы sink узнал о ней.
+        """
+        for client, client_block in input_data.items():
+            criteria_definitions = client_block.get("criteria", [])
+            for record in client_block.get("records", []):
+                dialogue = record.get("dialogue", "")
+                crit_pairs = []
+                for crit_ref in (record.get("data") or {}).get("criteria", []):
+                    # Находим полное определение критерия (чтобы взять prompt, правила и т.д.)
+                    full_crit = next((c for c in criteria_definitions if c["id"] == crit_ref.get("id")), crit_ref)
+                    # Критерии с актуальным результатом из прошлых циклов повторно не запрашиваются
+                    if has_criterion_result(crit_ref, full_crit, dialogue):
+                        counters["skipped"] += 1
+                    elif not criterion_needs_llm(full_crit):
+                        _store_criterion_result(crit_ref, full_crit, dialogue, {"text": "", "evaluation": None, "model": None})
+                    else:
+                        crit_pairs.append((crit_ref, full_crit))
+                counters["total"] += len(crit_pairs)
+
+                if multi_criteria:
+                    groups = group_criteria([full_crit for _, full_crit in crit_pairs])
+                    refs = {id(full_crit): crit_ref for crit_ref, full_crit in crit_pairs}
+                    units = [[(refs[id(full_crit)], full_crit) for full_crit in group] for group in groups]
+                else:
+                    units = [[pair] for pair in crit_pairs]
 
-    async def process_with_retries(dialogue: str, criterion: dict, record_id: str):
-        for attempt in range(1, max_retries + 1):
+                remaining[id(record)] = max(len(units), 1)
+                for pairs in units or [[]]:
+                    yield {"portal": client, "record": record, "pairs": pairs}
+
+    async def process_unit(unit: dict) -> list:
+        record = unit["record"]
+        dialogue = record.get("dialogue", "")
+        record_id = record.get("id", "<no-id>")
+        criteria = [full_crit for _, full_crit in unit["pairs"]]
+        if not criteria:
+            return []
+        if not multi_criteria:
+            return [await process_client_data(dialogue, criteria[0], record_id, hedge=hedge, portal=unit["portal"],
+                                              stage=stage)]
+
+        results = {}
+        try:
+            results = await process_client_criteria(dialogue, criteria, record_id, hedge=hedge, portal=unit["portal"],
+                                                    stage=stage)
+        except Exception as e:
+            logger.warning(f"[ERR]  ID={record_id!r}, пакет из {len(criteria)} критериев: {e}")
+        # Критерии без ответа в пакете обрабатываем по одному
+        for criterion in criteria:
+            if criterion["id"] in results:
+                continue
             try:
-                # Ограничиваем параллелизм
-                async with semaphore:
-                    result = await process_client_data(dialogue, criterion, record_id)
-                logger.debug(f"[OK]   ID={record_id!r}, критерий={criterion.get('name')!r}, попытка={attempt}")
-                return result
+                results[criterion["id"]] = await retry_call(
+                    process_client_data, dialogue, criterion, record_id, hedge=hedge, portal=unit["portal"],
+                    stage=stage, retries=max_retries, retry_delay=retry_delay,
+                    description=f"ID={record_id!r}, критерий={criterion.get('name')!r}"
+                )
             except Exception as e:
-                logger.warning(f"[ERR]  ID={record_id!r}, критерий={criterion.get('name')!r}, попытка={attempt}: {e}")
-                if attempt < max_retries:
-                    await asyncio.sleep(retry_delay)
-                else:
-                    logger.error(f"[FAIL] ID={record_id!r}, критерий={criterion.get('name')!r} — исчерпаны все {max_retries} попыток")
-                    return None
+                logger.error(f"[FAIL] ID={record_id!r}, критерий={criterion.get('name')!r} — исчерпаны все {max_retries} попыток: {e}")
+        return [results.get(criterion["id"]) for criterion in criteria]
+
+    async def store_unit(unit: dict, results: list | None, error: Exception | None):
+        record = unit["record"]
+        dialogue = record.get("dialogue", "")
+        for index, (crit_ref, full_crit) in enumerate(unit["pairs"]):
+            result = results[index] if results else None
+            _store_criterion_result(crit_ref, full_crit, dialogue, result)
+            counters["failed"] += result is None
+
+        remaining[id(record)] -= 1
+        if remaining[id(record)] == 0:
+            del remaining[id(record)]
+            if sink is not None:
+                outcome = sink(unit["portal"], record)
+                if inspect.isawaitable(outcome):
+                    await outcome
+
+    logger.info("Начинаю анализ критериев")
+    await run_pool(iter_units(), process_unit, max_concurrent_requests, sink=store_unit,
+                   retries=max_retries, retry_delay=retry_delay, name="Анализ критериев")
+    logger.info(f"Завершен анализ {counters['total']} критериев (уже был результат: {counters['skipped']})")
+
+    if counters["failed"]:
+        logger.warning(f"Без результата осталось {counters['failed']} критериев, они будут запрошены в следующем цикле")
+
+    return input_data
+
+
+async def analyze_criteria_batch(input_data: dict) -> dict:
+    """
+    Вариант analyze_criteria для несрочной обработки через OpenAI Batch API (в 2 раза дешевле).
+
+    За один вызов (один цикл сервиса):
+      1. Забирает ответы завершившихся батчей стадии "criteria" и записывает text и evaluation
+         в соответствующие критерии записей (custom_id = criteria|портал|id записи|id критерия).
+      2. Критерии, которые ещё выполняются в незавершённых батчах, оставляет без text и evaluation,
+         поэтому запись остаётся в статусе fixed и будет подобрана в следующем цикле.
+      3. Для остальных критериев без результата формирует запросы и отправляет новый батч.
+
+    :param input_data: Словарь с данными клиентов (см. analyze_criteria).
+    :return: То же самое input_data с результатами критериев, для которых ответ уже получен.
+    """
+    results, merged_batch_ids = await collect_batch_results("criteria")
+    pending = get_pending_custom_ids("criteria")
+    requests = []
+    applied = 0
+    # custom_id ответов, обработанных в этом цикле: только они удаляются из llm_batch_results
+    consumed = set()
 
-    # Собираем все задачи в один список
-    total_criteria_count = 0
     for client, client_block in input_data.items():
         records = client_block.get("records", [])
         criteria_definitions = client_block.get("criteria", [])
         for record in records:
             dialogue = record.get("dialogue", "")
             record_id = record.get("id", "<no-id>")
-            # Список ссылок на критерии в этой записи
-            crit_refs = record.get("data", {}).get("criteria", [])
+            crit_refs = (record.get("data") or {}).get("criteria", [])
             for crit_ref in crit_refs:
-                # Находим полное определение критерия (чтобы взять prompt, правила и т.д.)
                 full_crit = next(
                     (c for c in criteria_definitions if c["id"] == crit_ref.get("id")),
                     crit_ref
                 )
-                # создаём корутину, но не запускаем её сразу, а в gather ниже
-                coro = process_with_retries(dialogue, full_crit, record_id)
-                tasks.append((crit_ref, coro))
-                total_criteria_count += 1
-
-    logger.info(f"Начинаю анализ {total_criteria_count} критериев")
-    
-    # Параллельно выполняем все запросы
-    results = await asyncio.gather(*(t[1] for t in tasks))
-    
-    logger.info(f"Завершен анализ критериев")
-
-    # Распаковываем результаты обратно в crit_refs
-    for (crit_ref, _), processed in zip(tasks, results):
-        if processed is not None:
-            crit_ref["text"] = processed.get("text")
-            crit_ref["evaluation"] = processed.get("evaluation")
-        else:
-            crit_ref["text"] = None
-            crit_ref["evaluation"] = None
+                custom_id = make_custom_id("criteria", client, record_id, crit_ref.get("id"))
+                if custom_id in results:
+                    consumed.add(custom_id)
+
+                # Актуальный результат по критерию уже есть
+                if has_criterion_result(crit_ref, full_crit, dialogue):
+                    continue
+
+                if not criterion_needs_llm(full_crit):
+                    _store_criterion_result(crit_ref, full_crit, dialogue, {"text": "", "evaluation": None, "model": None})
+                elif custom_id in results:
+                    try:
+                        processed = parse_criterion_response(results[custom_id]["content"], full_crit, record_id)
+                        processed["model"] = results[custom_id].get("model")
+                        _store_criterion_result(crit_ref, full_crit, dialogue, processed)
+                        applied += 1
+                    except Exception as e:
+                        # Критерий будет отправлен в новый батч в следующем цикле
+                        logger.warning(f"[ERR]  ID={record_id!r}, критерий={full_crit.get('name')!r}, ответ батча: {e}")
+                elif custom_id not in pending:
+                    route = get_route(STAGE, full_crit.get("llm_type") or STANDARD, client)
+                    requests.append({
+                        "custom_id": custom_id,
+                        "model": route["model"],
+                        "params": route["params"],
+                        "messages": build_criterion_messages(dialogue, full_crit),
+                        "response_format": CRITERION_SCHEMA
+                    })
+
+    logger.info(f"Батч критериев: применено {applied} ответов, ожидается {len(pending)}, к отправке {len(requests)}")
+
+    await submit_batch("criteria", requests)
+    mark_batches_merged(merged_batch_ids, consumed)
 
     return input_data
 
+
 # Пример использования
 if __name__ == "__main__":
     import json
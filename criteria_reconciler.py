@@ -0,0 +1,169 @@
+import asyncio
+import json
+from db_client import get_db_client
+from db_fetcher import get_tables_with_status_column
+from criteria_analyzer import analyze_criteria, is_stale_result, is_record_analyzed
+from llm_scheduler import should_run_now, defer_job, fetch_deferred_jobs, complete_deferred_job
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('criteria_reconciler', 'logs/criteria_reconciler.log')
+
+# Стадия повторного анализа: несрочная, модели — из маршрутов reanalysis в llm_routing.json
+STAGE = "reanalysis"
+
+
+def _fetch_criteria_definitions(portal: str) -> dict:
+    """
+    Возвращает текущие определения критериев портала {id: criterion}.
+    """
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT * FROM {portal}_criteria;")
+            columns = [desc[0] for desc in cur.description]
+            return {row[columns.index("id")]: dict(zip(columns, row)) for row in cur.fetchall()}
+
+
+def find_stale_results(portal: str, retired_models=()) -> list[dict]:
+    """
+    Находит результаты критериев в готовых записях портала, которые устарели по отпечатку
+    (изменился промпт или диалог, либо ответ дала модель из retired_models, см. is_stale_result).
+    Хэш диалога считается в БД, поэтому тексты диалогов не выгружаются.
+
+    :return: [{"id": id записи, "criteria": [id устаревших критериев]}, ...] — от новых записей к старым.
+    """
+    definitions = _fetch_criteria_definitions(portal)
+
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT id, left(md5(coalesce(dialogue, '')), 16), data->'criteria'
+                FROM {portal}
+                WHERE status = 'ready' AND data ? 'criteria'
+                ORDER BY date DESC;
+            """)
+            rows = cur.fetchall()
+
+    stale = []
+    for record_id, current_dialogue_hash, crit_refs in rows:
+        stale_ids = [
+            crit_ref["id"] for crit_ref in crit_refs or []
+            if crit_ref.get("id") in definitions
+            and is_stale_result(crit_ref, definitions[crit_ref["id"]], current_dialogue_hash, retired_models)
+        ]
+        if stale_ids:
+            stale.append({"id": record_id, "criteria": stale_ids})
+    return stale
+
+
+def requeue_stale_results(portals: list[str] = None, retired_models=()) -> int:
+    """
+    Ставит устаревшие пары (запись, критерий) всех порталов в очередь deferred_jobs стадии reanalysis
+    (ключ задачи — id записи, payload — id критериев). Выполняются они в drain_reanalysis.
+    Записи, которые уже ждут в очереди, повторно не ставятся.
+
+    :param portals: Порталы (имена таблиц); по умолчанию — все таблицы с колонкой status.
+    :param retired_models: Модели, результаты которых нужно пересчитать независимо от промпта.
+    :return: Количество поставленных в очередь пар.
+    """
+    queued = {(job["portal"], job["job_key"]) for job in fetch_deferred_jobs(STAGE)}
+    total = 0
+    for portal in portals or get_tables_with_status_column():
+        try:
+            stale = find_stale_results(portal, retired_models)
+        except Exception as e:
+            logger.warning(f"Портал {portal}: не удалось проверить отпечатки критериев: {e}")
+            continue
+        stale = [record for record in stale if (portal, str(record["id"])) not in queued]
+        for record in stale:
+            defer_job(STAGE, portal, record["id"], record["criteria"])
+        count = sum(len(record["criteria"]) for record in stale)
+        if count:
+            logger.info(f"Портал {portal}: {count} устаревших результатов в {len(stale)} записях поставлено в очередь")
+        total += count
+    return total
+
+
+async def drain_reanalysis(
+    max_records: int = 500,
+    max_concurrent_requests: int = 500,
+    retry_delay: float = 0.1,
+    max_retries: int = 3
+) -> int:
+    """
+    В скидочное окно модели стадии reanalysis заново анализирует устаревшие критерии из очереди:
+    сначала в самых свежих записях, не больше max_records записей за вызов. Остальные критерии
+    записи не запрашиваются; обновляется только data записи, статус не меняется.
+    Описания сущностей по новым результатам не пересчитываются.
+
+    :return: Количество переанализированных записей.
+    """
+    if not should_run_now(STAGE):
+        return 0
+
+    jobs = fetch_deferred_jobs(STAGE)
+    if not jobs:
+        return 0
+
+    # Загружаем записи и определения критериев по порталам
+    input_data = {}
+    for portal in {job["portal"] for job in jobs}:
+        record_ids = [job["job_key"] for job in jobs if job["portal"] == portal]
+        with get_db_client() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT id, date, dialogue, data FROM {portal} WHERE id = ANY(%s);", (record_ids,))
+                records = [{"id": str(record_id), "date": date, "dialogue": dialogue, "data": data}
+                           for record_id, date, dialogue, data in cur.fetchall()]
+        input_data[portal] = {"records": records, "criteria": list(_fetch_criteria_definitions(portal).values())}
+
+    jobs_by_record = {(job["portal"], job["job_key"]): job for job in jobs}
+    found = {(portal, record["id"]) for portal, block in input_data.items() for record in block["records"]}
+    for key, job in jobs_by_record.items():
+        if key not in found:
+            logger.warning(f"Запись {job['portal']}/{job['job_key']} не найдена, задача удалена")
+            complete_deferred_job(STAGE, job)
+
+    # Самые свежие записи — первыми
+    selected = sorted(
+        ((portal, record) for portal, block in input_data.items() for record in block["records"]),
+        key=lambda item: item[1]["date"],
+        reverse=True
+    )[:max_records]
+    selected_keys = {(portal, record["id"]) for portal, record in selected}
+    for portal, block in input_data.items():
+        block["records"] = [record for record in block["records"] if (portal, record["id"]) in selected_keys]
+
+    # Убираем устаревшие результаты, чтобы analyze_criteria запросил только их
+    for portal, record in selected:
+        stale_ids = set(jobs_by_record[(portal, record["id"])]["payload"])
+        for crit_ref in (record.get("data") or {}).get("criteria", []):
+            if crit_ref.get("id") in stale_ids:
+                for key in ("text", "evaluation", "fingerprint"):
+                    crit_ref.pop(key, None)
+
+    logger.info(f"Скидочное окно открыто: переанализирую {len(selected)} из {len(jobs)} записей")
+    await analyze_criteria(input_data, max_retries, retry_delay, max_concurrent_requests,
+                           multi_criteria=True, stage=STAGE)
+
+    done = 0
+    for portal, record in selected:
+        # Критерии без нового результата остаются в очереди до следующего окна
+        if not is_record_analyzed(record):
+            continue
+        with get_db_client() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE {portal} SET data = %s WHERE id = %s;", (json.dumps(record["data"]), record["id"]))
+            conn.commit()
+        complete_deferred_job(STAGE, jobs_by_record[(portal, record["id"])])
+        done += 1
+
+    logger.info(f"Переанализировано записей: {done}")
+    return done
+
+
+if __name__ == "__main__":
+    # Ручной запуск после правки промптов: ставит устаревшие результаты в очередь
+    # и, если скидочное окно открыто, сразу их пересчитывает
+    queued = requeue_stale_results()
+    print(f"Поставлено в очередь устаревших результатов: {queued}")
+    print(f"Переанализировано записей: {asyncio.run(drain_reanalysis())}")
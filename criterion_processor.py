@@ -1,7 +1,9 @@
 import asyncio
+import hashlib
 import json
-from functools import partial
-from llm_router import llm_request
+from llm_routing import route_request, STANDARD
+from llm_tokens import count_tokens
+from dialog_windows import split_dialogue
 from logger_config import setup_logger
 
 # Настройка логгера для этого модуля
@@ -23,7 +25,400 @@ PROMPT2 = """
 """
 
 
-async def process_client_data(dialogue: str, data: dict, record_id: str = None) -> dict:
+# Инструкции для пакетной оценки нескольких критериев одним запросом
+MULTI_PROMPT = """
+Ниже приведены несколько критериев, каждый со своим id и промптом. Выполни промпт каждого критерия отдельно.
+Ответ выдай строго в виде словаря следующего синтаксиса:
+{"results": [{"id": id критерия, "text": "ответ на промпт критерия", "evaluation": оценка по шкале от 1 до 100 в рамках промпта критерия}, ...]}
+В results должен быть ровно один элемент на каждый критерий. Если в ответе по критерию ты не нашел никакой
+информации, то ставь оценку null. Оценка ставится только в ключе evaluation, в ключе text оценки ставить запрещено.
+"""
+
+
+# Объединение ответов по фрагментам длинного диалога (см. process_long_dialogue_criteria)
+REDUCE_PROMPT = """
+Длинный диалог был разбит на последовательные пересекающиеся фрагменты, и промпт каждого критерия был выполнен
+по каждому фрагменту отдельно. Ниже для каждого критерия приведены его id, промпт и ответы по фрагментам в порядке
+следования фрагментов. Составь по каждому критерию один ответ для всего диалога, выполнив требования его промпта:
+объедини сведения из всех фрагментов, не дублируй пункты, повторяющиеся в соседних фрагментах, а если фрагменты
+противоречат друг другу, опирайся на более поздний. Оценку выставь по диалогу в целом по шкале от 1 до 100.
+Ответ выдай строго в виде словаря следующего синтаксиса:
+{"results": [{"id": id критерия, "text": "ответ на промпт критерия по всему диалогу", "evaluation": оценка или null}, ...]}
+"""
+
+
+# Стадия анализа: модель критерия выбирается по его llm_type в таблице маршрутов (см. llm_routing)
+STAGE = "criteria"
+
+# Ограничения группы критериев в одном пакетном запросе
+MAX_CRITERIA_PER_REQUEST = 10
+MAX_GROUP_PROMPT_TOKENS = 6000
+# Прогноз размера ответа на один критерий
+OUTPUT_TOKENS_PER_CRITERION = 400
+
+# Диалоги длиннее LONG_DIALOGUE_TOKENS оцениваются по окнам с последующим объединением ответов
+LONG_DIALOGUE_TOKENS = 12000
+WINDOW_TOKENS = 8000
+WINDOW_OVERLAP_TOKENS = 500
+
+# Схема ответа для структурированного вывода (см. llm_router.allm_request)
+CRITERION_SCHEMA = {
+    "name": "criterion_result",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "text": {"type": "string"},
+            "evaluation": {"type": ["number", "null"]}
+        },
+        "required": ["text", "evaluation"],
+        "additionalProperties": False
+    }
+}
+
+MULTI_CRITERIA_SCHEMA = {
+    "name": "criteria_results",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "integer"},
+                        "text": {"type": "string"},
+                        "evaluation": {"type": ["number", "null"]}
+                    },
+                    "required": ["id", "text", "evaluation"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["results"],
+        "additionalProperties": False
+    }
+}
+
+
+def criterion_needs_llm(data: dict) -> bool:
+    """
+    Возвращает False, если у критерия отключены и show_text_description, и evaluate_criterion:
+    такой критерий обрабатывается без запроса к нейросети.
+    """
+    return bool(data.get("show_text_description", False) or data.get("evaluate_criterion", False))
+
+
+def prompt_hash(data: dict) -> str:
+    """
+    Возвращает хэш промпта критерия (часть отпечатка результата, см. make_fingerprint).
+    """
+    return hashlib.sha256(data.get("prompt", "").encode("utf-8")).hexdigest()[:16]
+
+
+def dialogue_hash(dialogue: str) -> str:
+    """
+    Возвращает хэш текста диалога. Совпадает с left(md5(dialogue), 16) в PostgreSQL,
+    поэтому устаревшие результаты можно искать, не выгружая тексты диалогов (см. criteria_reconciler).
+    """
+    return hashlib.md5((dialogue or "").encode("utf-8")).hexdigest()[:16]
+
+
+def make_fingerprint(data: dict, model: str, dialogue: str) -> dict:
+    """
+    Возвращает отпечаток результата критерия {"prompt", "model", "dialogue"}: хэш промпта,
+    модель, давшую ответ, и хэш диалога. Сохраняется рядом с результатом в data.criteria записи,
+    чтобы после изменения промпта или диалога найти ровно те результаты, которые устарели.
+    """
+    return {"prompt": prompt_hash(data), "model": model, "dialogue": dialogue_hash(dialogue)}
+
+
+def build_criterion_messages(dialogue: str, data: dict) -> list:
+    """
+    Формирует сообщения запроса по критерию в виде стабильного префикса и переменного суффикса:
+      - system: PROMPT1 + PROMPT2 (общие для всех критериев);
+      - user: текст диалога (общий для всех критериев одной записи);
+      - user: prompt критерия.
+    Запросы по разным критериям одного диалога отличаются только последним сообщением,
+    поэтому инструкции и диалог попадают в кэш префиксов провайдера.
+    """
+    description = data.get("prompt", "")
+
+    return [
+        {"role": "system", "content": f"{PROMPT1}{PROMPT2}"},
+        {"role": "user", "content": f"Текст диалога:{dialogue}"},
+        {"role": "user", "content": f"Задание:{description}"}
+    ]
+
+
+def parse_criterion_response(response_content, data: dict, record_id: str = None) -> dict:
+    """
+    Разбирает ответ нейросети {"text": "...", "evaluation": ...} (текст или уже разобранный
+    по CRITERION_SCHEMA объект) и применяет флаги критерия:
+      - evaluation делится на 20 и округляется до одной десятичной, если evaluate_criterion == True;
+      - если show_text_description == False, text заменяется на пустую строку;
+      - если evaluate_criterion == False, evaluation заменяется на None.
+    Возвращает словарь с ключами "text" и "evaluation".
+    """
+    criterion_name = data.get("name", "Неизвестный критерий")
+    criterion_id = data.get("id", "N/A")
+    record_info = f"запись {record_id}" if record_id else "неизвестная запись"
+
+    try:
+        parsed_json = response_content if isinstance(response_content, dict) else json.loads(response_content)
+    except json.JSONDecodeError as e:
+        logger.error(f"Ошибка при парсинге JSON для критерия '{criterion_name}' (ID: {criterion_id}), {record_info}: {e}")
+        logger.error(f"Содержимое response_content: {response_content}")
+        raise
+
+    return apply_criterion_flags(parsed_json, data, record_id)
+
+
+def validate_criterion_answer(parsed_json: dict, data: dict):
+    """
+    Проверяет ответ по критерию и выбрасывает ValueError, если он непригоден:
+    оценка вне шкалы 0–100 или пустой текст у критерия с show_text_description.
+    Непрошедший проверку ответ standard-модели повторяется на premium (см. llm_routing.route_request).
+    """
+    text = parsed_json.get("text")
+    evaluation = parsed_json.get("evaluation")
+
+    if not isinstance(text, str):
+        raise ValueError(f"Некорректный text в ответе: {text!r}")
+    if evaluation is not None:
+        if isinstance(evaluation, bool) or not isinstance(evaluation, (int, float)) or not 0 <= evaluation <= 100:
+            raise ValueError(f"Оценка вне шкалы 0–100: {evaluation!r}")
+    if data.get("show_text_description", False) and not text.strip():
+        raise ValueError("Пустой text в ответе")
+
+
+def apply_criterion_flags(parsed_json: dict, data: dict, record_id: str = None) -> dict:
+    """
+    Проверяет разобранный ответ {"text": "...", "evaluation": ...} (см. validate_criterion_answer)
+    и применяет к нему флаги критерия (правила см. parse_criterion_response).
+    Возвращает словарь с ключами "text" и "evaluation".
+    """
+    validate_criterion_answer(parsed_json, data)
+
+    show_text = data.get("show_text_description", False)
+    eval_crit = data.get("evaluate_criterion", False)
+
+    criterion_name = data.get("name", "Неизвестный критерий")
+    record_info = f"запись {record_id}" if record_id else "неизвестная запись"
+
+    text = parsed_json.get("text")
+    eval_raw = parsed_json.get("evaluation")
+
+    if eval_raw is not None and eval_crit:
+        eval_raw = round(float(eval_raw) / 20, 1)
+
+    if not show_text:
+        text = ""
+    if not eval_crit:
+        eval_raw = None
+
+    # Логируем результат
+    if eval_raw is not None:
+        logger.info(f"Завершена обработка критерия '{criterion_name}' для {record_info} - оценка: {eval_raw}")
+    else:
+        logger.info(f"Завершена обработка критерия '{criterion_name}' для {record_info} - без оценки")
+
+    return {"text": text, "evaluation": eval_raw}
+
+
+def group_criteria(criteria: list) -> list[list]:
+    """
+    Делит критерии записи на группы для пакетной оценки: в группе только критерии одного llm_type
+    (группа уходит на одну модель), не больше MAX_CRITERIA_PER_REQUEST критериев, а суммарный размер
+    их промптов не превышает MAX_GROUP_PROMPT_TOKENS.
+    """
+    groups = []
+    llm_types = dict.fromkeys(criterion.get("llm_type") or STANDARD for criterion in criteria)
+    for llm_type in llm_types:
+        current, current_tokens = [], 0
+        for criterion in criteria:
+            if (criterion.get("llm_type") or STANDARD) != llm_type:
+                continue
+            tokens = count_tokens(criterion.get("prompt", ""))
+            if current and (len(current) >= MAX_CRITERIA_PER_REQUEST or current_tokens + tokens > MAX_GROUP_PROMPT_TOKENS):
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(criterion)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+    return groups
+
+
+def build_multi_criterion_messages(dialogue: str, criteria: list) -> list:
+    """
+    Формирует один запрос по нескольким критериям одного диалога:
+      - system: PROMPT1 + MULTI_PROMPT (общие для всех записей);
+      - user: текст диалога;
+      - user: список критериев с их id и prompt.
+    """
+    tasks = "\n\n".join(f"Критерий id={criterion['id']}:\n{criterion.get('prompt', '')}" for criterion in criteria)
+
+    return [
+        {"role": "system", "content": f"{PROMPT1}{MULTI_PROMPT}"},
+        {"role": "user", "content": f"Текст диалога:{dialogue}"},
+        {"role": "user", "content": f"Критерии:\n{tasks}"}
+    ]
+
+
+def parse_multi_criterion_response(parsed: dict, criteria: list, record_id: str = None) -> dict:
+    """
+    Разбирает ответ {"results": [{"id", "text", "evaluation"}, ...]} и применяет флаги
+    каждого критерия. Возвращает {id критерия: {"text", "evaluation"}} только для критериев,
+    ответ по которым найден в results и прошёл проверку (см. validate_criterion_answer).
+    """
+    by_id = {criterion["id"]: criterion for criterion in criteria}
+    results = {}
+    for item in parsed.get("results", []):
+        criterion = by_id.get(item.get("id"))
+        if criterion is None or criterion["id"] in results:
+            continue
+        try:
+            results[criterion["id"]] = apply_criterion_flags(item, criterion, record_id)
+        except ValueError as e:
+            logger.warning(f"Запись {record_id}: ответ по критерию {criterion['id']} не прошёл проверку: {e}")
+    return results
+
+
+def parse_partial_criterion_response(parsed: dict, criteria: list) -> dict:
+    """
+    Разбирает ответ по фрагменту длинного диалога {"results": [...]}: возвращает {id критерия: {"text", "evaluation"}}
+    без применения флагов критерия (оценка остаётся по шкале 1–100) — это промежуточные ответы для объединения.
+    """
+    by_id = {criterion["id"]: criterion for criterion in criteria}
+    results = {}
+    for item in parsed.get("results", []):
+        criterion = by_id.get(item.get("id"))
+        if criterion is None or criterion["id"] in results:
+            continue
+        try:
+            validate_criterion_answer(item, criterion)
+        except ValueError:
+            continue
+        results[criterion["id"]] = {"text": item["text"], "evaluation": item.get("evaluation")}
+    return results
+
+
+def build_reduce_messages(criteria: list, partials: dict) -> list:
+    """
+    Формирует запрос на объединение ответов по фрагментам:
+      - system: PROMPT1 + REDUCE_PROMPT;
+      - user: для каждого критерия — id, prompt и ответы по фрагментам (partials: {id: [{"text", "evaluation"}, ...]}).
+    """
+    blocks = []
+    for criterion in criteria:
+        answers = "\n".join(
+            f"Фрагмент {number}: оценка {answer['evaluation']}. {answer['text']}"
+            for number, answer in enumerate(partials[criterion["id"]], start=1)
+        )
+        blocks.append(f"Критерий id={criterion['id']}:\n{criterion.get('prompt', '')}\nОтветы по фрагментам:\n{answers}")
+
+    return [
+        {"role": "system", "content": f"{PROMPT1}{REDUCE_PROMPT}"},
+        {"role": "user", "content": "\n\n".join(blocks)}
+    ]
+
+
+async def process_long_dialogue_criteria(dialogue: str, criteria: list, record_id: str = None, hedge: bool = False,
+                                         portal: str = None, stage: str = STAGE) -> dict:
+    """
+    Оценивает группу критериев (одного llm_type) по длинному диалогу в два шага:
+      1. map: диалог делится на пересекающиеся окна по границам реплик (см. dialog_windows.split_dialogue),
+         критерии выполняются по всем окнам параллельно;
+      2. reduce: если ответ есть по нескольким окнам, ответы объединяются одним запросом (REDUCE_PROMPT),
+         ответ по единственному окну используется как есть.
+
+    :return: {id критерия: {"text", "evaluation", "model"}}, как у process_client_criteria.
+    """
+    llm_type = criteria[0].get("llm_type") or STANDARD
+    windows = split_dialogue(dialogue, WINDOW_TOKENS, WINDOW_OVERLAP_TOKENS)
+    logger.info(f"Запись {record_id}: длинный диалог, оцениваю {len(criteria)} критериев по {len(windows)} окнам")
+
+    def parse_partial(response: dict) -> dict:
+        partial = parse_partial_criterion_response(response["parsed"], criteria)
+        if not partial:
+            raise ValueError("В ответе по фрагменту нет пригодных результатов")
+        return partial
+
+    mapped = await asyncio.gather(*(
+        route_request(stage,
+                      build_multi_criterion_messages(f" (фрагмент {number} из {len(windows)})\n{window['text']}", criteria),
+                      parse_partial, llm_type=llm_type, portal=portal, response_format=MULTI_CRITERIA_SCHEMA,
+                      expected_output_tokens=OUTPUT_TOKENS_PER_CRITERION * len(criteria), hedge=hedge)
+        for number, window in enumerate(windows, start=1)
+    ))
+
+    partials = {}
+    for partial, response in mapped:
+        for criterion_id, answer in partial.items():
+            partials.setdefault(criterion_id, []).append({**answer, "model": response.get("model")})
+
+    results = {}
+    to_reduce = []
+    for criterion in criteria:
+        answers = partials.get(criterion["id"], [])
+        if len(answers) == 1:
+            results[criterion["id"]] = {**apply_criterion_flags(answers[0], criterion, record_id),
+                                        "model": answers[0]["model"]}
+        elif answers:
+            to_reduce.append(criterion)
+
+    if to_reduce:
+        def parse_reduce(response: dict) -> dict:
+            parsed_results = parse_multi_criterion_response(response["parsed"], to_reduce, record_id)
+            if not parsed_results:
+                raise ValueError("В ответе на объединение нет пригодных результатов")
+            return parsed_results
+
+        reduced, response = await route_request(stage, build_reduce_messages(to_reduce, partials), parse_reduce,
+                                                llm_type=llm_type, portal=portal, response_format=MULTI_CRITERIA_SCHEMA,
+                                                expected_output_tokens=OUTPUT_TOKENS_PER_CRITERION * len(to_reduce),
+                                                hedge=hedge)
+        for criterion_id, result in reduced.items():
+            results[criterion_id] = {**result, "model": response.get("model")}
+
+    return results
+
+
+async def process_client_criteria(dialogue: str, criteria: list, record_id: str = None, hedge: bool = False,
+                                  portal: str = None, stage: str = STAGE) -> dict:
+    """
+    Оценивает группу критериев одного диалога (одного llm_type) одним запросом к нейросети
+    (см. group_criteria и build_multi_criterion_messages). Модель выбирается по llm_type группы
+    и порталу portal в маршрутах стадии stage; если в ответе нет ни одного пригодного результата,
+    запрос повторяется на premium.
+
+    Диалоги длиннее LONG_DIALOGUE_TOKENS оцениваются по окнам (см. process_long_dialogue_criteria).
+
+    :return: {id критерия: {"text", "evaluation", "model"}}; критерии, отсутствующие в ответе модели,
+             в результат не попадают — их нужно обработать по отдельности через process_client_data.
+    """
+    if count_tokens(dialogue) > LONG_DIALOGUE_TOKENS:
+        return await process_long_dialogue_criteria(dialogue, criteria, record_id, hedge, portal, stage)
+
+    messages = build_multi_criterion_messages(dialogue, criteria)
+
+    def parse(response: dict) -> dict:
+        parsed_results = parse_multi_criterion_response(response["parsed"], criteria, record_id)
+        if not parsed_results:
+            raise ValueError("В пакетном ответе нет пригодных результатов")
+        return parsed_results
+
+    results, response = await route_request(stage, messages, parse, llm_type=criteria[0].get("llm_type") or STANDARD,
+                                            portal=portal, response_format=MULTI_CRITERIA_SCHEMA,
+                                            expected_output_tokens=OUTPUT_TOKENS_PER_CRITERION * len(criteria),
+                                            hedge=hedge)
+    if len(results) < len(criteria):
+        logger.warning(f"Запись {record_id}: в пакетном ответе {len(results)} из {len(criteria)} критериев")
+    return {criterion_id: {**result, "model": response.get("model")} for criterion_id, result in results.items()}
+
+
+async def process_client_data(dialogue: str, data: dict, record_id: str = None, hedge: bool = False,
+                              portal: str = None, stage: str = STAGE) -> dict:
     """
     Асинхронная функция, принимающая на вход словарь формата:
     {
@@ -42,18 +437,18 @@ async def process_client_data(dialogue: str, data: dict, record_id: str = None)
       - Если оба флага "show_text_description" и "evaluate_criterion" равны False, то запрос к ChatGPT не выполняется,
         а возвращается словарь с пустым текстом и оценкой None.
       - В противном случае:
-          - Формируется prompt из PROMPT1, содержимого поля "prompt", текста диалога и всегда добавляется PROMPT2.
-          - Отправляется запрос к ChatGPT.
+          - Формируются сообщения из PROMPT1 и PROMPT2, текста диалога и содержимого поля "prompt" (см. build_criterion_messages).
+          - Отправляется запрос к модели уровня llm_type из маршрутов стадии stage (с учётом портала portal).
           - Ответ парсится как JSON-словарь вида {"text": "...", "evaluation": ...}.
           - Если в ответе evaluation не None, то, если evaluate_criterion == True, делится значение на 20 и округляется до одной десятичной.
       - После получения ответа:
           - Если "show_text_description" == False, итоговый "text" заменяется на пустую строку.
           - Если "evaluate_criterion" == False, итоговая "evaluation" заменяется на None.
-      - Возвращается словарь, содержащий только ключи "text" и "evaluation".
+      - Возвращается словарь с ключами "text", "evaluation" и "model" (модель, давшая ответ; None без запроса).
+      - Если ответ не прошёл проверку (см. validate_criterion_answer), запрос повторяется на premium-модели.
+      - hedge=True включает хеджирование медленных запросов (см. llm_hedging).
+      - Диалоги длиннее LONG_DIALOGUE_TOKENS оцениваются по окнам с объединением ответов (см. process_long_dialogue_criteria).
     """
-    show_text = data.get("show_text_description", False)
-    eval_crit = data.get("evaluate_criterion", False)
-    
     criterion_name = data.get("name", "Неизвестный критерий")
     criterion_id = data.get("id", "N/A")
     record_info = f"запись {record_id}" if record_id else "неизвестная запись"
@@ -61,53 +456,23 @@ async def process_client_data(dialogue: str, data: dict, record_id: str = None)
     logger.info(f"Начинаю обработку критерия '{criterion_name}' (ID: {criterion_id}) для {record_info}")
 
     # Если оба флага False, запрос не выполняется.
-    if not show_text and not eval_crit:
+    if not criterion_needs_llm(data):
         logger.info(f"Пропускаю критерий '{criterion_name}' - флаги show_text и evaluate_criterion отключены")
-        return {"text": "", "evaluation": None}
-
-    description = data.get("prompt", "")
-    prompt = f"{PROMPT1}{description}\nТекст диалога:{dialogue}{PROMPT2}"
-    # print(prompt)  # Отладочный вывод отключен
-
-    messages = [
-        {"role": "user", "content": prompt}
-    ]
-
-    loop = asyncio.get_running_loop()
-    # Выполняем блокирующий вызов в отдельном потоке через run_in_executor
-    response = await loop.run_in_executor(
-        None,
-        partial(llm_request,
-                model="gpt-5-nano",
-                messages=messages)
-    )
-
-    response_content = response.get("content", "")
-    try:
-        parsed_json = json.loads(response_content)
-    except json.JSONDecodeError as e:
-        logger.error(f"Ошибка при парсинге JSON для критерия '{criterion_name}' (ID: {criterion_id}), {record_info}: {e}")
-        logger.error(f"Содержимое response_content: {response_content}")
-        raise
-
-    text = parsed_json.get("text")
-    eval_raw = parsed_json.get("evaluation")
-
-    if eval_raw is not None and eval_crit:
-        eval_raw = round(float(eval_raw) / 20, 1)
+        return {"text": "", "evaluation": None, "model": None}
 
-    if not show_text:
-        text = ""
-    if not eval_crit:
-        eval_raw = None
+    if count_tokens(dialogue) > LONG_DIALOGUE_TOKENS:
+        results = await process_long_dialogue_criteria(dialogue, [data], record_id, hedge, portal, stage)
+        if data.get("id") not in results:
+            raise ValueError(f"Нет результата по критерию '{criterion_name}' ни в одном фрагменте диалога")
+        return results[data["id"]]
 
-    # Логируем результат
-    if eval_raw is not None:
-        logger.info(f"Завершена обработка критерия '{criterion_name}' для {record_info} - оценка: {eval_raw}")
-    else:
-        logger.info(f"Завершена обработка критерия '{criterion_name}' для {record_info} - без оценки")
+    messages = build_criterion_messages(dialogue, data)
 
-    return {"text": text, "evaluation": eval_raw}
+    result, response = await route_request(stage, messages,
+                                           lambda response: parse_criterion_response(response["parsed"], data, record_id),
+                                           llm_type=data.get("llm_type") or STANDARD, portal=portal,
+                                           response_format=CRITERION_SCHEMA, hedge=hedge)
+    return {**result, "model": response.get("model")}
 
 
 # Примеры использования:
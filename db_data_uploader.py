@@ -22,7 +22,8 @@ def upload_records_from_dict(data_dict: dict, status: str):
     2. Если 'data' есть, проверяем массив 'criteria' внутри data на полноту:
        - должны присутствовать поля: name, description, isEvaluated, evaluation, text.
        - если хотя бы одно отсутствует — обновляем только data (статус не трогаем).
-       - если все поля есть во всех объектах 'criteria' — обновляем data и ставим status равным аргументу функции (status).
+       - если все поля есть во всех объектах 'criteria' — обновляем data и ставим status равным аргументу функции (status),
+         а время смены статуса записываем в data.status_at (по нему дообучаются модели категорий, см. category_model.py).
     По окончании всех обновлений вызываем commit.
     """
 
@@ -65,7 +66,7 @@ def upload_records_from_dict(data_dict: dict, status: str):
                         # Все поля в criteria на месте => обновляем data и ставим статус = 'status' из аргумента
                         update_query = f"""
                             UPDATE {table_name}
-                            SET data = %s,
+                            SET data = %s::jsonb || jsonb_build_object('status_at', localtimestamp),
                                 status = %s
                             WHERE id = %s
                         """
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import time
+import psycopg2.extras
+from db_client import get_db_client
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('db_record_sink', 'logs/db_record_sink.log')
+
+# Колонки записей, которые хранятся в JSONB
+JSON_FIELDS = {"data", "audio_metadata"}
+
+
+class RecordSink:
+    """
+    Накопитель готовых записей для sink-параметров стадий (process_dialogs, classify_dialogs, analyze_criteria,
+    process_and_store_dialogs). Записи, у которых стадия завершена, копятся в буфере и сбрасываются в БД
+    одним UPDATE через execute_values каждые flush_size записей или раз в flush_interval секунд.
+    Так результаты оплаченных запросов сохраняются по ходу стадии, а перезапуск продолжает с места остановки.
+
+    Использование:
+        async with RecordSink(["dialogue", "summary"], default_status="fixed") as sink:
+            await process_dialogs(records, ..., sink=sink)
+    """
+
+    def __init__(self, fields: list[str], default_status: str = None, flush_size: int = 50,
+                 flush_interval: float = 5.0, name: str = "records"):
+        """
+        :param fields: Колонки, значения которых берутся из записи (например, ["dialogue", "summary"] или ["data"]).
+        :param default_status: Статус записи после стадии. Статус из самой записи (поле 'status') имеет приоритет,
+                               как в upload_recognized_dialogs. None — статус не меняется.
+        :param flush_size: Сбрасывать буфер, как только в нём столько записей.
+        :param flush_interval: Сбрасывать буфер не реже, чем раз в столько секунд.
+        :param name: Название для логов.
+        """
+        self.fields = list(fields)
+        self.default_status = default_status
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self.flushed = 0
+        # {(таблица, id): значения для UPDATE}; повторное добавление записи заменяет прежние значения
+        self._buffer = {}
+        self._lock = asyncio.Lock()
+        self._last_flush = time.monotonic()
+        self._timer = None
+
+    def _row(self, record: dict) -> tuple | None:
+        """
+        Снимает значения записи на момент добавления (стадия дальше может менять record).
+        """
+        values = [record.get("id")]
+        for field in self.fields:
+            value = record.get(field)
+            values.append(json.dumps(value) if field in JSON_FIELDS and value is not None else value)
+        if self.default_status is not None:
+            values.append(record.get("status") or self.default_status)
+        return tuple(values) if values[0] is not None else None
+
+    async def __call__(self, table_name: str, record: dict):
+        """
+        Добавляет запись в буфер (сигнатура sink стадий: (портал, запись)) и сбрасывает буфер, если он заполнен.
+        """
+        row = self._row(record)
+        if row is None:
+            return
+        self._buffer[(table_name, row[0])] = row
+        if len(self._buffer) >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self._safe_flush()
+
+    def _update(self, rows_by_table: dict) -> int:
+        """
+        Обновляет записи одним UPDATE ... FROM (VALUES ...) на таблицу в одной транзакции.
+        """
+        columns = ["id"] + self.fields + (["status"] if self.default_status is not None else [])
+        assignments = []
+        for column in columns[1:]:
+            if column == "status":
+                assignments.append("status = v.status::status_enum")
+            elif column in JSON_FIELDS:
+                # Пустое значение не затирает уже сохранённый JSON (например, data без совмещённой классификации)
+                assignments.append(f"{column} = coalesce(v.{column}::jsonb, t.{column})")
+            else:
+                assignments.append(f"{column} = v.{column}")
+
+        updated = 0
+        with get_db_client() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    for table_name, rows in rows_by_table.items():
+                        psycopg2.extras.execute_values(
+                            cursor,
+                            f"""
+                                UPDATE {table_name} AS t
+                                SET {", ".join(assignments)}
+                                FROM (VALUES %s) AS v({", ".join(columns)})
+                                WHERE t.id = v.id
+                            """,
+                            rows,
+                            template="(" + ", ".join(["%s"] * len(columns)) + ")",
+                            page_size=len(rows)
+                        )
+                        updated += cursor.rowcount
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+        return updated
+
+    async def flush(self):
+        """
+        Сбрасывает буфер в БД. При ошибке записи возвращаются в буфер (если их не заменили более новые
+        значения) и исключение пробрасывается.
+        """
+        async with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._buffer:
+                return
+            pending, self._buffer = self._buffer, {}
+
+            rows_by_table = {}
+            for (table_name, _), row in pending.items():
+                rows_by_table.setdefault(table_name, []).append(row)
+
+            try:
+                updated = await asyncio.to_thread(self._update, rows_by_table)
+            except Exception:
+                for key, row in pending.items():
+                    self._buffer.setdefault(key, row)
+                raise
+
+            self.flushed += len(pending)
+            logger.info(f"{self.name}: сохранено {len(pending)} записей (обновлено строк {updated})")
+
+    async def _safe_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"{self.name}: не удалось сохранить {len(self._buffer)} записей, повторю позже: {e}")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                await self._safe_flush()
+
+    async def __aenter__(self):
+        self._timer = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """
+        Останавливает периодический сброс и сохраняет остаток буфера — в том числе, когда стадия
+        завершилась с ошибкой, чтобы не терять уже готовые записи.
+        """
+        self._timer.cancel()
+        try:
+            await self._timer
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+        return False
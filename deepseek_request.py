@@ -1,106 +1,141 @@
 import json
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
-from datetime import datetime, time, timezone
 from llm_response_cleaner import clean_llm_content
+from llm_pricing import compute_cost, normalize_usage
+from llm_rate_limiter import get_rate_limiter
 
 
-def is_in_discount_time(discount_time_str: str) -> bool:
+# Лимиты пула HTTP-соединений асинхронного клиента (должны покрывать max_concurrent_requests стадий)
+MAX_CONNECTIONS = 500
+MAX_KEEPALIVE_CONNECTIONS = 500
+
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+
+# Лимит выходных токенов, если он не задан в таблице маршрутов
+DEFAULT_MAX_TOKENS = 8000
+
+# Клиенты создаются один раз на процесс и переиспользуют keep-alive соединения
+_client = None
+_async_client = None
+
+
+def get_client() -> OpenAI:
     """
-    Проверяет, попадает ли текущий момент в UTC в интервал discount_time_str.
-    Формат discount_time_str ожидается как 'UTC HH:MM-HH:MM'.
-    Пример: 'UTC 16:30-00:30'.
-    Возвращает True, если текущее UTC-время в заданном диапазоне.
+    Возвращает синхронный клиент DeepSeek (OpenAI-совместимый), общий для всего процесса.
     """
-    # Сначала отбросим префикс 'UTC ' и получим '16:30-00:30'
-    if not discount_time_str.startswith("UTC "):
-        return False
+    global _client
+    if _client is None:
+        load_dotenv()
+        _client = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url=DEEPSEEK_BASE_URL)
+    return _client
+
 
-    time_range_str = discount_time_str.split("UTC ")[1]  # '16:30-00:30'
-    try:
-        start_str, end_str = time_range_str.split("-")  # '16:30' и '00:30'
-    except ValueError:
-        return False
+def get_async_client() -> AsyncOpenAI:
+    """
+    Возвращает асинхронный клиент DeepSeek (OpenAI-совместимый), общий для всего процесса.
+    Пул соединений рассчитан на MAX_CONNECTIONS одновременных запросов.
+    """
+    global _async_client
+    if _async_client is None:
+        load_dotenv()
+        _async_client = AsyncOpenAI(
+            api_key=os.getenv("DEEPSEEK_API_KEY"),
+            base_url=DEEPSEEK_BASE_URL,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS
+                )
+            )
+        )
+    return _async_client
+
+
+def _build_response(model: str, result, structured: bool = False) -> dict:
+    """
+    Извлекает ответ из результата chat.completions и рассчитывает стоимость запроса
+    с учётом скидочного окна DeepSeek (см. llm_pricing.compute_cost).
+    Возвращает словарь с очищенным контентом, стоимостью, моделью и usage (см. llm_pricing.normalize_usage).
+    Для запросов со схемой ответа (structured=True) ответ сразу разбирается в ключ "parsed".
+    """
+    # Извлекаем сгенерированный ответ
+    answer = result.choices[0].message.content
 
-    start_h, start_m = map(int, start_str.split(":"))
-    end_h, end_m = map(int, end_str.split(":"))
+    # Рассчитываем стоимость по единой таблице тарифов
+    total_cost = compute_cost(model, result.usage)
 
-    start_time = time(hour=start_h, minute=start_m)
-    end_time = time(hour=end_h, minute=end_m)
+    if structured:
+        # В JSON-режиме DeepSeek изредка возвращает пустой ответ
+        if not answer or not answer.strip():
+            raise Exception(f"Модель {model} вернула пустой ответ в JSON-режиме")
+        return {"content": answer, "parsed": json.loads(answer), "cost": total_cost,
+                "model": model, "usage": normalize_usage(result.usage)}
 
-    # Текущее время UTC (исправленный вариант)
-    now_utc = datetime.now(timezone.utc).time()
+    # Очищаем ответ (удаляем возможные обёртки ```json и т. п.)
+    answer = clean_llm_content(answer)
 
-    if start_time < end_time:
-        return start_time <= now_utc < end_time
-    else:
-        # Интервал переходит через полночь
-        return (now_utc >= start_time) or (now_utc < end_time)
+    return {"content": answer, "cost": total_cost, "model": model, "usage": normalize_usage(result.usage)}
 
 
-def request_deepseek(model: str, messages: list) -> dict:
+def _prepare_request(messages: list, response_format: dict = None, params: dict = None) -> tuple[list, dict]:
     """
-    Синхронная функция, делающая запрос к OpenAI.
+    Возвращает сообщения и дополнительные параметры chat.completions.
+    DeepSeek поддерживает только JSON-режим (json_object) без схемы,
+    поэтому схема ответа передаётся модели системным сообщением.
+    Из параметров генерации params (см. llm_routing) используются max_tokens и temperature.
+    """
+    params = params or {}
+    request_params = {"max_tokens": params.get("max_tokens") or DEFAULT_MAX_TOKENS}
+    if params.get("temperature") is not None:
+        request_params["temperature"] = params["temperature"]
+    if not response_format:
+        return messages, request_params
+    schema = json.dumps(response_format["schema"], ensure_ascii=False)
+    messages = [
+        {"role": "system", "content": f"Ответ выдай строго в формате JSON по схеме: {schema}"},
+        *messages
+    ]
+    request_params["response_format"] = {"type": "json_object"}
+    return messages, request_params
+
+
+def request_deepseek(model: str, messages: list, response_format: dict = None, params: dict = None) -> dict:
+    """
+    Синхронная функция, делающая запрос к DeepSeek.
     Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
+    Если передана схема ответа response_format ({"name", "schema"}), в ответе есть ключ "parsed".
     """
-    load_dotenv()
-    api_key = os.getenv("DEEPSEEK_API_KEY")
-    client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-    result = client.chat.completions.create(
+    messages, request_params = _prepare_request(messages, response_format, params)
+    result = get_client().chat.completions.create(
         model=model,
         messages=messages,
         stream=False,
-        max_tokens=8000
+        **request_params
     )
-    # Извлекаем сгенерированный ответ
-    answer = result.choices[0].message.content
+    return _build_response(model, result, structured=bool(response_format))
 
-    # Очищаем ответ (удаляем возможные обёртки ```json и т. п.)
-    answer = clean_llm_content(answer)
 
-    # Загрузка тарифов из файла llm_price.json
-    with open("llm_pricing.json", "r", encoding="utf-8") as f:
-        pricing = json.load(f)
-
-    # Извлекаем информацию о токенах из ответа API
-    completion_tokens = result.usage.completion_tokens
-    cached_tokens = result.usage.prompt_cache_hit_tokens
-    non_cached_prompt_tokens = result.usage.prompt_cache_miss_tokens
-
-    # Получаем тарифы для выбранной модели
-    model_pricing = pricing.get(model)
-    if not model_pricing:
-        raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
-
-    input_rate = model_pricing.get("1M TOKENS INPUT (CACHE MISS)")
-    cached_rate = model_pricing.get("1M TOKENS INPUT (CACHE HIT)")
-    output_rate = model_pricing.get("1M TOKENS OUTPUT")
-
-    if input_rate is None or cached_rate is None or output_rate is None:
-        raise Exception(f"Не указаны тарифы для входных, кэшированных или выходных "
-                        f"токенов для модели: {model}")
-
-    # Расчёт стоимости:
-    # Стоимость некэшированных prompt_tokens
-    cost_non_cached_prompt = (non_cached_prompt_tokens / 1_000_000) * input_rate
-    # Стоимость кэшированных prompt_tokens
-    cost_cached = (cached_tokens / 1_000_000) * cached_rate
-    # Стоимость output токенов
-    cost_output = (completion_tokens / 1_000_000) * output_rate
-    total_cost = cost_non_cached_prompt + cost_cached + cost_output
-
-    # Проверяем, есть ли в тарифе поля DISCOUNT TIME и DISCOUNT
-    discount_time = model_pricing.get("DISCOUNT TIME")
-    discount_factor = model_pricing.get("DISCOUNT")
-
-    if discount_time and discount_factor is not None:
-        # Если текущее время попадает в указанный временной интервал,
-        # умножаем итоговую стоимость на discount_factor
-        if is_in_discount_time(discount_time):
-            total_cost *= discount_factor
-
-    return {"content": answer, "cost": total_cost}
+async def arequest_deepseek(model: str, messages: list, response_format: dict = None,
+                            params: dict = None) -> dict:
+    """
+    Асинхронная функция, делающая запрос к DeepSeek через общий AsyncOpenAI клиент.
+    Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
+    Если передана схема ответа response_format ({"name", "schema"}), в ответе есть ключ "parsed".
+    """
+    messages, request_params = _prepare_request(messages, response_format, params)
+    raw_response = await get_async_client().chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        stream=False,
+        **request_params
+    )
+    # Передаём заголовки x-ratelimit-* общему ограничителю запросов
+    get_rate_limiter().update_from_headers(model, raw_response.headers)
+    result = raw_response.parse()
+    return _build_response(model, result, structured=bool(response_format))
 
 
 if __name__ == "__main__":
@@ -1,13 +1,21 @@
 import asyncio
 from db_fetcher import fetch_data
+from dialog_triage import triage_dialogs
+from dialog_glossary import update_glossaries, reset_glossary_stats
 from dialog_fixer_all import process_dialogs
-from db_dialog_uploader import upload_recognized_dialogs
+from db_record_sink import RecordSink
 from dialog_classifier import classify_dialogs
+from category_model import update_category_models
 from criteria_analyzer import analyze_criteria
 from db_data_uploader import upload_full_data_from_dict
 from debug_utils import save_debug_json, convert_datetime_to_string
 from entity_summarizer import summarize_entity_descriptions
-from entity_summary_aggregator import aggregate_entity_summaries
+from entity_summary_aggregator import aggregate_entity_summaries, drain_deferred_aggregations
+from criteria_reconciler import requeue_stale_results, drain_reanalysis, STAGE as REANALYSIS_STAGE
+from llm_scheduler import should_run_now
+from llm_cache import get_cache_stats
+from llm_tokens import get_estimate_stats, reset_stage_token_stats
+from llm_hedging import reset_hedge_budgets
 from logger_config import get_analysis_logger
 
 # Настройка логгера для этого модуля
@@ -17,18 +25,22 @@ logger = get_analysis_logger()
 async def main(delay: int):
     """
     Асинхронная основная функция, которая в бесконечном цикле:
-    1) Обрабатывает диалоги и обновляет данные в БД.
+    1) Обрабатывает диалоги и обновляет данные в БД. Результаты исправления, классификации и анализа
+       критериев сохраняются по мере готовности записей (RecordSink), поэтому при сбое повторно
+       запрашиваются только незавершённые записи.
     2) Суммирует данные по критериям сущностей.
-    3) Агрегирует summary сущностей.
+    3) Агрегирует summary сущностей (вне скидочного окна DeepSeek — откладывает в очередь).
     4) Загружает итоговые данные в БД.
-    5) Ждёт заданное количество секунд перед повторным запуском.
+    5) В скидочное окно выполняет отложенные агрегации.
+    6) В скидочное окно находит устаревшие результаты критериев и переанализирует их.
+    7) Ждёт заданное количество секунд перед повторным запуском.
     """
     while True:
         logger.info("Шаг 1: Получаю сырые диалоги из БД")
         try:
             records = fetch_data(
                 status="recognized",
-                fields=["id", "dialogue", "status"],
+                fields=["id", "dialogue", "status", "audio_metadata"],
                 analytics_mode=False
             )
             logger.info(f"Получено {len(records)} диалогов для обработки")
@@ -36,21 +48,32 @@ async def main(delay: int):
             # Сохраняем отладочные данные
             save_debug_json(records, "records")
 
-            logger.info("Шаг 2: Исправляю тексты диалогов и получаю резюме диалогов")
-            processed_records = await process_dialogs(
-                records,
-                max_concurrent_requests=500,
-                request_delay=0.1,
-                retries=3
-            )
-            logger.info(f"Обработано {len(processed_records)} диалогов")
+            # Словари локальных замен обновляются по парам текстов, исправленных в прошлых циклах.
+            # Выравнивание пар выполняется в отдельном потоке, чтобы не блокировать event loop
+            try:
+                terms = await asyncio.to_thread(update_glossaries, list(records))
+                logger.info(f"Словари замен обновлены, всего замен: {terms}")
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении словарей замен: {e}")
+
+            logger.info("Шаг 2: Отсеиваю пустые и короткие звонки, исправляю тексты диалогов и получаю резюме")
+            logger.info("Шаг 3: Сохраняю исправленные диалоги в БД по мере готовности (статус fixed/empty)")
+            async with RecordSink(["dialogue", "summary", "data"], default_status="fixed",
+                                  name="Исправление") as fixed_sink:
+                # Автоответчики, сбросы и короткие звонки обрабатываются локально, без запросов к LLM
+                records_to_fix = await triage_dialogs(records, sink=fixed_sink)
+                processed_records = await process_dialogs(
+                    records_to_fix,
+                    max_concurrent_requests=500,
+                    request_delay=2,
+                    retries=3,
+                    sink=fixed_sink,
+                    edit_mode=True
+                )
+            logger.info(f"Обработано {len(processed_records)} диалогов, сохранено в БД {fixed_sink.flushed}")
 
             # Сохраняем отладочные данные
             save_debug_json(processed_records, "processed_records")
-            
-            logger.info("Шаг 3: Загружаю обработанные диалоги обратно в БД")
-            upload_recognized_dialogs(processed_records, default_status='fixed')
-            logger.info("Диалоги успешно загружены в БД")
         except Exception as e:
             logger.error(f"Ошибка на шагах 1-3: {e}")
             continue
@@ -67,25 +90,43 @@ async def main(delay: int):
             # Сохраняем отладочные данные
             save_debug_json(fixed_records, "fixed_records")
 
-            logger.info("Шаг 5: Классифицирую диалоги")
-            classified_records = await classify_dialogs(
-                fixed_records,
-                max_concurrent_requests=500,
-                retry_delay=0.1,
-                max_retries=3
-            )
+            logger.info("Шаг 5: Дообучаю локальные модели категорий и классифицирую диалоги")
+            # Без записей к анализу модели не дообучаются: пустой список порталов означал бы все порталы.
+            # Обучение на NumPy выполняется в отдельном потоке, чтобы не блокировать event loop
+            if fixed_records:
+                try:
+                    trained = await asyncio.to_thread(update_category_models, list(fixed_records))
+                    logger.info(f"Локальные модели категорий дообучены на {trained} новых записях")
+                except Exception as e:
+                    logger.error(f"Ошибка при обучении локальных моделей категорий: {e}")
+            # Категории сохраняются в data сразу; при перезапуске классифицированные записи пропускаются
+            async with RecordSink(["data"], name="Классификация") as classified_sink:
+                classified_records = await classify_dialogs(
+                    fixed_records,
+                    max_concurrent_requests=500,
+                    retry_delay=0.1,
+                    max_retries=3,
+                    hedge=True,
+                    sink=classified_sink,
+                    packed=True
+                )
             logger.info(f"Классифицировано {len(classified_records)} диалогов")
 
             # Сохраняем отладочные данные
             save_debug_json(classified_records, "classified_records") 
 
             logger.info("Шаг 6: Провожу анализ диалогов согласно критериям")
-            analyzed_records = await analyze_criteria(
-                classified_records,
-                max_concurrent_requests=500,
-                retry_delay=0.1,
-                max_retries=3
-            )
+            # Результаты критериев сохраняются в data сразу; при перезапуске запрашиваются только недостающие
+            async with RecordSink(["data"], name="Анализ критериев") as analyzed_sink:
+                analyzed_records = await analyze_criteria(
+                    classified_records,
+                    max_concurrent_requests=500,
+                    retry_delay=0.1,
+                    max_retries=3,
+                    hedge=True,
+                    multi_criteria=True,
+                    sink=analyzed_sink
+                )
             logger.info(f"Проанализировано {len(analyzed_records)} диалогов")
         except Exception as e:
             logger.error(f"Ошибка на шагах 4-6: {e}")
@@ -115,7 +156,8 @@ async def main(delay: int):
                 max_text_size=1000,
                 max_concurrent_requests=500,
                 request_delay=0.1,
-                retries=3
+                retries=3,
+                defer=True
             )
             logger.info("Summary сущностей успешно агрегированы")
 
@@ -133,7 +175,58 @@ async def main(delay: int):
         except Exception as e:
             logger.error(f"Ошибка при загрузке данных в БД: {e}")
             continue
+
+        logger.info("Шаг 10: Выполняю отложенные задачи (в скидочное окно)")
+        try:
+            drained = await drain_deferred_aggregations(
+                max_text_size=1000,
+                max_concurrent_requests=500,
+                request_delay=0.1,
+                retries=3
+            )
+            logger.info(f"Выполнено отложенных агрегаций: {drained}")
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении отложенных задач: {e}")
+
+        logger.info("Шаг 11: Переанализ устаревших результатов критериев (в скидочное окно)")
+        try:
+            if should_run_now(REANALYSIS_STAGE):
+                queued = requeue_stale_results()
+                reanalyzed = await drain_reanalysis(
+                    max_records=500,
+                    max_concurrent_requests=500,
+                    retry_delay=0.1,
+                    max_retries=3
+                )
+                logger.info(f"Устаревших результатов в очереди: {queued}, переанализировано записей: {reanalyzed}")
+        except Exception as e:
+            logger.error(f"Ошибка при переанализе критериев: {e}")
         
+        cache_stats = get_cache_stats()
+        logger.info(
+            f"Кэш LLM: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+            f"объединено одновременных запросов {cache_stats['deduplicated']}"
+        )
+        for stage, stats in reset_hedge_budgets().items():
+            logger.info(
+                f"Хеджирование {stage}: запросов {stats['requests']}, дублей {stats['hedges']}, "
+                f"доп. расходы до ${stats['extra_cost']:.4f}"
+            )
+        for stage, stats in reset_stage_token_stats().items():
+            logger.info(
+                f"Токены стадии {stage}: запросов {stats['requests']}, вход {stats['input_tokens']}, "
+                f"из кэша {stats['cached_tokens']} (доля {stats['cache_hit_rate']}), выход {stats['output_tokens']}"
+            )
+        for portal, stats in reset_glossary_stats().items():
+            logger.info(
+                f"Локальные замены {portal}: диалогов {stats['dialogs']}, по словарю {stats['terms']}, "
+                f"числительных {stats['numbers']}"
+            )
+        for model, stats in get_estimate_stats().items():
+            logger.info(
+                f"Токены {model}: запросов {stats['requests']}, факт/оценка входа {stats['input_ratio']}, "
+                f"факт/прогноз выхода {stats['output_ratio']}"
+            )
         logger.info("Все шаги успешно выполнены! Ожидаю перед следующим циклом...")
         await asyncio.sleep(delay)
 
@@ -1,170 +1,242 @@
 import asyncio
-from typing import Any, Coroutine
+import inspect
+from bisect import bisect_left
 
-from classifier import assign_category
+from classifier import (assign_category, assign_categories_packed, build_category_messages, parse_category_response,
+                        CATEGORY_SCHEMA, STAGE)
+from llm_routing import get_route
+from category_model import predict_categories, LOCAL_SOURCE
+from llm_tokens import count_tokens
+from worker_pool import run_pool, retry_call
+from llm_batch import make_custom_id, submit_batch, collect_batch_results, get_pending_custom_ids, mark_batches_merged
 import json
 from logger_config import setup_logger
 
 # Настройка логгера для этого модуля
 logger = setup_logger('dialog_classifier', 'logs/dialog_classifier.log')
 
+# Бюджет контекста классификации: агрегированный summary сущности (см. entity_summary_aggregator)
+# и summary не больше CONTEXT_MAX_CALLS последних предыдущих звонков, всего не больше CONTEXT_MAX_TOKENS токенов
+CONTEXT_MAX_CALLS = 5
+CONTEXT_MAX_TOKENS = 1500
+
+# Пакетная классификация (packed=True): несколько коротких диалогов портала в одном запросе.
+# Диалог с контекстом длиннее PACK_ITEM_MAX_TOKENS классифицируется отдельно
+PACK_MAX_ITEMS = 8
+PACK_MAX_TOKENS = 4000
+PACK_ITEM_MAX_TOKENS = 1000
+
+
+def build_entity_index(entities: list, all_records: list) -> dict:
+    """
+    Строит индекс контекста сущностей группы за один проход (вызывается один раз на группу):
+      - "summaries": {entity_id: summary сущности};
+      - "history": {entity_id: (даты записей, summary записей)} — записи сущности с непустым summary,
+        отсортированные по дате, чтобы предыдущие звонки записи находились бинарным поиском.
+    """
+    summaries = {}
+    for entity in entities:
+        entity_id = entity.get("id")
+        if entity_id is not None and entity_id not in summaries and (entity.get("summary") or "").strip():
+            summaries[entity_id] = entity["summary"].strip()
+
+    history = {}
+    for record in all_records:
+        entity_id = record.get("entity_id")
+        record_summary = (record.get("summary") or "").strip()
+        if entity_id and record.get("date") and record_summary:
+            history.setdefault(entity_id, []).append((record["date"], record_summary))
+
+    for entity_id, entries in history.items():
+        entries.sort(key=lambda entry: entry[0])
+        history[entity_id] = ([date for date, _ in entries], [summary for _, summary in entries])
+
+    return {"summaries": summaries, "history": history}
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Обрезает текст по границе слова так, чтобы он занимал не больше max_tokens токенов.
+    """
+    while text and count_tokens(text) > max_tokens:
+        cut = int(len(text) * max_tokens / count_tokens(text) * 0.95)
+        text = text[:cut].rsplit(" ", 1)[0] if " " in text[:cut] else text[:cut]
+    return text
+
+
+def build_extended_summary(item: dict, entity_index: dict) -> str:
+    """
+    Формирует расширенный контекст для классификации записи по индексу build_entity_index
+    в пределах бюджета CONTEXT_MAX_TOKENS:
+      - агрегированный summary связанной сущности (если entity_id указан; обрезается до бюджета);
+      - summary не больше CONTEXT_MAX_CALLS последних предыдущих записей той же сущности
+        (в хронологическом порядке), пока они помещаются в оставшийся бюджет.
+    Размер контекста в токенах пишется в лог для подбора бюджета.
+    """
+    extended_summary = ""
+    entity_id = item.get("entity_id")
+    current_date = item.get("date")
+    
+    if entity_id:
+        # 1. Summary связанной сущности
+        entity_summary = entity_index["summaries"].get(entity_id, "")
+        
+        # 2. Записи той же сущности, которые старше текущей записи (бинарный поиск по датам)
+        related_summaries = []
+        if current_date and entity_id in entity_index["history"]:
+            dates, summaries = entity_index["history"][entity_id]
+            related_summaries = summaries[:bisect_left(dates, current_date)]
+        
+        # 3. Формируем итоговый расширенный summary в пределах бюджета токенов
+        summary_parts = []
+        budget = CONTEXT_MAX_TOKENS
+        
+        # Добавляем summary сущности (общий контекст)
+        if entity_summary:
+            entity_part = _truncate_to_tokens(f"Общий контекст: {entity_summary}", budget)
+            summary_parts.append(entity_part)
+            budget -= count_tokens(entity_part)
+        
+        # Добавляем summary последних звонков: от новых к старым, пока хватает бюджета
+        call_parts = []
+        first_call = max(len(related_summaries) - CONTEXT_MAX_CALLS, 0)
+        for i in range(len(related_summaries) - 1, first_call - 1, -1):
+            call_part = f"Звонок {i + 1}: {related_summaries[i]}"
+            call_tokens = count_tokens(call_part)
+            if call_tokens > budget:
+                break
+            call_parts.append(call_part)
+            budget -= call_tokens
+        # В контексте звонки идут в хронологическом порядке
+        summary_parts.extend(reversed(call_parts))
+        
+        # Объединяем все части
+        if summary_parts:
+            extended_summary = "\n".join(summary_parts)
+            logger.info(
+                f"Контекст классификации записи {item.get('id')}: {CONTEXT_MAX_TOKENS - budget} токенов, "
+                f"звонков {len(call_parts)} из {len(related_summaries)}"
+            )
+
+    return extended_summary
+
+
+def apply_selected_categories(item: dict, raw_selected: list, categories: list, criteria_definitions: list):
+    """
+    Приводит выбранные категории к [{id, name}, ...], собирает по ним критерии {id, name}
+    из criteria_definitions и сохраняет результат в item["data"].
+    """
+    # Приводим выбранные категории к [{id, name}, ...]
+    selected_categories = []
+    for sel in raw_selected:
+        if isinstance(sel, dict) and sel.get("id") is not None and sel.get("name"):
+            selected_categories.append({"id": sel["id"], "name": sel["name"]})
+            continue
+        # ищем по id или name в исходном списке
+        for cat in categories:
+            if sel == cat.get("id") or sel == cat.get("name") or (
+               isinstance(sel, dict) and sel.get("id") == cat.get("id")):
+                selected_categories.append({"id": cat["id"], "name": cat["name"]})
+                break
+
+    # Собираем id критериев из выбранных категорий
+    combined_criteria_ids = []
+    for cat in selected_categories:
+        for src_cat in categories:
+            if src_cat.get("id") == cat["id"]:
+                combined_criteria_ids.extend(src_cat.get("criteria", []))
+                break
+
+    unique_criteria_ids = list(set(combined_criteria_ids))
+
+    # Формируем список критериев {id, name}
+    criteria_details = []
+    for crit_id in unique_criteria_ids:
+        for crit in criteria_definitions:
+            if crit.get("id") == crit_id:
+                criteria_details.append({"id": crit_id, "name": crit.get("name")})
+                break
+
+    # Сохраняем результат
+    item["data"] = {
+        "categories": selected_categories,
+        "criteria": criteria_details
+    }
+
+
+def is_classified(item: dict) -> bool:
+    """
+    Возвращает True, если в item["data"] уже присутствуют непустые поля "categories" и "criteria".
+    """
+    data = item.get("data")
+    return isinstance(data, dict) and bool(data.get("categories")) and bool(data.get("criteria"))
+
 
 async def process_item(
     item: dict,
     categories: list,
     criteria_definitions: list,
-    entities: list,
-    all_records: list,
-    max_retries: int,
-    retry_delay: float,
-    semaphore: asyncio.Semaphore
-) -> bool | None:
+    entity_index: dict,
+    hedge: bool = False,
+    portal: str = None
+) -> bool:
     """
     Обрабатывает одну запись (item):
       1. Если в item["data"] уже присутствуют непустые поля "categories" и "criteria", пропускает обработку.
-      2. Извлекает диалог и формирует расширенный контекст:
+      2. Извлекает диалог и формирует расширенный контекст по индексу группы (см. build_extended_summary):
          - Ищет summary в связанной сущности (если entity_id указан)
          - Ищет summary из предыдущих записей той же сущности (по дате)
          - Объединяет в хронологическом порядке
-      3. Вызывает assign_category с диалогом и расширенным контекстом.
+      3. Если локальная модель категорий портала уверена в ответе (см. category_model.predict_categories),
+         использует её категории без запроса к LLM; иначе вызывает assign_category с диалогом
+         и расширенным контекстом (модель — по маршруту портала portal).
       4. Форматирует выбранные категории как список словарей {id, name}.
       5. Собирает все id критериев из выбранных категорий.
       6. Формирует итоговый список критериев {id, name} по данным из criteria_definitions.
       7. Сохраняет результат в item["data"].
-      Возвращает True при успешной обработке или выбрасывает исключение после исчерпания попыток.
+      Возвращает True при успешной обработке или выбрасывает исключение (повторы выполняет пул, см. classify_dialogs).
     """
     # Пропускаем уже обработанные записи
-    data = item.get("data")
-    if isinstance(data, dict) and data.get("categories") and data.get("criteria"):
+    if is_classified(item):
         logger.debug(f"Пропуск: у {item.get('id')} уже есть непустые data.categories и data.criteria.")
         return True
 
     dialogue = item.get("dialogue", "")
     
     logger.info(f"Обработка элемента id {item.get('id')}")
+
+    # Уверенные предсказания локальной модели не требуют запроса к LLM
+    local_categories = predict_categories(portal, item, categories)
+    if local_categories:
+        apply_selected_categories(item, local_categories, categories, criteria_definitions)
+        item["data"]["categories_source"] = LOCAL_SOURCE
+        logger.info(f"Элемент id {item.get('id')} классифицирован локальной моделью")
+        return True
     
     # Формируем расширенный контекст из summary сущности и предыдущих записей
-    extended_summary = ""
-    entity_id = item.get("entity_id")
-    current_date = item.get("date")
-    
-    if entity_id:
-        # 1. Ищем summary из связанной сущности
-        entity_summary = ""
-        for entity in entities:
-            if entity.get("id") == entity_id and entity.get("summary"):
-                entity_summary = entity["summary"].strip()
-                break
-        
-        # 2. Ищем все записи той же сущности, которые старше текущей записи
-        related_records = []
-        if current_date and all_records:
-            for record in all_records:
-                record_entity_id = record.get("entity_id")
-                record_date = record.get("date")
-                record_summary = record.get("summary", "")
-                
-                # Проверяем: та же сущность, более старая дата, есть summary
-                if (record_entity_id == entity_id and 
-                    record_date and current_date and
-                    record_date < current_date and 
-                    record_summary.strip()):
-                    related_records.append({
-                        "date": record_date,
-                        "summary": record_summary.strip()
-                    })
-            
-            # Сортируем по дате (старые -> новые)
-            related_records.sort(key=lambda x: x["date"])
-        
-        # 3. Формируем итоговый расширенный summary
-        summary_parts = []
-        
-        # Добавляем summary сущности (общий контекст)
-        if entity_summary:
-            summary_parts.append(f"Общий контекст: {entity_summary}")
-        
-        # Добавляем summary из предыдущих звонков в хронологическом порядке
-        if related_records:
-            for i, record in enumerate(related_records, 1):
-                summary_parts.append(f"Звонок {i}: {record['summary']}")
-        
-        # Объединяем все части
-        if summary_parts:
-            extended_summary = "\n".join(summary_parts)
-            logger.debug(f"Расширенный контекст для записи {item.get('id')}: найдено {len(related_records)} связанных записей")
+    extended_summary = build_extended_summary(item, entity_index)
 
-    for attempt in range(max_retries):
-        try:
-            async with semaphore:
-                result = await assign_category(dialogue, {"categories": categories}, extended_summary)
+    result = await assign_category(dialogue, {"categories": categories}, extended_summary, hedge=hedge,
+                                   portal=portal)
 
-            if not isinstance(result, dict) or "categories" not in result:
-                raise ValueError("Result from assign_category is not in the expected format.")
+    if not isinstance(result, dict) or "categories" not in result:
+        raise ValueError("Result from assign_category is not in the expected format.")
 
-            raw_selected = result["categories"]
+    apply_selected_categories(item, result["categories"], categories, criteria_definitions)
 
-            # Приводим выбранные категории к [{id, name}, ...]
-            selected_categories = []
-            for sel in raw_selected:
-                if isinstance(sel, dict) and sel.get("id") is not None and sel.get("name"):
-                    selected_categories.append({"id": sel["id"], "name": sel["name"]})
-                    continue
-                # ищем по id или name в исходном списке
-                for cat in categories:
-                    if sel == cat.get("id") or sel == cat.get("name") or (
-                       isinstance(sel, dict) and sel.get("id") == cat.get("id")):
-                        selected_categories.append({"id": cat["id"], "name": cat["name"]})
-                        break
-
-            # Собираем id критериев из выбранных категорий
-            combined_criteria_ids = []
-            for cat in selected_categories:
-                for src_cat in categories:
-                    if src_cat.get("id") == cat["id"]:
-                        combined_criteria_ids.extend(src_cat.get("criteria", []))
-                        break
-
-            unique_criteria_ids = list(set(combined_criteria_ids))
-
-            # Формируем список критериев {id, name}
-            criteria_details = []
-            for crit_id in unique_criteria_ids:
-                for crit in criteria_definitions:
-                    if crit.get("id") == crit_id:
-                        criteria_details.append({"id": crit_id, "name": crit.get("name")})
-                        break
-
-            # Сохраняем результат
-            item["data"] = {
-                "categories": selected_categories,
-                "criteria": criteria_details
-            }
-
-            logger.info(f"Элемент id {item.get('id')} обработан")
-            return True
-
-        except Exception as e:
-            if attempt < max_retries - 1:
-                logger.warning(
-                    f"Ошибка при обработке {item.get('id')}, попытка {attempt + 1}: {e}. "
-                    f"Повтор через {retry_delay}s."
-                )
-                await asyncio.sleep(retry_delay)
-            else:
-                logger.error(
-                    f"Элемент {item.get('id')} не обработан за {max_retries} попыток. Ошибка: {e}"
-                )
-                raise ValueError(
-                    f"Failed to process item after {max_retries} attempts. Last error: {e}"
-                ) from e
+    logger.info(f"Элемент id {item.get('id')} обработан")
+    return True
 
 
 async def classify_dialogs(
     data: dict,
     max_retries: int = 3,
     retry_delay: float = 2.0,
-    max_concurrent_requests: int = 5
+    max_concurrent_requests: int = 5,
+    use_batch: bool = False,
+    hedge: bool = False,
+    sink=None,
+    packed: bool = False
 ) -> dict:
     """
     Асинхронно обрабатывает все записи в словаре data.
@@ -172,10 +244,182 @@ async def classify_dialogs(
     data должно иметь структуру:
       { группа: { "records": [...], "categories": [...], "criteria": [...] }, ... }
 
-    Для каждого item в records вызывает process_item и возвращает обновлённый data.
+    Записи обрабатываются пулом из max_concurrent_requests обработчиков (см. worker_pool.run_pool):
+    для каждого item вызывается process_item, при ошибке — до max_retries попыток с нарастающей задержкой.
+    Возвращает обновлённый data.
+    При use_batch=True классификация выполняется через OpenAI Batch API (см. classify_dialogs_batch).
+    При packed=True короткие диалоги портала классифицируются по несколько за запрос (см. classify_dialogs_packed).
+    При hedge=True медленные запросы дублируются (см. llm_hedging).
+    sink — функция (portal, item), обычная или корутинная; вызывается сразу после успешной классификации записи.
     """
-    semaphore = asyncio.Semaphore(max_concurrent_requests)
-    tasks = []
+    if use_batch:
+        return await classify_dialogs_batch(data)
+    if packed:
+        return await classify_dialogs_packed(data, max_retries, retry_delay, max_concurrent_requests, hedge, sink)
+
+    def iter_items():
+        for key, group in data.items():
+            if not isinstance(group, dict):
+                continue
+            records = group.get("records", [])
+            # Индекс контекста сущностей строится один раз на группу
+            entity_index = build_entity_index(group.get("entities", []), records)
+            for item in records:
+                yield key, group, entity_index, item
+
+    async def classify_item(entry: tuple) -> bool:
+        key, group, entity_index, item = entry
+        return await process_item(
+            item,
+            group.get("categories", []),
+            group.get("criteria", []),
+            entity_index,
+            hedge,
+            key
+        )
+
+    async def on_done(entry: tuple, result, error):
+        key, _, _, item = entry
+        if error is not None:
+            logger.error(f"Элемент {item.get('id')} не обработан за {max_retries} попыток. Ошибка: {error}")
+        elif sink is not None:
+            outcome = sink(key, item)
+            if inspect.isawaitable(outcome):
+                await outcome
+
+    stats = await run_pool(iter_items(), classify_item, max_concurrent_requests, sink=on_done,
+                           retries=max_retries, retry_delay=retry_delay, name="Классификация")
+
+    logger.info(f"Итог: обработано всего: {stats['processed'] + stats['failed']}")
+    logger.info(f"Успешно: {stats['processed']}, Ошибок: {stats['failed']}")
+
+    return data
+
+
+def _iter_packs(data: dict):
+    """
+    Группирует неклассифицированные записи каждого портала в пакеты для classify_dialogs_packed:
+    не больше PACK_MAX_ITEMS записей и PACK_MAX_TOKENS токенов (диалог + контекст) в пакете.
+    Записи, которые классифицирует локальная модель, и длинные записи выдаются пакетами из одной записи.
+
+    :return: Генератор кортежей (портал, группа, индекс сущностей, [(запись, контекст), ...]).
+    """
+    for key, group in data.items():
+        if not isinstance(group, dict):
+            continue
+        records = group.get("records", [])
+        categories = group.get("categories", [])
+        entity_index = build_entity_index(group.get("entities", []), records)
+
+        pack, pack_tokens = [], 0
+        for item in records:
+            if is_classified(item):
+                continue
+            if predict_categories(key, item, categories):
+                yield key, group, entity_index, [(item, None)]
+                continue
+
+            context = build_extended_summary(item, entity_index)
+            tokens = count_tokens(item.get("dialogue") or "") + count_tokens(context)
+            if tokens > PACK_ITEM_MAX_TOKENS:
+                yield key, group, entity_index, [(item, context)]
+                continue
+            if pack and (len(pack) >= PACK_MAX_ITEMS or pack_tokens + tokens > PACK_MAX_TOKENS):
+                yield key, group, entity_index, pack
+                pack, pack_tokens = [], 0
+            pack.append((item, context))
+            pack_tokens += tokens
+        if pack:
+            yield key, group, entity_index, pack
+
+
+async def classify_dialogs_packed(
+    data: dict,
+    max_retries: int = 3,
+    retry_delay: float = 2.0,
+    max_concurrent_requests: int = 5,
+    hedge: bool = False,
+    sink=None
+) -> dict:
+    """
+    Вариант classify_dialogs, который классифицирует короткие диалоги портала пакетами (см. _iter_packs):
+    один запрос с общим списком категорий и ответом по id каждого диалога (assign_categories_packed).
+    Записи, ответа по которым нет в пакетном ответе (или если пакетный запрос не удался),
+    классифицируются по одной через process_item с до max_retries попытками.
+    """
+    counters = {"packed": 0, "single": 0, "failed": 0}
+
+    async def classify_single(key: str, group: dict, entity_index: dict, item: dict):
+        await retry_call(process_item, item, group.get("categories", []), group.get("criteria", []), entity_index,
+                         hedge, key, retries=max_retries, retry_delay=retry_delay,
+                         description=f"Классификация {item.get('id')}")
+
+    async def classify_pack(unit: tuple) -> list:
+        key, group, entity_index, entries = unit
+        categories = group.get("categories", [])
+        results = {}
+        if len(entries) > 1:
+            try:
+                results = await assign_categories_packed(
+                    [{"id": str(index), "text": item.get("dialogue", ""), "summary": context}
+                     for index, (item, context) in enumerate(entries)],
+                    {"categories": categories}, hedge=hedge, portal=key
+                )
+            except Exception as e:
+                logger.warning(f"Пакетная классификация {len(entries)} записей не удалась, классифицирую по одной: {e}")
+
+        errors = []
+        for index, (item, _) in enumerate(entries):
+            if str(index) in results:
+                apply_selected_categories(item, results[str(index)], categories, group.get("criteria", []))
+                counters["packed"] += 1
+                errors.append(None)
+                continue
+            try:
+                await classify_single(key, group, entity_index, item)
+                counters["single"] += 1
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    async def on_done(unit: tuple, errors: list | None, error: Exception | None):
+        key, _, _, entries = unit
+        for (item, _), item_error in zip(entries, errors or [error] * len(entries)):
+            if item_error is not None:
+                counters["failed"] += 1
+                logger.error(f"Элемент {item.get('id')} не обработан за {max_retries} попыток. Ошибка: {item_error}")
+            elif sink is not None:
+                outcome = sink(key, item)
+                if inspect.isawaitable(outcome):
+                    await outcome
+
+    await run_pool(_iter_packs(data), classify_pack, max_concurrent_requests, sink=on_done,
+                   name="Пакетная классификация")
+
+    logger.info(
+        f"Итог: в пакетах {counters['packed']}, по одной {counters['single']}, ошибок {counters['failed']}"
+    )
+    return data
+
+
+async def classify_dialogs_batch(data: dict) -> dict:
+    """
+    Вариант classify_dialogs для несрочной обработки через OpenAI Batch API (в 2 раза дешевле).
+
+    За один вызов (один цикл сервиса):
+      1. Забирает ответы завершившихся батчей стадии "classification" и заполняет item["data"]
+         (custom_id = classification|группа|id записи).
+      2. Записи, которые ещё выполняются в незавершённых батчах, оставляет без data —
+         они остаются в статусе fixed и будут подобраны в следующем цикле.
+      3. Для остальных неклассифицированных записей формирует запросы и отправляет новый батч.
+    """
+    results, merged_batch_ids = await collect_batch_results("classification")
+    pending = get_pending_custom_ids("classification")
+    requests = []
+    applied = 0
+    # custom_id ответов, обработанных в этом цикле: только они удаляются из llm_batch_results
+    consumed = set()
 
     for key, group in data.items():
         if not isinstance(group, dict):
@@ -184,30 +428,45 @@ async def classify_dialogs(
         records = group.get("records", [])
         group_categories = group.get("categories", [])
         group_criteria = group.get("criteria", [])
-        group_entities = group.get("entities", [])
+        entity_index = build_entity_index(group.get("entities", []), records)
 
         for item in records:
-            task = asyncio.create_task(
-                process_item(
-                    item,
-                    group_categories,
-                    group_criteria,
-                    group_entities,
-                    records,  # Передаем все записи группы для поиска связанных записей
-                    max_retries,
-                    retry_delay,
-                    semaphore
-                )
-            )
-            tasks.append(task)
+            custom_id = make_custom_id("classification", key, item.get("id"))
+            if custom_id in results:
+                consumed.add(custom_id)
+            if is_classified(item):
+                continue
+
+            if custom_id in results:
+                try:
+                    raw_selected = parse_category_response(results[custom_id]["content"], {"categories": group_categories})
+                    apply_selected_categories(item, raw_selected, group_categories, group_criteria)
+                    applied += 1
+                except Exception as e:
+                    # Запись будет отправлена в новый батч в следующем цикле
+                    logger.warning(f"Ответ батча для {item.get('id')} не разобран: {e}")
+            elif custom_id not in pending:
+                local_categories = predict_categories(key, item, group_categories)
+                if local_categories:
+                    apply_selected_categories(item, local_categories, group_categories, group_criteria)
+                    item["data"]["categories_source"] = LOCAL_SOURCE
+                    applied += 1
+                    continue
+                extended_summary = build_extended_summary(item, entity_index)
+                route = get_route(STAGE, portal=key)
+                requests.append({
+                    "custom_id": custom_id,
+                    "model": route["model"],
+                    "params": route["params"],
+                    "messages": build_category_messages(item.get("dialogue", ""), {"categories": group_categories},
+                                                        extended_summary),
+                    "response_format": CATEGORY_SCHEMA
+                })
 
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    total = len(results)
-    error_count = sum(1 for r in results if isinstance(r, Exception))
-    success_count = total - error_count
+    logger.info(f"Батч классификации: применено {applied} ответов, ожидается {len(pending)}, к отправке {len(requests)}")
 
-    logger.info(f"Итог: обработано всего: {total}")
-    logger.info(f"Успешно: {success_count}, Ошибок: {error_count}")
+    await submit_batch("classification", requests)
+    mark_batches_merged(merged_batch_ids, consumed)
 
     return data
 
@@ -0,0 +1,120 @@
+import re
+from difflib import SequenceMatcher
+from dialog_windows import SPEAKER_LABEL_RE
+from dialog_glossary import normalize_numbers
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('dialog_edits', 'logs/dialog_edits.log')
+
+_WORD_RE = re.compile(r"\w+")
+
+# Слова продиктованного адреса сайта или почты: такой фрагмент можно свернуть в латиницу («гугл точка ру» -> google.ru)
+ADDRESS_WORDS = {"точка", "собака", "дот", "слэш", "слеш"}
+
+
+def _words(text: str) -> list[str]:
+    return _WORD_RE.findall(text.lower().replace("ё", "е"))
+
+
+def _label(line: str) -> str:
+    match = SPEAKER_LABEL_RE.match(line)
+    return match.group(1) if match else ""
+
+
+def number_lines(text: str) -> str:
+    """
+    Нумерует строки диалога для запроса правок: "1| К: текст". Номера строк — ссылки в правках (см. apply_edits).
+    """
+    return "\n".join(f"{number}| {line}" for number, line in enumerate(text.split("\n"), start=1))
+
+
+def _check_edit(original: str, replacement: str):
+    """
+    Проверяет одну правку: она не должна разбивать строку и добавлять метку спикера.
+    Слова проверяются по строке целиком (см. _check_words).
+    """
+    if "\n" in replacement:
+        raise ValueError(f"Правка разбивает строку: {original!r} -> {replacement!r}")
+    if SPEAKER_LABEL_RE.match(replacement) and not SPEAKER_LABEL_RE.match(original):
+        raise ValueError(f"Правка добавляет метку спикера: {replacement!r}")
+
+
+def _allowed_merge(source: list[str], target: list[str], allowed: dict) -> bool:
+    """
+    Разрешено ли заменить слова source на другое число слов target: замена из словаря allowed
+    ({фраза: замена}, см. dialog_glossary) или продиктованный адрес, записанный латиницей.
+    """
+    source_phrase = " ".join(source)
+    if source_phrase in allowed and _words(allowed[source_phrase]) == target:
+        return True
+    return bool(ADDRESS_WORDS & set(source)) and all(word.isascii() for word in target)
+
+
+def _check_words(line: str, new_line: str, allowed: dict):
+    """
+    Сравнивает последовательности слов строки до и после правок: слова можно только заменять один к одному
+    (исправление написания). Пропуск и добавление слов запрещены, а слияние нескольких слов в другое число слов
+    допускается только по _allowed_merge. Числительные в обеих строках предварительно переводятся в цифры,
+    чтобы «восемьсот шестьдесят три» -> «863» не считалось пропуском слов. Так ловятся правки, выбрасывающие
+    часть фрагмента («посев сайта» -> «SEO») или переставляющие слова.
+    """
+    source, target = _words(normalize_numbers(line)[0]), _words(normalize_numbers(new_line)[0])
+    matcher = SequenceMatcher(None, source, target, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal" or (tag == "replace" and i2 - i1 == j2 - j1):
+            continue
+        if tag == "replace" and _allowed_merge(source[i1:i2], target[j1:j2], allowed):
+            continue
+        raise ValueError(f"Правки меняют слова строки: {' '.join(source[i1:i2])!r} -> {' '.join(target[j1:j2])!r}")
+
+
+def apply_edits(text: str, edits: list, allowed: dict = None) -> tuple[str, int]:
+    """
+    Восстанавливает исправленный диалог из списка правок модели [{"line", "original", "replacement"}, ...].
+
+    Фрагмент original ищется в своей строке после конца предыдущей правки той же строки, поэтому
+    не затронутый правками текст остаётся в исходном порядке. После применения проверяется, что число строк
+    и метки спикеров не изменились, а слова каждой изменённой строки не пропущены, не добавлены
+    и не переставлены (см. _check_words; allowed — разрешённые замены фраз, например словарь портала).
+    Любое нарушение — ValueError (исправление повторяется целым текстом).
+
+    :return: Кортеж (исправленный текст, число применённых правок).
+    """
+    lines = text.split("\n")
+    # Правки группируются по строкам с сохранением порядка внутри строки
+    by_line = {}
+    for edit in edits:
+        try:
+            number = int(edit["line"])
+            original, replacement = str(edit["original"]), str(edit["replacement"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Некорректная правка {edit!r}: {e}")
+        if not 1 <= number <= len(lines):
+            raise ValueError(f"Правка ссылается на строку {number} из {len(lines)}")
+        if not original or original == replacement:
+            continue
+        _check_edit(original, replacement)
+        by_line.setdefault(number - 1, []).append((original, replacement))
+
+    applied = 0
+    for index, line_edits in by_line.items():
+        line = lines[index]
+        parts = []
+        cursor = 0
+        for original, replacement in line_edits:
+            position = line.find(original, cursor)
+            if position < 0:
+                raise ValueError(f"Фрагмент {original!r} не найден в строке {index + 1} после позиции {cursor}")
+            parts.append(line[cursor:position])
+            parts.append(replacement)
+            cursor = position + len(original)
+            applied += 1
+        parts.append(line[cursor:])
+        new_line = "".join(parts)
+        if _label(new_line) != _label(line):
+            raise ValueError(f"Правки строки {index + 1} меняют метку спикера")
+        _check_words(line, new_line, allowed or {})
+        lines[index] = new_line
+
+    return "\n".join(lines), applied
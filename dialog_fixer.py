@@ -1,9 +1,25 @@
 import asyncio
-import json
-from llm_router import llm_request
+from llm_routing import route_request
+from classifier import PROMPT3, PROMPT4, _categories_json, parse_category_response, validate_category_answer
+from llm_tokens import count_tokens, ContextWindowExceeded
+from dialog_windows import split_dialogue, merge_windows
+from dialog_edits import number_lines, apply_edits
+from dialog_glossary import apply_glossary, record_pair, load_glossary
+from logger_config import setup_logger
 
+# Настройка логгера для этого модуля
+logger = setup_logger('dialog_fixer', 'logs/dialog_fixer.log')
 
-PROMPT = """
+
+# Правила резюме: общие для исправления и для объединения резюме частей длинного диалога (SUMMARY_MERGE_PROMPT)
+SUMMARY_RULES = """В резюме спикеров указывай как менеджер и клиент.
+В резюме не используй ничего не значащие обороты, типа на настоящий момент, в настоящее время и прочее. 
+В резюме не ставь переносы строк.
+В резюме сокращай слова и словосочетания в тексте по общепринятым стандартам сокращений. 
+В резюме используй официальные правила сокращений, принятые в русском языке.
+"""
+
+FIX_INSTRUCTIONS = f"""
 Ты профессиональный аналитик и редактор сырых диалогов. Проанализируй диалог менеджера (помечен буквой М) с клиентом (помечен буквой К). 
 Определи тематику разговора. Исправь слова в диалоге на их правильное написание согласно тематике если они не подходят 
 по контексту всего диалога, например: 
@@ -23,12 +39,9 @@ PROMPT = """
 - изменить строчные буквы на заглавные в начале предложений;
 - в конце каждой фразы добавить символ переноса строки;
 Также составь краткое резюме разговора. Сформулируй резюме максимально кратко, но при этом понятно, отрази основные моменты.
-В резюме спикеров указывай как менеджер и клиент.
-В резюме не используй ничего не значащие обороты, типа на настоящий момент, в настоящее время и прочее. 
-В резюме не ставь переносы строк.
-В резюме сокращай слова и словосочетания в тексте по общепринятым стандартам сокращений. 
-В резюме используй официальные правила сокращений, принятые в русском языке.
-Ответ выдай строго в виде словаря следующего синтаксиса (без доп символов и кавычек, синтаксис словаря должен быть с 
+{SUMMARY_RULES}"""
+
+PROMPT_FORMAT = """Ответ выдай строго в виде словаря следующего синтаксиса (без доп символов и кавычек, синтаксис словаря должен быть с 
 таким же набором фигурных скобок и двойных кавычек, обрамлять словарь в доп символы запрещено):
 {"text": "исправленный текст полностью",
 "summary": "резюме разговора"}
@@ -36,14 +49,305 @@ PROMPT = """
 Текст диалога:
 """
 
+PROMPT = f"{FIX_INSTRUCTIONS}{PROMPT_FORMAT}"
+
+# Совмещённый запрос (исправление + классификация, см. fix_dialog с categories): после инструкций исправления
+# идут категории портала (как в classifier.build_category_messages) и формат ответа с категориями
+CATEGORIES_PROMPT = """
+Также определи, к каким из категорий принадлежит диалог. Категории указывай точно так, как они названы в списке.
+"""
+
+# Режим правок (см. fix_dialog с edit_mode): вместо всего текста модель возвращает только изменённые фрагменты
+EDIT_PROMPT = """
+Исправленный текст целиком не выводи. Строки диалога пронумерованы в виде "номер| строка". Верни только правки:
+для каждой правки — номер строки (line), исходный фрагмент строки точно как в тексте (original) и исправленный
+фрагмент (replacement). Фрагмент должен быть минимальным: одно или несколько подряд идущих слов, которые меняются,
+вместе с добавленными знаками препинания и заглавными буквами. Правки одной строки перечисляй в порядке следования
+фрагментов, фрагменты не должны пересекаться. Номера строк и метки спикеров в фрагменты не включай,
+строки не объединяй и не разбивай.
+"""
+
+# Объединение резюме частей длинного диалога (см. _merge_summaries): каждое резюме части составлено так,
+# будто часть — весь разговор, поэтому простая склейка даёт несколько пересекающихся резюме
+SUMMARY_MERGE_PROMPT = f"""
+Ниже резюме последовательных частей одного телефонного разговора менеджера с клиентом (части идут по порядку
+и могут пересекаться). Составь одно краткое резюме всего разговора: объедини повторы, сохрани основные моменты
+и итог разговора. Сформулируй резюме максимально кратко, но при этом понятно.
+{SUMMARY_RULES}Ответ выдай строго в виде словаря следующего синтаксиса:
+{{"summary": "резюме разговора"}}
+Кроме словаря вставлять что-то в ответ запрещено.
+"""
+
+SUMMARY_SCHEMA = {
+    "name": "dialog_summary",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"}
+        },
+        "required": ["summary"],
+        "additionalProperties": False
+    }
+}
+
+# Поля ответа: описание для промпта и JSON-схема
+ANSWER_FIELDS = {
+    "text": '"text": "исправленный текст полностью"',
+    "edits": '"edits": [{"line": номер строки, "original": "исходный фрагмент", "replacement": "исправленный фрагмент"}]',
+    "summary": '"summary": "резюме разговора"',
+    "categories": '"categories": ["Категория 1", "Категория 2"]'
+}
+FIELD_SCHEMAS = {
+    "text": {"type": "string"},
+    "edits": {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "line": {"type": "integer"},
+                "original": {"type": "string"},
+                "replacement": {"type": "string"}
+            },
+            "required": ["line", "original", "replacement"],
+            "additionalProperties": False
+        }
+    },
+    "summary": {"type": "string"},
+    "categories": {"type": "array", "items": {"type": "string"}}
+}
+
+# Схема ответа для структурированного вывода (см. llm_router.allm_request)
+FIX_DIALOG_SCHEMA = {
+    "name": "fixed_dialog",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "text": {"type": "string"},
+            "summary": {"type": "string"}
+        },
+        "required": ["text", "summary"],
+        "additionalProperties": False
+    }
+}
+
+
+# Стадия анализа: модель исправления выбирается по таблице маршрутов (см. llm_routing)
+STAGE = "dialog_fix"
+
+# Прогноз размера ответа: исправленный текст чуть длиннее исходного (пунктуация) + резюме
+OUTPUT_TOKENS_RATIO = 1.2
+SUMMARY_TOKENS = 500
+# Исправленный текст короче этой доли исходного считается обрезанным (слова удалять запрещено)
+MIN_LENGTH_RATIO = 0.7
+
+# Длинные диалоги исправляются окнами параллельно: время ответа растёт с длиной выходного текста
+LONG_DIALOGUE_TOKENS = 4000
+WINDOW_TOKENS = 3000
+WINDOW_OVERLAP_TOKENS = 200
+
+# Совмещённый запрос используется, только если категории портала в промпте занимают не больше стольких токенов:
+# иначе длинный список категорий удорожает каждый запрос исправления сильнее, чем экономит отдельная классификация
+FUSED_MAX_CATEGORY_TOKENS = 2000
+# Прогноз размера списка категорий в ответе
+CATEGORIES_OUTPUT_TOKENS = 50
+# Прогноз размера ответа в режиме правок: доля токенов исходного текста (пунктуация меняется почти в каждой строке)
+EDIT_OUTPUT_TOKENS_RATIO = 0.5
 
-async def fix_dialog(dialog_text: str) -> dict:
+
+def _answer_fields(categories: dict = None, edit_mode: bool = False) -> list[str]:
+    return ["edits" if edit_mode else "text", "summary"] + (["categories"] if categories else [])
+
+
+def _answer_prompt(fields: list[str]) -> str:
     """
-    Асинхронная функция для анализа диалога с помощью chatgpt_request
-    :param dialog_text: Текст диалога с метками 0: и 1:
-    :return: Ответ от chatgpt_request в виде словаря с исправленным текстом и резюме
+    Формат ответа для промпта с полями fields (см. ANSWER_FIELDS).
+    """
+    answer = ",\n".join(ANSWER_FIELDS[field] for field in fields)
+    return (
+        "Ответ выдай строго в виде словаря следующего синтаксиса:\n"
+        f"{{{answer}}}\n"
+        "Кроме словаря вставлять что-то в ответ запрещено.\n"
+        "Текст диалога:\n"
+    )
+
+
+def _answer_schema(fields: list[str]) -> dict:
+    """
+    Схема структурированного ответа с полями fields (см. FIELD_SCHEMAS).
+    """
+    if fields == ["text", "summary"]:
+        return FIX_DIALOG_SCHEMA
+    return {
+        "name": "fixed_dialog_" + "_".join(field for field in fields if field != "summary"),
+        "schema": {
+            "type": "object",
+            "properties": {field: FIELD_SCHEMAS[field] for field in fields},
+            "required": fields,
+            "additionalProperties": False
+        }
+    }
+
+
+def _parse_fix_response(response: dict, source_text: str, edit_mode: bool = False, allowed: dict = None) -> dict:
+    """
+    Извлекает исправленный текст и резюме из ответа по схеме {"text": "...", "summary": "..."}
+    (в режиме правок текст восстанавливается из "edits", см. dialog_edits.apply_edits; allowed — разрешённые
+    замены фраз).
+    Выбрасывает ValueError, если правки не прошли проверку, текст заметно короче исходного или резюме пустое
+    (непрошедший проверку ответ повторяется на premium-модели, правки — целым текстом).
+    """
+    response_data = response["parsed"]
+    if edit_mode:
+        text, applied = apply_edits(source_text, response_data.get("edits") or [], allowed)
+        logger.debug(f"Диалог восстановлен из {applied} правок")
+    else:
+        text = response_data.get("text") or ""
+    if len(text) < len(source_text) * MIN_LENGTH_RATIO:
+        raise ValueError(f"Исправленный текст короче исходного: {len(text)} из {len(source_text)} символов")
+    if not (response_data.get("summary") or "").strip():
+        raise ValueError("Пустое резюме")
+    return {"content": text, "summary": response_data["summary"], "cost": response["cost"]}
+
+
+def build_fix_messages(preprocessed_text: str, categories: dict = None, context: str = None,
+                       edit_mode: bool = False) -> list:
+    """
+    Формирует запрос исправления. Без categories и edit_mode — PROMPT и диалог. Иначе:
+      - system: инструкции исправления + EDIT_PROMPT (режим правок) + PROMPT4, JSON категорий и CATEGORIES_PROMPT
+        (совмещённая классификация) + формат ответа — стабильный префикс портала;
+      - user: введение (контекст сущности, если есть) и диалог (в режиме правок — с номерами строк).
+    """
+    if not categories and not edit_mode:
+        return [
+            # Инструкции — стабильный префикс (кэшируется провайдером), диалог — переменная часть
+            {"role": "system", "content": PROMPT},
+            {"role": "user", "content": preprocessed_text}
+        ]
+
+    instructions = FIX_INSTRUCTIONS
+    if edit_mode:
+        instructions += EDIT_PROMPT
+    if categories:
+        instructions += f"{PROMPT4}\n{_categories_json(categories)}{CATEGORIES_PROMPT}"
+    instructions += _answer_prompt(_answer_fields(categories, edit_mode))
+
+    user_content = number_lines(preprocessed_text) if edit_mode else preprocessed_text
+    if categories and context and context.strip():
+        user_content = f"{PROMPT3}\n{context.strip()}\n\n{user_content}"
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": user_content}
+    ]
+
+
+def fits_fused_budget(categories: dict) -> bool:
+    """
+    Возвращает True, если категории портала помещаются в бюджет совмещённого запроса FUSED_MAX_CATEGORY_TOKENS.
+    """
+    return bool(categories.get("categories")) and \
+        count_tokens(_categories_json(categories)) <= FUSED_MAX_CATEGORY_TOKENS
+
+
+async def _fix_text(preprocessed_text: str, portal: str = None, categories: dict = None, context: str = None,
+                    edit_mode: bool = False) -> dict:
+    """
+    Исправляет текст диалога (с метками К:/М:) одним запросом к модели из таблицы маршрутов портала portal.
+    Если переданы categories, тот же запрос выбирает категории диалога (см. build_fix_messages):
+    в результат добавляется поле "categories" — [{"id", "name"}, ...].
+    При edit_mode модель возвращает только правки, текст восстанавливается локально (dialog_edits.apply_edits);
+    если правки не прошли проверку, диалог исправляется повторно целым текстом (без повтора правок на premium).
+    Если диалог вместе с ожидаемым ответом не помещается в окно модели (ContextWindowExceeded),
+    делит его пополам по границе реплик и исправляет части по отдельности (уже без категорий),
+    резюме частей объединяются в одно (_merge_summaries).
+    """
+    input_tokens = count_tokens(preprocessed_text)
+    ratio = EDIT_OUTPUT_TOKENS_RATIO if edit_mode else OUTPUT_TOKENS_RATIO
+    expected_output_tokens = int(input_tokens * ratio) + SUMMARY_TOKENS
+    if categories:
+        expected_output_tokens += CATEGORIES_OUTPUT_TOKENS
+
+    # В правках можно сливать слова только по словарю замен портала (и в числа/адреса, см. apply_edits)
+    allowed = load_glossary(portal)[0] if edit_mode and portal else None
+
+    def parse(response: dict) -> dict:
+        # Неизвестные категории — такая же причина повторить запрос на premium-модели, как и обрезанный текст
+        if categories:
+            validate_category_answer(response["parsed"], categories)
+        result = _parse_fix_response(response, preprocessed_text, edit_mode, allowed)
+        if categories:
+            result["categories"] = parse_category_response(response["parsed"], categories)
+        return result
+
+    try:
+        result, _ = await route_request(
+            STAGE,
+            build_fix_messages(preprocessed_text, categories, context, edit_mode),
+            parse,
+            portal=portal,
+            response_format=_answer_schema(_answer_fields(categories, edit_mode)),
+            expected_output_tokens=expected_output_tokens,
+            escalate=not edit_mode
+        )
+    except ContextWindowExceeded as e:
+        lines = preprocessed_text.split("\n")
+        if len(lines) < 2:
+            raise
+        middle = len(lines) // 2
+        logger.info(f"Диалог не помещается в окно ({e}), делю на части по {middle} и {len(lines) - middle} реплик")
+        first = await _fix_text("\n".join(lines[:middle]), portal, edit_mode=edit_mode)
+        second = await _fix_text("\n".join(lines[middle:]), portal, edit_mode=edit_mode)
+        summary, summary_cost = await _merge_summaries([first["summary"], second["summary"]], portal)
+        return {
+            "content": f"{first['content'].rstrip()}\n{second['content'].lstrip()}",
+            "summary": summary,
+            "cost": first["cost"] + second["cost"] + summary_cost
+        }
+    except ValueError as e:
+        if not edit_mode:
+            raise
+        logger.warning(f"Правки не прошли проверку ({e}), исправляю диалог целым текстом")
+        return await _fix_text(preprocessed_text, portal, categories, context)
+
+    return result
+
+
+async def _merge_summaries(summaries: list[str], portal: str = None) -> tuple[str, float]:
+    """
+    Объединяет резюме частей длинного диалога в одно резюме всего разговора одним коротким запросом
+    (SUMMARY_MERGE_PROMPT). Если запрос не удался, резюме частей склеиваются по порядку.
+
+    :return: Кортеж (резюме, стоимость запроса).
+    """
+    summaries = [summary.strip() for summary in summaries if summary and summary.strip()]
+    if len(summaries) <= 1:
+        return (summaries[0] if summaries else ""), 0
+
+    def parse(response: dict) -> dict:
+        summary = (response["parsed"].get("summary") or "").strip()
+        if not summary:
+            raise ValueError("Пустое резюме")
+        return {"summary": summary, "cost": response["cost"]}
+
+    blocks = "\n".join(f"Часть {number}: {summary}" for number, summary in enumerate(summaries, start=1))
+    try:
+        result, _ = await route_request(
+            STAGE,
+            [{"role": "system", "content": SUMMARY_MERGE_PROMPT}, {"role": "user", "content": blocks}],
+            parse,
+            portal=portal,
+            response_format=SUMMARY_SCHEMA,
+            expected_output_tokens=SUMMARY_TOKENS
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось объединить резюме {len(summaries)} частей ({e}), склеиваю их по порядку")
+        return " ".join(summaries), 0
+    return result["summary"], result["cost"]
+
+
+def relabel_speakers(dialog_text: str) -> str:
+    """
+    Заменяет метки спикеров распознавания 0: и 1: на К: (клиент) и М: (менеджер).
     """
-    # Заменяем метки 0: и 1: на К: и М: перед отправкой в LLM
     preprocessed_dialog = []
     for line in dialog_text.split("\n"):
         if line.strip().startswith("0:"):
@@ -57,32 +361,59 @@ async def fix_dialog(dialog_text: str) -> dict:
         preprocessed_dialog.append(new_line)
     
     # Объединяем препроцессированный диалог
-    preprocessed_text = "\n".join(preprocessed_dialog)
-    combined_text = f"{PROMPT}\n\n{preprocessed_text}"
-
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(
-        None,
-        llm_request,
-        'gpt-4o',
-        [
-            {"role": "user", "content": combined_text}
-        ]
-    )
+    return "\n".join(preprocessed_dialog)
 
-    # Разбираем JSON-ответ (теперь {"text": "...", "summary": "..."})
-    response_data = json.loads(response["content"])
-    fixed_text = response_data["text"]
-    summary = response_data["summary"]
-    cost = response["cost"]
 
+async def _fix_long_text(preprocessed_text: str, portal: str = None, edit_mode: bool = False) -> dict:
+    """
+    Исправляет длинный диалог окнами (см. dialog_windows.split_dialogue): окна по WINDOW_TOKENS токенов
+    с перекрытием WINDOW_OVERLAP_TOKENS исправляются параллельно, исправленные тексты сшиваются
+    без повтора реплик на стыках, резюме окон объединяются в одно резюме разговора (_merge_summaries).
+    """
+    windows = split_dialogue(preprocessed_text, WINDOW_TOKENS, WINDOW_OVERLAP_TOKENS)
+    logger.info(f"Длинный диалог: исправляю {len(windows)} окон параллельно")
+    results = await asyncio.gather(*(_fix_text(window["text"], portal, edit_mode=edit_mode) for window in windows))
+    summary, summary_cost = await _merge_summaries([result["summary"] for result in results], portal)
     return {
-        "content": fixed_text,
+        "content": merge_windows(windows, [result["content"] for result in results]),
         "summary": summary,
-        "cost": cost
+        "cost": sum(result["cost"] for result in results) + summary_cost
     }
 
 
+async def fix_dialog(dialog_text: str, portal: str = None, categories: dict = None, context: str = None,
+                     edit_mode: bool = False) -> dict:
+    """
+    Асинхронная функция для анализа диалога с помощью chatgpt_request
+    :param dialog_text: Текст диалога с метками 0: и 1:
+    :param portal: Портал, маршрут которого используется (см. llm_routing).
+    :param categories: Категории портала {"categories": [...]}. Если переданы и помещаются в бюджет
+                       FUSED_MAX_CATEGORY_TOKENS, категории диалога выбираются тем же запросом (поле "categories"
+                       результата); длинные диалоги исправляются окнами и классифицируются отдельно.
+    :param context: Контекст для классификации (например, summary сущности), используется вместе с categories.
+    :param edit_mode: Запрашивать только правки вместо всего текста (меньше выходных токенов, см. _fix_text).
+    :return: Ответ от chatgpt_request в виде словаря с исправленным текстом и резюме
+    """
+    # Заменяем метки 0: и 1: на К: и М: перед отправкой в LLM
+    relabeled_text = relabel_speakers(dialog_text)
+    # Известные замены портала и числительные исправляются локально (см. dialog_glossary)
+    preprocessed_text, substitutions = apply_glossary(relabeled_text, portal)
+    if substitutions["terms"] or substitutions["numbers"]:
+        logger.debug(f"Локальные замены: по словарю {substitutions['terms']}, числительных {substitutions['numbers']}")
+
+    # Диалоги длиннее LONG_DIALOGUE_TOKENS исправляются окнами параллельно
+    if count_tokens(preprocessed_text) > LONG_DIALOGUE_TOKENS:
+        result = await _fix_long_text(preprocessed_text, portal, edit_mode)
+    elif categories and fits_fused_budget(categories):
+        result = await _fix_text(preprocessed_text, portal, categories, context, edit_mode)
+    else:
+        result = await _fix_text(preprocessed_text, portal, edit_mode=edit_mode)
+
+    # Пара «распознанный / исправленный текст» — материал для словаря замен портала
+    record_pair(portal, relabeled_text, result["content"])
+    return result
+
+
 # Пример вызова функции
 if __name__ == "__main__":
     sample_dialog = """
@@ -1,5 +1,9 @@
 import asyncio
-from dialog_fixer import fix_dialog
+import inspect
+from dialog_fixer import fix_dialog, relabel_speakers
+from category_model import predict_categories, LOCAL_SOURCE
+from dialog_classifier import apply_selected_categories, build_entity_index, build_extended_summary
+from worker_pool import run_pool
 import json
 from logger_config import setup_logger
 
@@ -7,56 +11,14 @@ from logger_config import setup_logger
 logger = setup_logger('dialog_fixer_all', 'logs/dialog_fixer_all.log')
 
 
-async def safe_analyze_dialog(dialog_text, dialog_id=None, retries=3, delay=2) -> dict | None:
-    """
-    Безопасный вызов fix_dialog с повторными попытками при ошибках.
-
-    :param dialog_text: Текст диалога для анализа.
-    :param retries: Количество повторных попыток при ошибках (по умолчанию 3).
-    :param delay: Задержка между повторными попытками в секундах (по умолчанию 2).
-    :return: Результат анализа диалога или None, если все попытки не удались.
-    """
-    for attempt in range(retries):
-        try:
-            result = await fix_dialog(dialog_text)
-
-            return result
-        except Exception as e:
-            logger.warning(f"Ошибка в попытке {attempt + 1} для диалога {dialog_id}: {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(delay)
-            else:
-                logger.error(f"Все {retries} попыток исправления диалога {dialog_id} провалились")
-                return None
-
-
-async def process_dialog(row, semaphore, delay, retries) -> dict | None:
-    """
-    Обрабатывает отдельный диалог с использованием семафора и задержки.
-
-    :param row: Словарь с данными диалога.
-    :param semaphore: Семафор для ограничения одновременных запросов.
-    :param delay: Задержка перед каждым запросом в секундах.
-    :param retries: Количество повторных попыток при ошибках.
-    :return: Результат обработки диалога.
-    """
-    async with semaphore:
-        logger.info(f"Начинаю исправление диалога {row['id']}")
-        await asyncio.sleep(delay)  # Задержка перед каждым запросом
-        result = await safe_analyze_dialog(row["dialogue"], dialog_id=row['id'], retries=retries)
-        if result:
-            cost = result.get('cost', 0)
-            logger.info(f"Завершено исправление диалога {row['id']}, стоимость: {cost}")
-        else:
-            logger.error(f"Не удалось исправить диалог {row['id']}")
-        return result
-
-
 async def process_dialogs(
         records: dict,
         max_concurrent_requests: int,
         request_delay: float,
-        retries: int
+        retries: int,
+        sink=None,
+        fused: bool = False,
+        edit_mode: bool = False
 ) -> dict:
     """
     Принимает данные из БД в формате:
@@ -69,55 +31,85 @@ async def process_dialogs(
         },
         ...
     }
-    Асинхронно обрабатывает диалоги и формирует структуру с успешно обработанными записями.
+    Асинхронно обрабатывает диалоги пулом из max_concurrent_requests обработчиков (см. worker_pool.run_pool)
+    и формирует структуру с успешно обработанными записями. Темп запросов к LLM регулирует общий
+    ограничитель llm_rate_limiter, поэтому фиксированной паузы перед запросом нет.
 
     :param records: Словарь с данными, где ключ – имя таблицы, а значение – словарь с ключом "records".
     :param max_concurrent_requests: Максимальное количество одновременных запросов.
-    :param request_delay: Задержка перед каждым запросом в секундах.
-    :param retries: Количество повторных попыток при ошибках.
+    :param request_delay: Базовая задержка между повторными попытками в секундах (удваивается с каждой попыткой).
+    :param retries: Количество попыток при ошибках.
+    :param sink: Функция (table_name, row), обычная или корутинная; вызывается сразу после исправления диалога.
+    :param fused: Выбирать категории тем же запросом, что и исправление (см. dialog_fixer.fix_dialog), для таблиц,
+                  у которых переданы "categories" и "criteria" (fetch_data с analytics_mode=True). Результат
+                  сохраняется в row["data"] так же, как в dialog_classifier, поэтому классификация такие записи
+                  пропускает. Контекст классификации — только summary сущности: резюме предыдущих звонков на этом
+                  шаге ещё не загружены. Если локальная модель категорий портала уверена по одному диалогу
+                  (category_model.predict_categories с dialogue_only, порог dialogue_threshold), диалог
+                  исправляется обычным запросом, а категории берутся из модели.
+    :param edit_mode: Запрашивать у модели только правки вместо всего исправленного текста
+                      (см. dialog_fixer.fix_dialog); при непрошедших проверку правках — целый текст.
     :return: Словарь с таблицами, где данные представлены в формате:
              { 'table_name': { 'records': [ успешно обработанные записи с обновленными dialogue, summary и status ] } }
     """
-    semaphore = asyncio.Semaphore(max_concurrent_requests)
-    tasks = []
+    processed_records = {table: {"records": []} for table in records}
 
-    # Создаём задачи для обработки диалогов из каждой таблицы
-    for table, table_data in records.items():
-        rows = table_data.get("records", [])
-        for row in rows:
-            tasks.append(asyncio.create_task(
-                process_dialog(row, semaphore, request_delay, retries)
-            ))
-
-    # Асинхронно обрабатываем все диалоги
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    failed_requests = 0
-    index = 0
-    processed_records = {}
+    # Индекс summary сущностей для контекста совмещённой классификации строится один раз на таблицу
+    entity_indexes = {
+        table: build_entity_index(table_data.get("entities", []), [])
+        for table, table_data in records.items() if fused and table_data.get("categories")
+    }
 
-    # Формируем результирующую структуру, сохраняя новый формат
-    for table, table_data in records.items():
-        rows = table_data.get("records", [])
-        processed_table = []
-        for row in rows:
-            result = results[index]
-            if isinstance(result, Exception) or result is None:
-                failed_requests += 1
-                logger.error(f"Ошибка при исправлении диалога {row['id']}")
-            else:
-                # Обновляем текст диалога результатом анализа
-                row["dialogue"] = result["content"]
-                # Добавляем резюме диалога
-                row["summary"] = result["summary"]
-                # Обновляем статус на 'fixed' после успешной обработки
-                row["status"] = "fixed"
-                processed_table.append(row)
-            index += 1
-        processed_records[table] = {"records": processed_table}
+    def iter_rows():
+        for table, table_data in records.items():
+            for row in table_data.get("records", []):
+                yield table, row
 
-    total_processed = sum(len(data["records"]) for data in processed_records.values())
-    logger.info(f"Успешно исправлено: {total_processed}, Ошибок: {failed_requests}")
+    async def fix_row(entry: tuple) -> dict:
+        table, row = entry
+        logger.info(f"Начинаю исправление диалога {row['id']}")
+        # Маршрут модели выбирается по порталу (имени таблицы)
+        if table in entity_indexes:
+            categories = records[table]["categories"]
+            # Если локальная модель категорий уверена, категории не запрашиваются у LLM: обычное исправление.
+            # Резюме ещё нет, поэтому используется порог, подобранный на одних диалогах
+            local_categories = predict_categories(table, {"dialogue": relabel_speakers(row["dialogue"])}, categories,
+                                                  dialogue_only=True)
+            if local_categories:
+                result = await fix_dialog(row["dialogue"], table, edit_mode=edit_mode)
+                return {**result, "categories": local_categories, "categories_source": LOCAL_SOURCE}
+            return await fix_dialog(row["dialogue"], table, {"categories": categories},
+                                    build_extended_summary(row, entity_indexes[table]), edit_mode=edit_mode)
+        return await fix_dialog(row["dialogue"], table, edit_mode=edit_mode)
+
+    async def on_done(entry: tuple, result: dict | None, error: Exception | None):
+        table, row = entry
+        if error is not None or result is None:
+            logger.error(f"Ошибка при исправлении диалога {row['id']}: {error}")
+            return
+        logger.info(f"Завершено исправление диалога {row['id']}, стоимость: {result.get('cost', 0)}")
+        # Обновляем текст диалога результатом анализа
+        row["dialogue"] = result["content"]
+        # Добавляем резюме диалога
+        row["summary"] = result["summary"]
+        # Категории совмещённого запроса: data в том же виде, что после dialog_classifier
+        if "categories" in result:
+            apply_selected_categories(row, result["categories"], records[table]["categories"],
+                                      records[table].get("criteria", []))
+            if result.get("categories_source"):
+                row["data"]["categories_source"] = result["categories_source"]
+        # Обновляем статус на 'fixed' после успешной обработки
+        row["status"] = "fixed"
+        processed_records[table]["records"].append(row)
+        if sink is not None:
+            outcome = sink(table, row)
+            if inspect.isawaitable(outcome):
+                await outcome
+
+    stats = await run_pool(iter_rows(), fix_row, max_concurrent_requests, sink=on_done,
+                           retries=retries, retry_delay=request_delay, name="Исправление диалогов")
+
+    logger.info(f"Успешно исправлено: {stats['processed']}, Ошибок: {stats['failed']}")
 
     return processed_records
 
@@ -0,0 +1,560 @@
+import argparse
+import json
+import os
+import re
+from collections import Counter, deque
+from difflib import SequenceMatcher
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('dialog_glossary', 'logs/dialog_glossary.log')
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dialog_glossary.json")
+GLOSSARY_DIR = os.getenv(
+    "DIALOG_GLOSSARY_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "glossaries")
+)
+
+# Сколько последних пар «распознанный / исправленный текст» портала хранится для поиска замен
+MAX_PAIRS = 2000
+
+_WORD_RE = re.compile(r"\w+")
+_TOKEN_RE = re.compile(r"\S+")
+_PUNCTUATION = ".,!?;:…\"'«»()[]—–-"
+
+# Числительные: значение и разряд (1 — единицы и 10-19, 2 — десятки, 3 — сотни)
+_UNITS = {
+    "ноль": 0, "один": 1, "одна": 1, "одно": 1, "два": 2, "две": 2, "три": 3, "четыре": 4, "пять": 5,
+    "шесть": 6, "семь": 7, "восемь": 8, "девять": 9
+}
+_TEENS = {
+    "десять": 10, "одиннадцать": 11, "двенадцать": 12, "тринадцать": 13, "четырнадцать": 14,
+    "пятнадцать": 15, "шестнадцать": 16, "семнадцать": 17, "восемнадцать": 18, "девятнадцать": 19
+}
+_TENS = {
+    "двадцать": 20, "тридцать": 30, "сорок": 40, "пятьдесят": 50, "шестьдесят": 60, "семьдесят": 70,
+    "восемьдесят": 80, "девяносто": 90
+}
+_HUNDREDS = {
+    "сто": 100, "двести": 200, "триста": 300, "четыреста": 400, "пятьсот": 500, "шестьсот": 600,
+    "семьсот": 700, "восемьсот": 800, "девятьсот": 900
+}
+_SCALES = {
+    "тысяча": 1000, "тысячи": 1000, "тысяч": 1000,
+    "миллион": 1_000_000, "миллиона": 1_000_000, "миллионов": 1_000_000
+}
+NUMBER_WORDS = {
+    **{word: (value, 1) for word, value in {**_UNITS, **_TEENS}.items()},
+    **{word: (value, 2) for word, value in _TENS.items()},
+    **{word: (value, 3) for word, value in _HUNDREDS.items()}
+}
+# Слова, которые в одиночку чаще местоимение («один вопрос», «одно и то же»), чем число
+_NOT_ALONE = {"один", "одна", "одно"}
+# Порядковые числительные и количественные в косвенных падежах («пятого», «первый», «двухсот», «сорока»).
+# NUMBER_WORDS их не содержит, поэтому серию рядом с таким словом заменить целиком нельзя («двадцать пятого»)
+_NUMBER_FORM_RE = re.compile(
+    r"(?:нулев|перв|втор|трет|четверт|пят|шест|седьм|восьм|девят|десят|\w+надцат|двадцат|тридцат|сороков"
+    r"|пятидесят|шестидесят|семидесят|восьмидесят|девяност|сот|двухсот|трехсот|четырехсот|пятисот|шестисот"
+    r"|семисот|восьмисот|девятисот|тысячн|миллионн)"
+    r"(?:ой|ый|ий|ая|ое|ые|ого|ому|ым|ом|ую|ых|ыми|ья|ье|ьи|ьего|ьему|ьим|ьем|ьей|ью|ьих|ьими)"
+    r"|(?:нол|нул)[яюе]|одн(?:ого|ому|ой|им|их|ими|у)|дв(?:ух|ум|умя)|тр(?:ех|ем|емя)|четыр(?:ех|ем|ьмя)"
+    r"|(?:пят|шест|сем|восьм|девят|десят|\w+надцат|двадцат|тридцат|пятидесят|шестидесят|семидесят|восьмидесят)"
+    r"(?:и|ью)|восемью|(?:сорок|девяност|ст)а"
+    r"|(?:двух|трех|четырех|пяти|шести|семи|восьми|девяти)(?:сот|стам|стами|стах)"
+    r"|тысяч(?:е|у|ей|ью|ам|ами|ах)|миллион(?:у|ом|е|ы|ам|ами|ах)"
+)
+
+# Настройки и mtime файла, из которого они загружены
+_config = {}
+_config_mtime = None
+# Загруженные словари: {портал: (mtime файла, словарь, автомат)}
+_glossaries = {}
+# Замены за текущий цикл: {портал: {"dialogs", "terms", "numbers"}}
+_stats = {}
+
+
+def get_glossary_config(portal: str = None) -> dict:
+    """
+    Возвращает настройки словаря замен из dialog_glossary.json: раздел default, дополненный настройками портала
+    (portals; "terms" объединяются). Файл перечитывается только при изменении его mtime.
+      - enabled: применять словарь перед исправлением через LLM;
+      - numbers: переводить числительные в цифры (normalize_numbers);
+      - collect: сохранять пары «распознанный / исправленный текст» для поиска замен;
+      - min_count, min_ratio: замена попадает в словарь, если встретилась не меньше min_count раз
+        и фраза исправлялась на неё не реже чем в min_ratio случаев;
+      - max_phrase_words: максимальная длина фразы замены в словах;
+      - terms: замены, заданные вручную (имеют приоритет над найденными).
+    """
+    global _config, _config_mtime
+
+    mtime = os.stat(CONFIG_PATH).st_mtime
+    if mtime != _config_mtime:
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            _config = json.load(f)
+        _config_mtime = mtime
+        logger.info(f"Загружены настройки словаря замен из {CONFIG_PATH}")
+
+    default = _config.get("default", {})
+    portal_config = _config.get("portals", {}).get(portal, {})
+    return {
+        **default,
+        **portal_config,
+        "terms": {**default.get("terms", {}), **portal_config.get("terms", {})}
+    }
+
+
+def _normalize(text: str) -> str:
+    """
+    Приводит текст к виду для поиска: нижний регистр, ё -> е. Длина строки сохраняется,
+    чтобы позиции совпадений указывали на исходный текст.
+    """
+    return "".join(char if len(char.lower()) != 1 else char.lower() for char in text).replace("ё", "е")
+
+
+def _key(token: str) -> str:
+    return _normalize(token.strip(_PUNCTUATION))
+
+
+class AhoCorasick:
+    """
+    Автомат Ахо — Корасик для поиска всех фраз словаря за один проход по тексту.
+    Совпадения учитываются только по границам слов.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.patterns = patterns
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for char in pattern:
+                if char not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[node][char] = len(self._goto) - 1
+                node = self._goto[node][char]
+            self._output[node].append(index)
+
+        # Ссылки неудач строятся обходом в ширину (у детей корня — корень)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text: str) -> list[tuple[int, int, int]]:
+        """
+        Находит непересекающиеся совпадения в нормализованном тексте: при пересечении выигрывает
+        совпадение, которое начинается раньше, а при равном начале — более длинное.
+
+        :return: [(начало, конец, индекс фразы), ...] по возрастанию начала.
+        """
+        matches = []
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for index in self._output[node]:
+                end = position + 1
+                start = end - len(self.patterns[index])
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    matches.append((start, end, index))
+
+        selected = []
+        last_end = 0
+        for start, end, index in sorted(matches, key=lambda match: (match[0], match[0] - match[1])):
+            if start >= last_end:
+                selected.append((start, end, index))
+                last_end = end
+        return selected
+
+
+def _parse_numbers(words: list[str]) -> list[int]:
+    """
+    Переводит подряд идущие числительные в числа. Новое число начинается, когда разряд не убывает
+    («девятьсот двадцать пять сорок восемь» -> [925, 48]) или после «ноль».
+    """
+    numbers = []
+    total, group, last_rank, last_scale, has_value = 0, 0, None, None, False
+
+    def flush():
+        nonlocal total, group, last_rank, last_scale, has_value
+        if has_value:
+            numbers.append(total + group)
+        total, group, last_rank, last_scale, has_value = 0, 0, None, None, False
+
+    for word in words:
+        if word in _SCALES:
+            scale = _SCALES[word]
+            if last_scale is not None and scale >= last_scale:
+                flush()
+            total += (group or 1) * scale
+            group, last_rank, last_scale, has_value = 0, None, scale, True
+            continue
+
+        value, rank = NUMBER_WORDS[word]
+        if word == "ноль":
+            flush()
+            numbers.append(0)
+            continue
+        # 10-19 не продолжают десятки («двадцать одиннадцать» — два числа)
+        if last_rank is not None and (rank >= last_rank or (word in _TEENS and last_rank == 2)):
+            flush()
+        group += value
+        last_rank, has_value = rank, True
+    flush()
+    return numbers
+
+
+def normalize_numbers(text: str) -> tuple[str, int]:
+    """
+    Детерминированно заменяет числительные в именительном падеже цифрами: «восемьсот шестьдесят три» -> 863,
+    «две тысячи двадцать пять» -> 2025, номера телефонов по группам — числами через пробел.
+    Одиночные «один/одна/одно» не заменяются (обычно это не число). Серия, рядом с которой стоит порядковое
+    числительное или числительное в косвенном падеже («двадцать пятого марта», «двадцать первый»,
+    «двух тысяч»), не заменяется целиком: иначе получилось бы «20 пятого марта».
+
+    :return: Кортеж (текст, число заменённых групп числительных).
+    """
+    # Серии подряд идущих числительных (между ними только пробелы): [[начало, конец, [слова], заблокирована], ...]
+    runs = []
+    previous_end = None
+    # Конец последнего слова-формы числительного (_NUMBER_FORM_RE), если после него были только пробелы
+    form_end = None
+    for match in _WORD_RE.finditer(text):
+        word = _normalize(match.group())
+        adjacent = previous_end is not None and not text[previous_end:match.start()].strip()
+        if word not in NUMBER_WORDS and word not in _SCALES:
+            is_form = bool(_NUMBER_FORM_RE.fullmatch(word))
+            if is_form and adjacent:
+                runs[-1][3] = True
+            form_end = match.end() if is_form else None
+            previous_end = None
+            continue
+        if adjacent:
+            runs[-1][1] = match.end()
+            runs[-1][2].append(word)
+        else:
+            after_form = form_end is not None and not text[form_end:match.start()].strip()
+            runs.append([match.start(), match.end(), [word], after_form])
+        form_end = None
+        previous_end = match.end()
+
+    parts = []
+    cursor = 0
+    replaced = 0
+    for start, end, words, blocked in runs:
+        if blocked or (len(words) == 1 and words[0] in _NOT_ALONE):
+            continue
+        parts.append(text[cursor:start])
+        parts.append(" ".join(str(number) for number in _parse_numbers(words)))
+        cursor = end
+        replaced += 1
+    parts.append(text[cursor:])
+    return "".join(parts), replaced
+
+
+def _glossary_path(portal: str) -> str:
+    return os.path.join(GLOSSARY_DIR, f"{portal}.json")
+
+
+def _pairs_path(portal: str) -> str:
+    return os.path.join(GLOSSARY_DIR, f"{portal}.pairs.jsonl")
+
+
+def load_glossary(portal: str) -> tuple[dict, AhoCorasick | None]:
+    """
+    Возвращает словарь замен портала {фраза: замена} (найденные замены + terms из настроек)
+    и автомат для поиска его фраз. Найденный словарь перечитывается при изменении файла.
+    """
+    path = _glossary_path(portal)
+    mtime = os.stat(path).st_mtime if os.path.exists(path) else None
+    config_terms = get_glossary_config(portal).get("terms", {})
+    cached = _glossaries.get(portal)
+    if cached and cached[0] == (mtime, _config_mtime):
+        return cached[1], cached[2]
+
+    terms = {}
+    if mtime is not None:
+        with open(path, "r", encoding="utf-8") as f:
+            terms = json.load(f).get("terms", {})
+    terms = {_normalize(source): target for source, target in {**terms, **config_terms}.items() if source.strip()}
+    matcher = AhoCorasick(list(terms)) if terms else None
+    _glossaries[portal] = ((mtime, _config_mtime), terms, matcher)
+    return terms, matcher
+
+
+def _match_case(source: str, target: str) -> str:
+    """
+    Сохраняет заглавную первую букву исходной фразы (начало предложения), если замена начинается со строчной.
+    """
+    if source[:1].isupper() and target[:1].islower():
+        return target[:1].upper() + target[1:]
+    return target
+
+
+def apply_terms(text: str, terms: dict, matcher: AhoCorasick) -> tuple[str, int]:
+    """
+    Заменяет фразы словаря terms в тексте (поиск автоматом matcher по границам слов).
+
+    :return: Кортеж (текст, число замен).
+    """
+    matches = matcher.find(_normalize(text))
+    parts = []
+    cursor = 0
+    for start, end, index in matches:
+        parts.append(text[cursor:start])
+        parts.append(_match_case(text[start:end], terms[matcher.patterns[index]]))
+        cursor = end
+    parts.append(text[cursor:])
+    return "".join(parts), len(matches)
+
+
+def apply_glossary(text: str, portal: str = None) -> tuple[str, dict]:
+    """
+    Локальная предобработка диалога перед исправлением через LLM: замены из словаря портала
+    и перевод числительных в цифры (см. get_glossary_config). Количество замен копится в статистике цикла.
+
+    :return: Кортеж (текст, {"terms": замен по словарю, "numbers": заменённых числительных}).
+    """
+    config = get_glossary_config(portal)
+    counts = {"terms": 0, "numbers": 0}
+    if not config.get("enabled", False):
+        return text, counts
+
+    terms, matcher = load_glossary(portal)
+    if matcher is not None:
+        text, counts["terms"] = apply_terms(text, terms, matcher)
+    if config.get("numbers", False):
+        text, counts["numbers"] = normalize_numbers(text)
+
+    stats = _stats.setdefault(portal, {"dialogs": 0, "terms": 0, "numbers": 0})
+    stats["dialogs"] += 1
+    stats["terms"] += counts["terms"]
+    stats["numbers"] += counts["numbers"]
+    return text, counts
+
+
+def reset_glossary_stats() -> dict:
+    """
+    Сбрасывает статистику замен и возвращает её за прошедший период: {портал: {"dialogs", "terms", "numbers"}}.
+    """
+    global _stats
+    stats, _stats = _stats, {}
+    return stats
+
+
+def record_pair(portal: str, source: str, fixed: str):
+    """
+    Сохраняет пару «распознанный текст (с метками К:/М:) / исправленный текст» для поиска замен (mine_glossary).
+    """
+    if not portal or not get_glossary_config(portal).get("collect", False):
+        return
+    os.makedirs(GLOSSARY_DIR, exist_ok=True)
+    with open(_pairs_path(portal), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"source": source, "fixed": fixed}, ensure_ascii=False) + "\n")
+
+
+def load_pairs(portal: str) -> list[dict]:
+    """
+    Возвращает не больше MAX_PAIRS последних пар портала; файл при этом усекается до них.
+    """
+    path = _pairs_path(portal)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    if len(lines) > MAX_PAIRS:
+        lines = lines[-MAX_PAIRS:]
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(temporary_path, path)
+
+    pairs = []
+    for line in lines:
+        try:
+            pairs.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return pairs
+
+
+def _target_form(tokens: list[str]) -> str:
+    """
+    Форма замены без знаков препинания: слова в нижнем регистре, кроме латиницы, цифр и аббревиатур
+    (заглавная буква в начале предложения не должна попасть в словарь).
+    """
+    words = []
+    for token in tokens:
+        word = token.strip(_PUNCTUATION)
+        keep = any(char.isascii() and char.isalnum() for char in word) or any(char.isupper() for char in word[1:])
+        words.append(word if keep else word.lower())
+    return " ".join(word for word in words if word)
+
+
+def _tokens(text: str) -> tuple[list[str], list[str]]:
+    """
+    Делит текст на слова (по пробелам, без меток спикеров) и ключи для сравнения (без пунктуации, в нижнем регистре).
+    """
+    tokens = [token for token in _TOKEN_RE.findall(text) if _key(token) and token not in ("К:", "М:", "0:", "1:")]
+    return tokens, [_key(token) for token in tokens]
+
+
+def mine_terms(pairs: list[dict], min_count: int, min_ratio: float, max_phrase_words: int) -> dict:
+    """
+    Находит устойчивые замены по парам текстов: слова распознанного текста (после перевода числительных
+    в цифры) выравниваются с исправленным текстом (difflib), заменённые фрагменты до max_phrase_words слов
+    становятся кандидатами. Фраза попадает в словарь, если её исправляли на одну и ту же замену
+    не меньше min_count раз и не реже чем в min_ratio её вхождений.
+
+    :return: {фраза: замена}.
+    """
+    replacements = {}
+    sources = []
+    for pair in pairs:
+        source_text, _ = normalize_numbers(pair.get("source") or "")
+        _, source_keys = _tokens(source_text)
+        fixed_tokens, fixed_keys = _tokens(pair.get("fixed") or "")
+        sources.append(source_keys)
+
+        matcher = SequenceMatcher(None, source_keys, fixed_keys, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != "replace" or i2 - i1 > max_phrase_words or j2 - j1 > max_phrase_words:
+                continue
+            source = " ".join(source_keys[i1:i2])
+            target = _target_form(fixed_tokens[j1:j2])
+            if len(source) >= 3 and target and _normalize(target) != source:
+                replacements.setdefault(source, Counter())[target] += 1
+
+    # Сколько раз каждая фраза-кандидат встречается в распознанных текстах
+    occurrences = Counter()
+    lengths = {len(source.split()) for source in replacements}
+    for source_keys in sources:
+        for length in lengths:
+            for start in range(len(source_keys) - length + 1):
+                phrase = " ".join(source_keys[start:start + length])
+                if phrase in replacements:
+                    occurrences[phrase] += 1
+
+    terms = {}
+    for source, targets in replacements.items():
+        target, count = targets.most_common(1)[0]
+        if count >= min_count and count >= min_ratio * occurrences[source]:
+            terms[source] = target
+    return terms
+
+
+def mine_glossary(portal: str, force: bool = False) -> int:
+    """
+    Обновляет найденный словарь замен портала по сохранённым парам (см. mine_terms) и сохраняет его в GLOSSARY_DIR.
+    Если с прошлого построения не изменились ни пары, ни настройки, словарь не пересобирается
+    (выравнивание MAX_PAIRS пар занимает десятки секунд); force=True — пересобрать в любом случае.
+
+    :return: Количество замен в словаре.
+    """
+    config = get_glossary_config(portal)
+    path = _glossary_path(portal)
+    pairs_path = _pairs_path(portal)
+    if not force and os.path.exists(path) and os.path.exists(pairs_path):
+        mtime = os.stat(path).st_mtime
+        if os.stat(pairs_path).st_mtime <= mtime and os.stat(CONFIG_PATH).st_mtime <= mtime:
+            with open(path, "r", encoding="utf-8") as f:
+                return len(json.load(f).get("terms", {}))
+
+    pairs = load_pairs(portal)
+    if not pairs:
+        return 0
+    terms = mine_terms(pairs, config.get("min_count", 3), config.get("min_ratio", 0.8),
+                       config.get("max_phrase_words", 3))
+
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump({"terms": terms, "pairs": len(pairs)}, f, ensure_ascii=False, indent=2)
+    os.replace(temporary_path, path)
+    logger.info(f"Портал {portal}: словарь замен обновлён по {len(pairs)} парам, замен {len(terms)}")
+    return len(terms)
+
+
+def update_glossaries(portals: list[str]) -> int:
+    """
+    Обновляет словари замен порталов, у которых включён сбор пар. Вызывается в начале цикла анализа.
+
+    :return: Общее количество замен в словарях.
+    """
+    total = 0
+    for portal in portals:
+        if not get_glossary_config(portal).get("collect", False):
+            continue
+        try:
+            total += mine_glossary(portal)
+        except Exception as e:
+            logger.warning(f"Портал {portal}: не удалось обновить словарь замен: {e}")
+    return total
+
+
+def evaluate_portal(portal: str) -> dict:
+    """
+    Офлайн-оценка без LLM: применяет словарь и перевод числительных к распознанным текстам сохранённых пар
+    и считает замены, а также долю замен по словарю, результат которых есть в исправленном тексте.
+    """
+    config = get_glossary_config(portal)
+    terms, matcher = load_glossary(portal)
+    report = {"pairs": 0, "terms": 0, "numbers": 0, "confirmed": 0}
+    for pair in load_pairs(portal):
+        source = pair.get("source") or ""
+        fixed = _normalize(pair.get("fixed") or "")
+        report["pairs"] += 1
+        if matcher is not None:
+            for start, end, index in matcher.find(_normalize(source)):
+                report["terms"] += 1
+                report["confirmed"] += _normalize(terms[matcher.patterns[index]]) in fixed
+        if config.get("numbers", False):
+            report["numbers"] += normalize_numbers(source)[1]
+    report["confirmed_share"] = round(report["confirmed"] / report["terms"], 3) if report["terms"] else None
+    return report
+
+
+if __name__ == "__main__":
+    # python dialog_glossary.py mine [--portal advertpro] — обновить словари по сохранённым парам
+    # python dialog_glossary.py eval [--portal advertpro] — сколько замен делается без LLM
+    # python dialog_glossary.py numbers — примеры перевода числительных в цифры
+    parser = argparse.ArgumentParser(description="Словарь замен для исправления диалогов")
+    parser.add_argument("command", choices=["mine", "eval", "numbers"])
+    parser.add_argument("--portal", action="append", help="Портал (по умолчанию все с сохранёнными парами)")
+    args = parser.parse_args()
+
+    if args.command == "numbers":
+        examples = [
+            "восемьсот шестьдесят три",                  # 863
+            "две тысячи двадцать пять",                  # 2025
+            "девятьсот двадцать пять сорок восемь",      # 925 48
+            "один вопрос",                               # без изменений
+            "двадцать пятого марта",                     # без изменений: порядковое числительное
+            "двадцать первый",                           # без изменений
+            "до двух тысяч двадцати пяти рублей",        # без изменений: косвенный падеж
+            "пять сорока"                                # без изменений
+        ]
+        for example in examples:
+            print(f"{example!r} -> {normalize_numbers(example)[0]!r}")
+        raise SystemExit
+
+    portal_names = args.portal
+    if not portal_names:
+        stored = os.listdir(GLOSSARY_DIR) if os.path.isdir(GLOSSARY_DIR) else []
+        portal_names = sorted(name[:-len(".pairs.jsonl")] for name in stored if name.endswith(".pairs.jsonl"))
+    for portal_name in portal_names:
+        if args.command == "mine":
+            print(f"{portal_name}: замен в словаре {mine_glossary(portal_name, force=True)}")
+            continue
+        result = evaluate_portal(portal_name)
+        print(f"{portal_name}: пар {result['pairs']}, замен по словарю {result['terms']} "
+              f"(есть в исправленном тексте {result['confirmed_share']}), числительных {result['numbers']}")
@@ -1,5 +1,7 @@
 import asyncio
+import inspect
 from dialogue_recognizer import process_record  # Импорт функции из record_processor.py
+from worker_pool import run_pool
 from logger_config import setup_logger
 
 # Настройка логгера для этого модуля
@@ -10,60 +12,52 @@ async def process_and_store_dialogs(
     data: dict,
     max_concurrent_requests: int,
     retries: int,
-    request_delay: float
+    request_delay: float,
+    sink=None
 ):
     """
-    Обрабатывает записи параллельно с ограничением по количеству одновременно
-    обрабатываемых записей. В случае ошибки предпримет заданное количество
-    повторных попыток с задержкой между ними.
+    Обрабатывает записи пулом из max_concurrent_requests обработчиков (см. worker_pool.run_pool):
+    записи читаются из data по мере освобождения обработчиков. В случае ошибки предпримет заданное
+    количество попыток с нарастающей задержкой между ними.
 
     :param data: Словарь вида {category1: {"records": [record1, record2, ...]}, category2: {"records": [...]}, ...}
     :param max_concurrent_requests: максимальное количество одновременно обрабатываемых записей
-    :param retries: количество повторных попыток при возникновении ошибки
-    :param request_delay: задержка (в секундах) между повторными попытками
+    :param retries: количество попыток при возникновении ошибки
+    :param request_delay: базовая задержка (в секундах) между повторными попытками
+    :param sink: функция (category, record), обычная или корутинная; вызывается сразу после распознавания записи
     """
     logger.info("=== НАЧИНАЮ ОБРАБОТКУ: Распознавание диалогов ===")
-    semaphore = asyncio.Semaphore(max_concurrent_requests)
 
-    async def sem_protected_process_record(record):
-        """Вспомогательная функция для ограничения параллелизма и повторных попыток."""
-        async with semaphore:
-            for attempt in range(retries):
-                try:
-                    return await process_record(record)
-                except Exception as e:
-                    if attempt < retries - 1:
-                        logger.warning(
-                            f"Ошибка при распознавании записи (id={record.get('id', 'unknown')}), "
-                            f"попытка {attempt + 1} из {retries}: {e}"
-                        )
-                        await asyncio.sleep(request_delay)
-                    else:
-                        logger.error(
-                            f"Не удалось распознать запись (id={record.get('id', 'unknown')}) "
-                            f"после {retries} попыток. Ошибка: {e}"
-                        )
-                        return None
-
-    # Подготовим список (category, record) для удобства.
     # Предполагается, что записи для каждой категории находятся в ключе "records"
-    all_records = []
-    for category, category_data in data.items():
-        records = category_data.get("records", [])
-        for record in records:
-            all_records.append((category, record))
+    def iter_records():
+        for category, category_data in data.items():
+            for record in category_data.get("records", []):
+                yield category, record
 
-    # Запустим все задачи параллельно
-    tasks = [sem_protected_process_record(record) for _, record in all_records]
-    results = await asyncio.gather(*tasks)
+    async def recognize(entry: tuple):
+        return await process_record(entry[1])
 
     # Собираем только успешные результаты обратно в структуру {category: {"records": [record, ...]}, ...}
     filtered_data = {}
-    for (category, _), processed_record in zip(all_records, results):
-        if processed_record is not None:
-            if category not in filtered_data:
-                filtered_data[category] = {"records": []}
-            filtered_data[category]["records"].append(processed_record)
+
+    async def on_done(entry: tuple, processed_record, error):
+        category, record = entry
+        if error is not None:
+            logger.error(
+                f"Не удалось распознать запись (id={record.get('id', 'unknown')}) "
+                f"после {retries} попыток. Ошибка: {error}"
+            )
+            return
+        if processed_record is None:
+            return
+        filtered_data.setdefault(category, {"records": []})["records"].append(processed_record)
+        if sink is not None:
+            outcome = sink(category, processed_record)
+            if inspect.isawaitable(outcome):
+                await outcome
+
+    await run_pool(iter_records(), recognize, max_concurrent_requests, sink=on_done,
+                   retries=retries, retry_delay=request_delay, name="Распознавание диалогов")
 
     logger.info("=== ЗАВЕРШАЮ ОБРАБОТКУ: Распознавание диалогов ===")
     return filtered_data
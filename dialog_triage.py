@@ -0,0 +1,184 @@
+import inspect
+import json
+import os
+import re
+from dialog_fixer import relabel_speakers
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('dialog_triage', 'logs/dialog_triage.log')
+
+TRIAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dialog_triage.json")
+
+# Решения триажа
+EMPTY = "empty"    # разговора не было: статус empty, дальше не обрабатывается
+SHORT = "short"    # короткий звонок: без исправления через LLM, резюме по умолчанию, статус fixed
+
+# Строка диалога вида "0: текст" / "К: текст"
+_LINE_RE = re.compile(r"^\s*([^:\s]{1,3}):\s*(.*)$")
+_WORD_RE = re.compile(r"\w+")
+
+# Настройки триажа и mtime файла, из которого они загружены
+_triage = {}
+_triage_mtime = None
+
+
+def _normalize(text: str) -> str:
+    """
+    Приводит текст к виду для поиска фраз: нижний регистр, ё -> е, только слова через пробел.
+    """
+    return " ".join(_WORD_RE.findall(text.lower().replace("ё", "е")))
+
+
+def get_triage_config(portal: str = None) -> dict:
+    """
+    Возвращает пороги триажа из dialog_triage.json: раздел default, дополненный настройками портала
+    (portals, переопределяются отдельные ключи разделов empty/short/blacklist).
+    Файл перечитывается только при изменении его mtime.
+    """
+    global _triage, _triage_mtime
+
+    mtime = os.stat(TRIAGE_PATH).st_mtime
+    if mtime != _triage_mtime:
+        with open(TRIAGE_PATH, "r", encoding="utf-8") as f:
+            _triage = json.load(f)
+        for section in [_triage.get("default", {})] + list(_triage.get("portals", {}).values()):
+            blacklist = section.get("blacklist", {})
+            if "phrases" in blacklist:
+                blacklist["phrases"] = [_normalize(phrase) for phrase in blacklist["phrases"]]
+        _triage_mtime = mtime
+        logger.info(f"Загружены настройки триажа из {TRIAGE_PATH}")
+
+    config = {key: dict(value) for key, value in _triage.get("default", {}).items()}
+    for key, value in _triage.get("portals", {}).get(portal, {}).items():
+        config[key] = {**config.get(key, {}), **value}
+    return config
+
+
+def dialog_stats(dialog_text: str) -> dict:
+    """
+    Считает признаки диалога без обращения к LLM: число слов, число реплик (смен спикера),
+    число разных спикеров и нормализованный текст для поиска фраз.
+    """
+    words = 0
+    turns = 0
+    speakers = set()
+    previous_speaker = None
+    normalized = []
+    for line in (dialog_text or "").split("\n"):
+        match = _LINE_RE.match(line)
+        speaker, text = (match.group(1), match.group(2)) if match else (None, line)
+        line_words = _WORD_RE.findall(text)
+        if not line_words:
+            continue
+        words += len(line_words)
+        speakers.add(speaker)
+        if speaker is None or speaker != previous_speaker:
+            turns += 1
+        previous_speaker = speaker
+        normalized.append(_normalize(text))
+    return {"words": words, "turns": turns, "speakers": len(speakers), "text": " ".join(normalized)}
+
+
+def _duration(record: dict) -> float | None:
+    audio_metadata = record.get("audio_metadata") or {}
+    try:
+        return float(audio_metadata.get("duration"))
+    except (TypeError, ValueError):
+        return None
+
+
+def triage_record(record: dict, portal: str = None) -> tuple[str | None, str]:
+    """
+    Определяет по числу слов, реплик, длительности аудио и стоп-фразам, нужен ли записи анализ через LLM.
+
+    :return: Кортеж (решение, причина): решение EMPTY, SHORT или None (запись обрабатывается как обычно).
+    """
+    config = get_triage_config(portal)
+    empty = config.get("empty", {})
+    short = config.get("short", {})
+    blacklist = config.get("blacklist", {})
+
+    stats = dialog_stats(record.get("dialogue"))
+    duration = _duration(record)
+
+    if stats["words"] == 0:
+        return EMPTY, "нет слов"
+    if stats["words"] <= empty.get("max_words", 0):
+        return EMPTY, f"слов: {stats['words']}"
+    if duration is not None and duration <= empty.get("max_duration", 0):
+        return EMPTY, f"длительность {duration:.1f} с"
+    if stats["speakers"] <= 1 and stats["words"] <= empty.get("max_single_speaker_words", 0):
+        return EMPTY, f"говорит один спикер, слов: {stats['words']}"
+    if stats["words"] <= blacklist.get("max_words", 0):
+        padded = f" {stats['text']} "
+        for phrase in blacklist.get("phrases", []):
+            if phrase and f" {phrase} " in padded:
+                return EMPTY, f"стоп-фраза «{phrase}»"
+    if stats["words"] <= short.get("max_words", 0) and stats["turns"] <= short.get("max_turns", 0):
+        return SHORT, f"слов: {stats['words']}, реплик: {stats['turns']}"
+    return None, ""
+
+
+def apply_triage(record: dict, verdict: str, portal: str = None):
+    """
+    Записывает в запись результат триажа: EMPTY — статус empty, SHORT — диалог с метками К:/М:
+    без исправления, резюме по умолчанию и статус fixed (запись идёт на классификацию и критерии).
+    """
+    config = get_triage_config(portal)
+    if verdict == EMPTY:
+        record["summary"] = config.get("empty", {}).get("summary", "")
+        record["status"] = "empty"
+    elif verdict == SHORT:
+        record["dialogue"] = relabel_speakers(record.get("dialogue") or "")
+        record["summary"] = config.get("short", {}).get("summary", "")
+        record["status"] = "fixed"
+
+
+async def triage_dialogs(records: dict, sink=None) -> dict:
+    """
+    Локальный (без LLM) триаж распознанных диалогов перед исправлением.
+    Пустые звонки, автоответчики и сбросы получают статус empty, короткие звонки — резюме по умолчанию
+    и статус fixed (см. apply_triage); такие записи передаются в sink сразу.
+
+    :param records: {'table_name': {'records': [{id, dialogue, audio_metadata, ...}, ...]}, ...}
+    :param sink: Функция (table_name, record), обычная или корутинная; вызывается для каждой отсеянной записи.
+    :return: Структура того же вида только с записями, которым нужно исправление через LLM.
+    """
+    remaining = {}
+    for table, table_data in records.items():
+        counts = {EMPTY: 0, SHORT: 0}
+        remaining[table] = {"records": []}
+        for record in table_data.get("records", []):
+            verdict, reason = triage_record(record, table)
+            if verdict is None:
+                remaining[table]["records"].append(record)
+                continue
+            logger.debug(f"Таблица {table}, запись {record.get('id')}: {verdict} ({reason})")
+            apply_triage(record, verdict, table)
+            counts[verdict] += 1
+            if sink is not None:
+                outcome = sink(table, record)
+                if inspect.isawaitable(outcome):
+                    await outcome
+        if counts[EMPTY] or counts[SHORT]:
+            logger.info(
+                f"Таблица {table}: пустых {counts[EMPTY]}, коротких {counts[SHORT]}, "
+                f"на исправление через LLM {len(remaining[table]['records'])}"
+            )
+    return remaining
+
+
+if __name__ == "__main__":
+    # Проверка порогов на распознанных записях без изменений в БД
+    from db_fetcher import fetch_data
+
+    data_records = fetch_data(status="recognized", fields=["id", "dialogue", "audio_metadata"])
+    for table_name, table_data in data_records.items():
+        verdicts = {}
+        for data_record in table_data["records"]:
+            record_verdict, record_reason = triage_record(data_record, table_name)
+            verdicts[record_verdict] = verdicts.get(record_verdict, 0) + 1
+            if record_verdict:
+                print(f"{table_name} {data_record['id']}: {record_verdict} ({record_reason})")
+        print(f"{table_name}: {verdicts}")
@@ -0,0 +1,123 @@
+import re
+from difflib import SequenceMatcher
+from llm_tokens import count_tokens
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('dialog_windows', 'logs/dialog_windows.log')
+
+# Начало реплики: метка спикера распознавания (0:/1:) или после замены (К:/М:)
+SPEAKER_LABEL_RE = re.compile(r"^\s*(К|М|0|1):")
+_WORD_RE = re.compile(r"\w+")
+
+# Минимальная длина совпадения (в словах), по которой сшиваются окна, если число реплик в ответе изменилось
+MIN_MATCH_WORDS = 3
+
+
+def split_turns(text: str) -> list[str]:
+    """
+    Делит диалог на реплики: реплика начинается строкой с меткой спикера, строки без метки
+    (например, перенос фразы в ответе модели) относятся к предыдущей реплике.
+    """
+    turns = []
+    for line in (text or "").split("\n"):
+        if not line.strip():
+            continue
+        if turns and not SPEAKER_LABEL_RE.match(line):
+            turns[-1] = f"{turns[-1]}\n{line}"
+        else:
+            turns.append(line)
+    return turns
+
+
+def split_dialogue(text: str, window_tokens: int, overlap_tokens: int) -> list[dict]:
+    """
+    Делит длинный диалог на окна по границам реплик. Окно — не больше window_tokens токенов
+    (кроме случая, когда одна реплика длиннее окна); соседние окна пересекаются на реплики
+    общим размером до overlap_tokens, чтобы модель видела контекст на стыке.
+
+    :return: [{"text": текст окна, "turns": число реплик, "overlap": число первых реплик окна,
+             совпадающих с концом предыдущего}, ...]
+    """
+    turns = split_turns(text)
+    tokens = [count_tokens(turn) for turn in turns]
+
+    windows = []
+    start, previous_end = 0, 0
+    while start < len(turns):
+        end, size = start, 0
+        while end < len(turns) and (end == start or size + tokens[end] <= window_tokens):
+            size += tokens[end]
+            end += 1
+        windows.append({"text": "\n".join(turns[start:end]), "turns": end - start, "overlap": previous_end - start})
+        if end >= len(turns):
+            break
+
+        # Следующее окно начинается на несколько реплик раньше конца текущего, но всегда продвигается вперёд
+        next_start, overlap_size = end, 0
+        while next_start - 1 > start and overlap_size + tokens[next_start - 1] <= overlap_tokens:
+            next_start -= 1
+            overlap_size += tokens[next_start]
+        start, previous_end = next_start, end
+    return windows
+
+
+def _turn_words(turns: list[str]) -> list[tuple[str, int]]:
+    """
+    Возвращает слова реплик (без метки спикера, в нижнем регистре) с номером реплики.
+    """
+    words = []
+    for index, turn in enumerate(turns):
+        for word in _WORD_RE.findall(SPEAKER_LABEL_RE.sub("", turn, count=1).lower().replace("ё", "е")):
+            words.append((word, index))
+    return words
+
+
+def _reconcile(merged: list[str], turns: list[str], overlap: int, aligned: bool) -> list[str]:
+    """
+    Сшивает уже собранные реплики merged с репликами следующего окна turns, у которого первые overlap
+    реплик повторяют конец предыдущего окна.
+
+    Если число реплик в ответах обоих окон совпало с исходным (aligned), общая часть делится посередине:
+    первая половина берётся из предыдущего окна, вторая — из следующего (у каждого окна края хуже,
+    чем середина). Иначе окна сшиваются по самому длинному общему фрагменту слов на стыке.
+    """
+    if overlap <= 0:
+        return merged + turns
+    if aligned:
+        keep_previous = overlap // 2
+        return merged[:len(merged) - (overlap - keep_previous)] + turns[keep_previous:]
+
+    # Модель объединила или разбила реплики: ищем общий фрагмент на стыке с небольшим запасом
+    tail = merged[-(overlap + 2):]
+    head = turns[:overlap + 2]
+    tail_words = _turn_words(tail)
+    head_words = _turn_words(head)
+    matcher = SequenceMatcher(None, [word for word, _ in tail_words], [word for word, _ in head_words], autojunk=False)
+    match = matcher.find_longest_match(0, len(tail_words), 0, len(head_words))
+    if match.size >= MIN_MATCH_WORDS:
+        middle = match.size // 2
+        tail_turn = tail_words[match.a + middle][1]
+        head_turn = head_words[match.b + middle][1]
+        return merged[:len(merged) - len(tail) + tail_turn] + turns[head_turn:]
+
+    logger.warning(f"Не найдено общего фрагмента на стыке окон, отбрасываю {overlap} первых реплик окна")
+    return merged + turns[overlap:]
+
+
+def merge_windows(windows: list[dict], texts: list[str]) -> str:
+    """
+    Собирает обработанные окна (например, исправленные тексты) обратно в один диалог,
+    убирая повтор реплик на стыках (см. _reconcile).
+
+    :param windows: Окна из split_dialogue.
+    :param texts: Результаты обработки окон в том же порядке.
+    """
+    merged = []
+    previous_aligned = True
+    for window, text in zip(windows, texts):
+        turns = split_turns(text)
+        aligned = len(turns) == window["turns"]
+        merged = _reconcile(merged, turns, window["overlap"], aligned and previous_aligned)
+        previous_aligned = aligned
+    return "\n".join(merged)
@@ -2,7 +2,7 @@ import asyncio
 import time
 from db_fetcher import fetch_data
 from dialog_processor import process_and_store_dialogs
-from db_dialog_uploader import upload_recognized_dialogs
+from db_record_sink import RecordSink
 from logger_config import get_dialogue_logger
 
 # Настройка логгера для этого модуля
@@ -25,20 +25,17 @@ async def process_data():
         logger.info(f"Найдено {len(data_records)} файлов для распознавания")
         logger.info("Начинается распознавание аудиофайлов...")
         
-        updated_data_records = await process_and_store_dialogs(
-            data_records,
-            max_concurrent_requests=50,
-            retries=3,
-            request_delay=1
-        )
-        logger.info(f"Распознано {len(updated_data_records)} диалогов")
-
-        logger.info("Загрузка распознанных данных обратно в базу...")
-        upload_recognized_dialogs(
-            updated_data_records,
-            default_status='recognized'  # Fallback статус, если в записи нет поля 'status'
-        )
-        logger.info("Распознанные данные успешно загружены в БД")
+        # Распознанные записи сохраняются в базу по мере готовности; статус берётся из записи
+        # ('empty' для пустых диалогов), иначе — 'recognized'
+        async with RecordSink(["dialogue"], default_status="recognized", name="Распознавание") as sink:
+            updated_data_records = await process_and_store_dialogs(
+                data_records,
+                max_concurrent_requests=50,
+                retries=3,
+                request_delay=1,
+                sink=sink
+            )
+        logger.info(f"Распознано {len(updated_data_records)} диалогов, сохранено в БД {sink.flushed}")
 
         logger.info("Распознавание завершено!")
         
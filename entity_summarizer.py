@@ -1,5 +1,12 @@
 import asyncio
-from sum_texts import sum_text_blocks
+import json
+from db_client import get_db_client
+from sum_texts import (sum_text_blocks, build_sum_messages, parse_sum_response, calculate_evaluation, SUM_SCHEMA,
+                       STAGE)
+from llm_routing import get_route
+from criteria_analyzer import is_record_analyzed
+from llm_batch import (make_custom_id, parse_custom_id, submit_batch, collect_batch_results,
+                       get_pending_custom_ids, mark_batches_merged)
 from logger_config import setup_logger
 
 # Настройка логгера для этого модуля
@@ -11,7 +18,8 @@ async def summarize_entity_descriptions(
     max_text_size=1000,
     max_concurrent_requests=50,
     request_delay=0.1,
-    retries=3
+    retries=3,
+    use_batch=False
 ):
     """
     Проходит по всем сущностям в словаре, находит критерии с "include_in_entity_description": true
@@ -29,9 +37,18 @@ async def summarize_entity_descriptions(
     :param max_concurrent_requests: Максимальное количество параллельных запросов к LLM
     :param request_delay: Задержка между запросами в секундах
     :param retries: Количество повторных попыток при ошибке
+    :param use_batch: Суммировать тексты через OpenAI Batch API (см. _merge_batch_results).
+                      Оценка считается сразу, а текст критерия обновляется, когда батч завершится.
     :return: Обновленный словарь с суммированными описаниями сущностей
     """
-    
+    batch = None
+    if use_batch:
+        batch = {
+            "pending": get_pending_custom_ids("entity_summary"),
+            "requests": [],
+        }
+        batch["merged_batch_ids"], batch["merged_custom_ids"] = await _merge_batch_results(data_dict)
+
     # Создаем копию ключей для безопасной итерации
     table_names = list(data_dict.keys())
     
@@ -43,11 +60,13 @@ async def summarize_entity_descriptions(
         records = table_data.get("records", [])
         criteria_definitions = table_data.get("criteria", [])
         
-        # Создаем маппинг entity_id -> список записей для этой сущности
+        # Создаем маппинг entity_id -> список записей для этой сущности.
+        # Записи с неполными результатами критериев остаются в статусе fixed и попадут сюда
+        # в следующем цикле, поэтому сейчас пропускаются (иначе их тексты учлись бы дважды)
         entity_records = {}
         for record in records:
             entity_id = record.get("entity_id")
-            if entity_id is not None:
+            if entity_id is not None and is_record_analyzed(record):
                 if entity_id not in entity_records:
                     entity_records[entity_id] = []
                 entity_records[entity_id].append(record)
@@ -58,7 +77,7 @@ async def summarize_entity_descriptions(
             criteria_to_process = {}
             
             for record in entity_record_list:
-                criteria_list = record.get("data", {}).get("criteria", [])
+                criteria_list = (record.get("data") or {}).get("criteria", [])
                 
                 for criterion in criteria_list:
                     criterion_id = criterion.get("id")
@@ -89,7 +108,7 @@ async def summarize_entity_descriptions(
                 logger.info(f"Планирую обработку сущности {entity_id} в таблице {table_name}: {len(criteria_to_process)} критериев")
                 tasks.append(_update_entity_data(
                     data_dict, table_name, entity_id, criteria_to_process, 
-                    max_text_size, max_concurrent_requests, request_delay, retries
+                    max_text_size, max_concurrent_requests, request_delay, retries, batch
                 ))
     
     # Выполняем все задачи параллельно
@@ -97,11 +116,97 @@ async def summarize_entity_descriptions(
         logger.info(f"Запускаю параллельную обработку {len(tasks)} сущностей...")
         await asyncio.gather(*tasks)
         logger.info("Параллельная обработка сущностей завершена!")
+
+    if batch is not None:
+        logger.info(f"Батч суммирования сущностей: к отправке {len(batch['requests'])}, ожидается {len(batch['pending'])}")
+        await submit_batch("entity_summary", batch["requests"])
+        mark_batches_merged(batch["merged_batch_ids"], batch["merged_custom_ids"])
     
     return data_dict
 
 
-async def _update_entity_data(data_dict, table_name, entity_id, criteria_to_process, max_text_size, max_concurrent_requests, request_delay, retries):
+def _apply_batch_summary(entity_data, criterion_id, text):
+    """
+    Записывает суммированный текст из батча в критерий сущности и убирает из pending_texts
+    тексты, которые были отправлены в этот батч (batched_count). Тексты, добавленные
+    после отправки, остаются в pending_texts и уйдут в следующий батч.
+    """
+    for criterion in (entity_data or {}).get("criteria", []):
+        if str(criterion.get("id")) == str(criterion_id):
+            batched_count = criterion.pop("batched_count", 0)
+            criterion["pending_texts"] = criterion.get("pending_texts", [])[batched_count:]
+            if not criterion["pending_texts"]:
+                criterion.pop("pending_texts")
+            criterion["text"] = text
+            return True
+    return False
+
+
+async def _merge_batch_results(data_dict):
+    """
+    Забирает ответы завершившихся батчей стадии "entity_summary"
+    (custom_id = entity_summary|таблица|id сущности|id критерия) и записывает текст в критерии сущностей.
+    Сущности из data_dict обновляются в памяти (в БД они попадут на шаге загрузки),
+    остальные — сразу в таблице {table}_entities.
+
+    :return: Кортеж (ID батчей, обработанные custom_id) для mark_batches_merged после отправки новых запросов.
+    """
+    results, merged_batch_ids = await collect_batch_results("entity_summary")
+
+    for custom_id, result in results.items():
+        _, table_name, entity_id, criterion_id = parse_custom_id(custom_id)
+        text = parse_sum_response(result)
+        if not text:
+            continue
+
+        entities = data_dict.get(table_name, {}).get("entities", [])
+        entity = next((e for e in entities if str(e.get("id")) == entity_id), None)
+        if entity is not None:
+            _apply_batch_summary(entity.get("data"), criterion_id, text)
+            continue
+
+        with get_db_client() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT data FROM {table_name}_entities WHERE id = %s;", (entity_id,))
+                row = cur.fetchone()
+                if row and _apply_batch_summary(row[0], criterion_id, text):
+                    cur.execute(f"UPDATE {table_name}_entities SET data = %s WHERE id = %s;",
+                                (json.dumps(row[0]), entity_id))
+            conn.commit()
+
+    return merged_batch_ids, list(results)
+
+
+def _queue_batch_summary(batch, table_name, entity_id, criterion, new_texts, max_text_size):
+    """
+    Добавляет новые тексты критерия сущности в pending_texts и, если по этому критерию
+    нет незавершённого батча, отправляет текущий text + pending_texts на суммирование.
+    """
+    criterion["pending_texts"] = criterion.get("pending_texts", []) + new_texts
+    custom_id = make_custom_id("entity_summary", table_name, entity_id, criterion["id"])
+    if custom_id in batch["pending"]:
+        return
+
+    texts = [text for text in [criterion.get("text")] + criterion["pending_texts"] if text and text.strip()]
+    if len(texts) <= 1:
+        # Суммировать нечего — текст просто переносится в критерий
+        criterion["text"] = texts[0] if texts else ""
+        criterion.pop("pending_texts")
+        criterion.pop("batched_count", None)
+        return
+
+    criterion["batched_count"] = len(criterion["pending_texts"])
+    route = get_route(STAGE, portal=table_name)
+    batch["requests"].append({
+        "custom_id": custom_id,
+        "model": route["model"],
+        "params": route["params"],
+        "messages": build_sum_messages(texts, max_text_size),
+        "response_format": SUM_SCHEMA
+    })
+
+
+async def _update_entity_data(data_dict, table_name, entity_id, criteria_to_process, max_text_size, max_concurrent_requests, request_delay, retries, batch=None):
     """
     Обновляет данные сущности, суммируя критерии.
     
@@ -113,6 +218,7 @@ async def _update_entity_data(data_dict, table_name, entity_id, criteria_to_proc
     :param max_concurrent_requests: Максимальное количество параллельных запросов
     :param request_delay: Задержка между запросами в секундах
     :param retries: Количество повторных попыток при ошибке
+    :param batch: Состояние батча стадии (pending, requests) при use_batch=True, иначе None
     """
     
     # Получаем или создаем данные сущности в структуре table_data["entities"]
@@ -172,6 +278,17 @@ async def _update_entity_data(data_dict, table_name, entity_id, criteria_to_proc
             if instance_text:
                 text_eval_pairs.append((instance_text, instance_eval))
         
+        # Несрочный режим: оценка считается сразу, тексты суммируются через Batch API
+        if batch is not None and len(text_eval_pairs) > 1:
+            if existing_criterion is None:
+                existing_criterion = {"id": criterion_id, "text": ""}
+                existing_criteria.append(existing_criterion)
+            existing_criterion["name"] = criterion_definition.get("name", "")
+            existing_criterion["evaluation"] = calculate_evaluation(*(pair[1] for pair in text_eval_pairs))
+            new_texts = [instance.get("text") for instance in instances if instance.get("text")]
+            _queue_batch_summary(batch, table_name, entity_id, existing_criterion, new_texts, max_text_size)
+            continue
+
         # Если есть что суммировать
         if text_eval_pairs:
             if len(text_eval_pairs) == 1:
@@ -182,7 +299,7 @@ async def _update_entity_data(data_dict, table_name, entity_id, criteria_to_proc
                 # Суммируем через LLM с повторными попытками
                 for attempt in range(1, retries + 1):
                     try:
-                        result = await sum_text_blocks(text_eval_pairs, max_size=max_text_size)
+                        result = await sum_text_blocks(text_eval_pairs, max_size=max_text_size, portal=table_name)
                         final_text = result.get("text_result", "")
                         final_eval = result.get("evaluation_result")
                         logger.debug(f"[OK]   Entity={entity_id}, критерий={criterion_definition.get('name')!r}, попытка={attempt}")
@@ -1,17 +1,24 @@
 import asyncio
+from db_client import get_db_client
 from sum_texts import sum_text_blocks
+from llm_scheduler import (should_run_now, defer_job, fetch_deferred_jobs,
+                           complete_deferred_job)
 from logger_config import setup_logger
 
 # Настройка логгера для этого модуля
 logger = setup_logger('entity_summary_aggregator', 'logs/entity_summary_aggregator.log')
 
+# Стадия в llm_scheduler: несрочная, выполняется в скидочное окно DeepSeek
+STAGE = "entity_summary_aggregation"
+
 
 async def aggregate_entity_summaries(
     data_dict, 
     max_text_size=1000,
     max_concurrent_requests=50,
     request_delay=0.1,
-    retries=3
+    retries=3,
+    defer=False
 ):
     """
     Агрегирует поле summary для сущностей, суммируя summary из связанных записей 
@@ -30,8 +37,12 @@ async def aggregate_entity_summaries(
     :param max_concurrent_requests: Максимальное количество параллельных запросов к LLM
     :param request_delay: Задержка между запросами в секундах
     :param retries: Количество повторных попыток при ошибке
+    :param defer: Вне скидочного окна модели стадии не вызывать LLM, а ставить summary записей
+                  в очередь deferred_jobs (см. drain_deferred_aggregations)
     :return: Обновленный словарь с агрегированными summary для сущностей
     """
+    deferring = defer and not should_run_now(STAGE)
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
     
     # Создаем копию ключей для безопасной итерации
     table_names = list(data_dict.keys())
@@ -74,12 +85,19 @@ async def aggregate_entity_summaries(
                 if record_summary and record_summary.strip():
                     summaries_to_aggregate.append(record_summary.strip())
             
+            # Вне скидочного окна откладываем агрегацию: сущность сохраняет текущий (или первый) summary
+            if deferring and len(summaries_to_aggregate) > 1:
+                entity["summary"] = summaries_to_aggregate[0]
+                defer_job(STAGE, table_name, entity_id, summaries_to_aggregate[1:])
+                logger.info(f"Агрегация summary для сущности {entity_id} в таблице {table_name} отложена до скидочного окна")
+                continue
+
             # Если есть что агрегировать, добавляем задачу
             if len(summaries_to_aggregate) > 1:  # Только если больше одного summary
                 logger.info(f"Планирую агрегацию summary для сущности {entity_id} в таблице {table_name}: {len(summaries_to_aggregate)} summary")
                 tasks.append(_update_entity_summary(
                     entity, summaries_to_aggregate, 
-                    max_text_size, retries, request_delay
+                    max_text_size, retries, request_delay, semaphore
                 ))
             elif len(summaries_to_aggregate) == 1:
                 # Если только один summary, просто копируем его
@@ -95,7 +113,7 @@ async def aggregate_entity_summaries(
     return data_dict
 
 
-async def _update_entity_summary(entity, summaries_to_aggregate, max_text_size, retries, request_delay):
+async def _update_entity_summary(entity, summaries_to_aggregate, max_text_size, retries, request_delay, semaphore):
     """
     Обновляет summary сущности, агрегируя множественные summary через LLM.
     
@@ -104,12 +122,15 @@ async def _update_entity_summary(entity, summaries_to_aggregate, max_text_size,
     :param max_text_size: Максимальный размер текста для суммирования
     :param retries: Количество повторных попыток при ошибке
     :param request_delay: Задержка между запросами в секундах
+    :param semaphore: Семафор, ограничивающий число параллельных запросов к LLM
+    :return: True, если summary агрегированы через LLM; False, если все попытки неудачны
+             (тогда в сущности остаётся первый summary).
     """
     
     entity_id = entity.get("id")
     
     if len(summaries_to_aggregate) <= 1:
-        return
+        return True
     
     # Преобразуем summary в формат для sum_text_blocks (без оценок)
     text_eval_pairs = [(summary, None) for summary in summaries_to_aggregate]
@@ -117,13 +138,14 @@ async def _update_entity_summary(entity, summaries_to_aggregate, max_text_size,
     # Суммируем через LLM с повторными попытками
     for attempt in range(1, retries + 1):
         try:
-            result = await sum_text_blocks(text_eval_pairs, max_size=max_text_size)
+            async with semaphore:
+                result = await sum_text_blocks(text_eval_pairs, max_size=max_text_size, stage=STAGE)
             final_summary = result.get("text_result", "")
             
             # Обновляем summary сущности
             entity["summary"] = final_summary
             logger.info(f"[OK]   Entity={entity_id}, агрегация summary, попытка={attempt}")
-            break
+            return True
             
         except Exception as e:
             logger.warning(f"[ERR]  Entity={entity_id}, агрегация summary, попытка={attempt}: {e}")
@@ -133,6 +155,69 @@ async def _update_entity_summary(entity, summaries_to_aggregate, max_text_size,
                 logger.error(f"[FAIL] Entity={entity_id}, агрегация summary — исчерпаны все {retries} попыток")
                 # В случае неудачи оставляем первый summary или пустую строку
                 entity["summary"] = summaries_to_aggregate[0] if summaries_to_aggregate else ""
+    return False
+
+
+async def drain_deferred_aggregations(
+    max_text_size=1000,
+    max_concurrent_requests=500,
+    request_delay=0.1,
+    retries=3
+):
+    """
+    Выполняет отложенные агрегации summary сущностей, если сейчас открыто скидочное окно
+    модели стадии. Summary сущностей читаются и записываются напрямую в таблицы {table}_entities,
+    поэтому вызывать функцию нужно после загрузки итоговых данных цикла в БД.
+
+    :return: Количество выполненных задач.
+    """
+    if not should_run_now(STAGE):
+        return 0
+
+    jobs = fetch_deferred_jobs(STAGE)
+    if not jobs:
+        return 0
+
+    logger.info(f"Скидочное окно открыто: выполняю {len(jobs)} отложенных агрегаций summary")
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    # Загружаем текущие summary сущностей по порталам
+    entities = {}
+    for portal in {job["portal"] for job in jobs}:
+        entity_ids = [int(job["job_key"]) for job in jobs if job["portal"] == portal]
+        with get_db_client() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT id, summary FROM {portal}_entities WHERE id = ANY(%s);", (entity_ids,))
+                for entity_id, summary in cur.fetchall():
+                    entities[(portal, str(entity_id))] = {"id": entity_id, "summary": summary or ""}
+
+    async def run_job(job):
+        entity = entities.get((job["portal"], job["job_key"]))
+        if entity is None:
+            logger.warning(f"Сущность {job['portal']}/{job['job_key']} не найдена, задача удалена")
+            complete_deferred_job(STAGE, job)
+            return False
+
+        summaries = [text for text in [entity["summary"].strip()] + job["payload"] if text and text.strip()]
+        if len(summaries) > 1:
+            if not await _update_entity_summary(entity, summaries, max_text_size, retries, request_delay, semaphore):
+                # Задача остаётся в очереди: иначе отложенные summary записей были бы потеряны
+                logger.warning(f"Агрегация {job['portal']}/{job['job_key']} не удалась, задача остаётся в очереди")
+                return False
+        elif summaries:
+            entity["summary"] = summaries[0]
+
+        with get_db_client() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE {job['portal']}_entities SET summary = %s WHERE id = %s;",
+                            (entity["summary"], entity["id"]))
+            conn.commit()
+        complete_deferred_job(STAGE, job)
+        return True
+
+    completed = sum(await asyncio.gather(*(run_job(job) for job in jobs)))
+    logger.info(f"Отложенные агрегации summary выполнены: {completed} из {len(jobs)}")
+    return completed
 
 
 # Пример использования
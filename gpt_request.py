@@ -1,62 +1,141 @@
 import json
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 from llm_response_cleaner import clean_llm_content
+from llm_pricing import compute_cost, normalize_usage
+from llm_rate_limiter import get_rate_limiter
 
+# Лимиты пула HTTP-соединений асинхронного клиента (должны покрывать max_concurrent_requests стадий)
+MAX_CONNECTIONS = 500
+MAX_KEEPALIVE_CONNECTIONS = 500
 
-def request_gpt(model: str, messages: list) -> dict:
+# Клиенты создаются один раз на процесс и переиспользуют keep-alive соединения
+_client = None
+_async_client = None
+
+
+def get_client() -> OpenAI:
     """
-    Синхронная функция, делающая запрос к OpenAI.
-    Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
+    Возвращает синхронный клиент OpenAI, общий для всего процесса.
     """
-    load_dotenv()
-    client = OpenAI()
-    result = client.chat.completions.create(
-        model=model,
-        messages=messages
-    )
+    global _client
+    if _client is None:
+        load_dotenv()
+        _client = OpenAI()
+    return _client
+
+
+def get_async_client() -> AsyncOpenAI:
+    """
+    Возвращает асинхронный клиент OpenAI, общий для всего процесса.
+    Пул соединений рассчитан на MAX_CONNECTIONS одновременных запросов.
+    """
+    global _async_client
+    if _async_client is None:
+        load_dotenv()
+        _async_client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS
+                )
+            )
+        )
+    return _async_client
+
+
+def build_response_format(response_format: dict) -> dict:
+    """
+    Преобразует схему ответа {"name": ..., "schema": ...} в response_format OpenAI
+    (json_schema в строгом режиме: ответ модели гарантированно соответствует схеме).
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": response_format["name"], "schema": response_format["schema"], "strict": True}
+    }
+
+
+def _build_response(model: str, result, structured: bool = False) -> dict:
+    """
+    Извлекает ответ из результата chat.completions и рассчитывает стоимость запроса.
+    Возвращает словарь с очищенным контентом, стоимостью, моделью и usage (см. llm_pricing.normalize_usage).
+    Для запросов со схемой ответа (structured=True) контент не чистится, а сразу
+    разбирается в ключ "parsed".
+    """
+    message = result.choices[0].message
 
-    # Извлекаем сгенерированный ответ
-    answer = result.choices[0].message.content
+    # Рассчитываем стоимость по единой таблице тарифов
+    total_cost = compute_cost(model, result.usage)
+
+    if structured:
+        if getattr(message, "refusal", None):
+            raise Exception(f"Модель {model} отказалась отвечать: {message.refusal}")
+        return {"content": message.content, "parsed": json.loads(message.content), "cost": total_cost,
+                "model": model, "usage": normalize_usage(result.usage)}
 
     # Очищаем ответ (удаляем возможные обёртки ```json и т. п.)
-    answer = clean_llm_content(answer)
+    answer = clean_llm_content(message.content)
 
-    # Загрузка тарифов из файла llm_price.json
-    with open("llm_pricing.json", "r", encoding="utf-8") as f:
-        pricing = json.load(f)
+    return {"content": answer, "cost": total_cost, "model": model, "usage": normalize_usage(result.usage)}
 
-    # Извлекаем информацию о токенах из ответа API
-    prompt_tokens = result.usage.prompt_tokens
-    completion_tokens = result.usage.completion_tokens
-    cached_tokens = result.usage.prompt_tokens_details.cached_tokens
 
-    # Рассчитываем количество некэшированных prompt_tokens
-    non_cached_prompt_tokens = prompt_tokens - cached_tokens
+def build_generation_params(params: dict = None) -> dict:
+    """
+    Преобразует параметры генерации из таблицы маршрутов (см. llm_routing) в параметры chat.completions:
+    max_tokens -> max_completion_tokens, reasoning_effort и temperature передаются как есть.
+    """
+    params = params or {}
+    generation_params = {}
+    if params.get("max_tokens"):
+        generation_params["max_completion_tokens"] = params["max_tokens"]
+    for key in ("reasoning_effort", "temperature"):
+        if params.get(key) is not None:
+            generation_params[key] = params[key]
+    return generation_params
 
-    # Получаем тарифы для выбранной модели
-    model_pricing = pricing.get(model)
-    if not model_pricing:
-        raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
 
-    input_rate = model_pricing.get("1M input tokens")
-    cached_rate = model_pricing.get("1M cached** input tokens")
-    output_rate = model_pricing.get("1M output tokens")
+def _request_params(response_format: dict = None, params: dict = None) -> dict:
+    """
+    Дополнительные параметры chat.completions: схема ответа и параметры генерации.
+    """
+    request_params = build_generation_params(params)
+    if response_format:
+        request_params["response_format"] = build_response_format(response_format)
+    return request_params
 
-    if input_rate is None or cached_rate is None or output_rate is None:
-        raise Exception(f"Не указаны тарифы для входных, кэшированных или выходных "
-                        f"токенов для модели: {model}")
 
-    # Расчёт стоимости:
-    # Стоимость некэшированных prompt_tokens
-    cost_non_cached_prompt = (non_cached_prompt_tokens / 1_000_000) * input_rate
-    # Стоимость кэшированных prompt_tokens
-    cost_cached = (cached_tokens / 1_000_000) * cached_rate
-    # Стоимость output токенов
-    cost_output = (completion_tokens / 1_000_000) * output_rate
-    total_cost = cost_non_cached_prompt + cost_cached + cost_output
+def request_gpt(model: str, messages: list, response_format: dict = None, params: dict = None) -> dict:
+    """
+    Синхронная функция, делающая запрос к OpenAI.
+    Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
+    Если передана схема ответа response_format ({"name", "schema"}), в ответе есть ключ "parsed".
+    params — параметры генерации (см. build_generation_params).
+    """
+    result = get_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        **_request_params(response_format, params)
+    )
+    return _build_response(model, result, structured=bool(response_format))
 
-    return {"content": answer, "cost": total_cost}
+
+async def arequest_gpt(model: str, messages: list, response_format: dict = None, params: dict = None) -> dict:
+    """
+    Асинхронная функция, делающая запрос к OpenAI через общий AsyncOpenAI клиент.
+    Возвращает словарь с очищенным контентом и рассчитанной стоимостью.
+    Если передана схема ответа response_format ({"name", "schema"}), в ответе есть ключ "parsed".
+    params — параметры генерации (см. build_generation_params).
+    """
+    raw_response = await get_async_client().chat.completions.with_raw_response.create(
+        model=model,
+        messages=messages,
+        **_request_params(response_format, params)
+    )
+    # Передаём заголовки x-ratelimit-* общему ограничителю запросов
+    get_rate_limiter().update_from_headers(model, raw_response.headers)
+    result = raw_response.parse()
+    return _build_response(model, result, structured=bool(response_format))
 
 
 if __name__ == "__main__":
@@ -70,4 +149,4 @@ if __name__ == "__main__":
         ]
     )
 
-    print(completion)
\ No newline at end of file
+    print(completion)
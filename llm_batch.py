@@ -0,0 +1,271 @@
+import json
+from psycopg2.extras import execute_values
+from db_client import get_db_client
+from gpt_request import get_async_client, build_response_format, build_generation_params
+from llm_pricing import compute_cost
+from llm_response_cleaner import clean_llm_content
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_batch', 'logs/llm_batch.log')
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+MAX_REQUESTS_PER_BATCH = 50_000
+
+# Статусы батча, при которых его custom_id ещё ожидают результата
+OPEN_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+# Статусы, после которых у батча может быть выходной файл
+FINISHED_STATUSES = ("completed", "expired", "cancelled")
+
+CUSTOM_ID_SEPARATOR = "|"
+
+_table_ready = False
+
+
+def make_custom_id(stage: str, portal: str, *ids) -> str:
+    """
+    Формирует custom_id запроса батча, например 'criteria|advertpro|call_1|12'.
+    """
+    return CUSTOM_ID_SEPARATOR.join(str(part) for part in (stage, portal, *ids))
+
+
+def parse_custom_id(custom_id: str) -> list[str]:
+    """
+    Разбирает custom_id обратно на части [stage, portal, id1, id2, ...].
+    """
+    return custom_id.split(CUSTOM_ID_SEPARATOR)
+
+
+def ensure_batches_table():
+    """
+    Создаёт таблицы llm_batches (отправленные батчи) и llm_batch_results (ответы), если их ещё нет.
+    """
+    global _table_ready
+    if _table_ready:
+        return
+
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS llm_batches (
+                    id TEXT PRIMARY KEY,                  -- ID батча в OpenAI
+                    stage TEXT NOT NULL,                  -- Стадия анализа (criteria, classification, ...)
+                    model TEXT NOT NULL,                  -- Модель, для которой считается стоимость
+                    status TEXT NOT NULL,                 -- Статус батча в OpenAI или merged
+                    input_file_id TEXT,
+                    output_file_id TEXT,
+                    custom_ids JSONB NOT NULL,            -- Список custom_id запросов батча
+                    created_at TIMESTAMP DEFAULT now(),
+                    updated_at TIMESTAMP DEFAULT now()
+                );
+                CREATE INDEX IF NOT EXISTS idx_llm_batches_stage_status ON llm_batches(stage, status);
+
+                CREATE TABLE IF NOT EXISTS llm_batch_results (
+                    batch_id TEXT NOT NULL REFERENCES llm_batches(id) ON DELETE CASCADE,
+                    custom_id TEXT NOT NULL,
+                    content TEXT,
+                    cost DOUBLE PRECISION,
+                    PRIMARY KEY (batch_id, custom_id)
+                );
+            """)
+        conn.commit()
+    _table_ready = True
+
+
+def _build_jsonl(requests: list[dict]) -> bytes:
+    """
+    Формирует JSONL для Batch API из списка {"custom_id", "model", "messages",
+    "response_format" (необязательно), "params" (необязательно, см. llm_routing.get_route)}.
+    """
+    lines = []
+    for request in requests:
+        body = {"model": request["model"], "messages": request["messages"],
+                **build_generation_params(request.get("params"))}
+        if request.get("response_format"):
+            body["response_format"] = build_response_format(request["response_format"])
+        lines.append(json.dumps({
+            "custom_id": request["custom_id"],
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": body
+        }, ensure_ascii=False))
+    return "\n".join(lines).encode("utf-8")
+
+
+async def submit_batch(stage: str, requests: list[dict]) -> list[str]:
+    """
+    Отправляет запросы стадии в OpenAI Batch API и сохраняет ID батчей в БД.
+    Запросы группируются по модели и режутся на батчи по MAX_REQUESTS_PER_BATCH.
+
+    :param stage: Название стадии (criteria, classification, entity_summary).
+    :param requests: Список словарей {"custom_id", "model", "messages", "response_format" и "params" (необязательно)}.
+    :return: Список ID созданных батчей.
+    """
+    if not requests:
+        return []
+
+    ensure_batches_table()
+    client = get_async_client()
+
+    by_model = {}
+    for request in requests:
+        if not request["model"].startswith("gpt-"):
+            raise Exception(f"Модель {request['model']} не поддерживает Batch API.")
+        by_model.setdefault(request["model"], []).append(request)
+
+    batch_ids = []
+    for model, model_requests in by_model.items():
+        for start in range(0, len(model_requests), MAX_REQUESTS_PER_BATCH):
+            chunk = model_requests[start:start + MAX_REQUESTS_PER_BATCH]
+
+            uploaded_file = await client.files.create(
+                file=(f"{stage}_batch.jsonl", _build_jsonl(chunk)),
+                purpose="batch"
+            )
+            batch = await client.batches.create(
+                input_file_id=uploaded_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=COMPLETION_WINDOW,
+                metadata={"stage": stage}
+            )
+
+            with get_db_client() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO llm_batches (id, stage, model, status, input_file_id, custom_ids)
+                        VALUES (%s, %s, %s, %s, %s, %s);
+                    """, (batch.id, stage, model, batch.status, uploaded_file.id,
+                          json.dumps([request["custom_id"] for request in chunk])))
+                conn.commit()
+
+            batch_ids.append(batch.id)
+            logger.info(f"Стадия {stage}: отправлен батч {batch.id} ({len(chunk)} запросов, модель {model})")
+
+    return batch_ids
+
+
+def _parse_output(text: str, model: str) -> list[tuple]:
+    """
+    Разбирает выходной JSONL батча в список (custom_id, content, cost) для успешных запросов.
+    """
+    results = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        obj = json.loads(line)
+        response = obj.get("response") or {}
+        if obj.get("error") or response.get("status_code") != 200:
+            logger.warning(f"Запрос {obj.get('custom_id')} в батче завершился ошибкой: {obj.get('error')}")
+            continue
+        body = response["body"]
+        content = clean_llm_content(body["choices"][0]["message"]["content"])
+        cost = compute_cost(model, body.get("usage"), batch=True)
+        results.append((obj["custom_id"], content, cost))
+    return results
+
+
+async def poll_batches(stage: str):
+    """
+    Проверяет статусы незавершённых батчей стадии (без ожидания) и сохраняет ответы
+    завершившихся батчей в llm_batch_results. Вызывается один раз за цикл сервиса.
+    """
+    ensure_batches_table()
+    client = get_async_client()
+
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, model FROM llm_batches WHERE stage = %s AND status = ANY(%s);",
+                        (stage, list(OPEN_STATUSES)))
+            open_batches = cur.fetchall()
+
+    for batch_id, model in open_batches:
+        batch = await client.batches.retrieve(batch_id)
+        results = []
+        if batch.status in FINISHED_STATUSES and batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            results = _parse_output(output.text, model)
+
+        with get_db_client() as conn:
+            with conn.cursor() as cur:
+                if results:
+                    execute_values(cur, """
+                        INSERT INTO llm_batch_results (batch_id, custom_id, content, cost) VALUES %s
+                        ON CONFLICT (batch_id, custom_id) DO NOTHING;
+                    """, [(batch_id, custom_id, content, cost) for custom_id, content, cost in results])
+                cur.execute("""
+                    UPDATE llm_batches SET status = %s, output_file_id = %s, updated_at = now() WHERE id = %s;
+                """, (batch.status, batch.output_file_id, batch_id))
+            conn.commit()
+
+        if batch.status in FINISHED_STATUSES or batch.status == "failed":
+            logger.info(f"Стадия {stage}: батч {batch_id} завершён со статусом {batch.status}, ответов {len(results)}")
+
+
+async def collect_batch_results(stage: str) -> tuple[dict, list[str]]:
+    """
+    Обновляет статусы батчей стадии и возвращает ещё не слитые ответы.
+
+    :return: Кортеж (results, batch_ids), где results — {custom_id: {"content", "cost", "model"}},
+             batch_ids — батчи, которые нужно передать в mark_batches_merged вместе с обработанными custom_id.
+    """
+    await poll_batches(stage)
+
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT b.id, b.model, r.custom_id, r.content, r.cost
+                FROM llm_batches b
+                LEFT JOIN llm_batch_results r ON r.batch_id = b.id
+                WHERE b.stage = %s AND b.status = ANY(%s);
+            """, (stage, list(FINISHED_STATUSES)))
+            rows = cur.fetchall()
+
+    results = {}
+    batch_ids = set()
+    for batch_id, model, custom_id, content, cost in rows:
+        batch_ids.add(batch_id)
+        if custom_id is not None:
+            results[custom_id] = {"content": content, "cost": cost, "model": model}
+
+    return results, list(batch_ids)
+
+
+def get_pending_custom_ids(stage: str) -> set[str]:
+    """
+    Возвращает custom_id запросов стадии, которые ещё выполняются в незавершённых батчах.
+    """
+    ensure_batches_table()
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT custom_ids FROM llm_batches WHERE stage = %s AND status = ANY(%s);",
+                        (stage, list(OPEN_STATUSES)))
+            rows = cur.fetchall()
+
+    pending = set()
+    for (custom_ids,) in rows:
+        pending.update(custom_ids)
+    return pending
+
+
+def mark_batches_merged(batch_ids: list[str], custom_ids):
+    """
+    Удаляет из llm_batch_results ответы батчей batch_ids только для custom_ids — запросов, ответы которых
+    обработаны в этом цикле. Ответы записей, не попавших в цикл, остаются и будут применены позже
+    (иначе записи ушли бы в новый батч и были бы оплачены повторно). Батч помечается слитым,
+    когда у него не осталось ответов.
+    """
+    if not batch_ids:
+        return
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM llm_batch_results WHERE batch_id = ANY(%s) AND custom_id = ANY(%s);",
+                        (batch_ids, list(custom_ids)))
+            cur.execute("""
+                UPDATE llm_batches b SET status = 'merged', updated_at = now()
+                WHERE b.id = ANY(%s)
+                  AND NOT EXISTS (SELECT 1 FROM llm_batch_results r WHERE r.batch_id = b.id);
+            """, (batch_ids,))
+            merged = cur.rowcount
+        conn.commit()
+    logger.info(f"Слито батчей: {merged} из {len(batch_ids)}")
@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_cache', 'logs/llm_cache.log')
+
+# Параметры кэша (можно переопределить через переменные окружения)
+CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "llm_cache.sqlite3")
+)
+CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))             # Время жизни записи в секундах
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 200_000))  # Максимальное число записей
+EVICTION_INTERVAL = 1000                                                # Проверять вытеснение раз в N записей
+ACCESS_FLUSH_SIZE = 200                                                 # Сохранять время обращений раз в N попаданий
+
+# Ключи ответа get_or_request с результатом проверки accept (см. accepted_result)
+ACCEPTED_KEY = "accepted"
+ACCEPT_ERROR_KEY = "accept_error"
+
+
+def make_cache_key(model: str, messages: list, params: dict = None) -> str:
+    """
+    Возвращает sha256 от канонического JSON-представления (model, messages, params).
+    """
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params or {}},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def accepted_result(response: dict, parse):
+    """
+    Возвращает результат проверки accept, уже выполненной в LLMCache.get_or_request (ключи убираются из ответа),
+    чтобы parse с побочными эффектами не вызывался дважды. Если проверка отвергла ответ, её исключение
+    выбрасывается повторно; если ответ не проверялся (кэш выключен, ответ дублирующего запроса) — вызывается parse.
+    """
+    if ACCEPT_ERROR_KEY in response:
+        raise response.pop(ACCEPT_ERROR_KEY)
+    if ACCEPTED_KEY in response:
+        return response.pop(ACCEPTED_KEY)
+    return parse(response)
+
+
+def is_cacheable(response: dict) -> bool:
+    """
+    Кэшируются только ответы, чей content является корректным JSON:
+    все стадии просят у модели JSON, а некорректный ответ при повторной попытке
+    должен уйти к провайдеру заново, а не вернуться из кэша.
+    """
+    try:
+        json.loads(response.get("content"))
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+class LLMCache:
+    """
+    Дисковый кэш ответов LLM на SQLite с вытеснением по TTL и количеству записей
+    и с объединением одинаковых одновременных запросов (single-flight).
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttl: int = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "deduplicated": 0, "stored": 0, "evicted": 0}
+
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._writes_since_eviction = 0
+        # Время последнего обращения к записям {key: accessed_at}; пишется в БД пачкой (см. _flush_access)
+        self._pending_access = {}
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed_at ON llm_cache(accessed_at);")
+        self._conn.commit()
+
+    def get(self, key: str) -> dict | None:
+        """
+        Возвращает сохранённый ответ или None, если записи нет или её TTL истёк.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM llm_cache WHERE key = ?;", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?;", (key,))
+                self._conn.commit()
+                return None
+            self._pending_access[key] = now
+            if len(self._pending_access) >= ACCESS_FLUSH_SIZE:
+                self._flush_access()
+                self._conn.commit()
+        return json.loads(row[0])
+
+    def _flush_access(self):
+        """
+        Записывает накопленное время обращений одним executemany (без commit). Вызывается под self._lock.
+        """
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE llm_cache SET accessed_at = ? WHERE key = ?;",
+                [(accessed_at, key) for key, accessed_at in self._pending_access.items()]
+            )
+            self._pending_access = {}
+
+    def delete(self, key: str):
+        """
+        Удаляет запись (например, ответ, который вызывающий код отверг при проверке).
+        """
+        with self._lock:
+            self._pending_access.pop(key, None)
+            if self._conn.execute("DELETE FROM llm_cache WHERE key = ?;", (key,)).rowcount:
+                self._conn.commit()
+                logger.info(f"Из кэша LLM удалён отвергнутый ответ {key[:12]}")
+
+    def set(self, key: str, response: dict):
+        """
+        Сохраняет ответ и периодически запускает вытеснение.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?);",
+                (key, json.dumps(response, ensure_ascii=False), now, now)
+            )
+            self._pending_access.pop(key, None)
+            self._flush_access()
+            self._conn.commit()
+            self.stats["stored"] += 1
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= EVICTION_INTERVAL:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        """
+        Удаляет просроченные записи и самые давно использованные сверх max_entries.
+        Вызывается под self._lock.
+        """
+        self._writes_since_eviction = 0
+        self._flush_access()
+        deleted = self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?;", (now - self.ttl,)).rowcount
+        count = self._conn.execute("SELECT COUNT(*) FROM llm_cache;").fetchone()[0]
+        if count > self.max_entries:
+            deleted += self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY accessed_at ASC LIMIT ?);",
+                (count - self.max_entries,)
+            ).rowcount
+        self._conn.commit()
+        self.stats["evicted"] += deleted
+        if deleted:
+            logger.info(f"Из кэша LLM вытеснено {deleted} записей")
+
+    def lookup(self, key: str) -> dict | None:
+        """
+        Синхронный поиск в кэше с учётом счётчиков попаданий/промахов.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return {**cached, "cost": 0.0, "cache_hit": True}
+        self.stats["misses"] += 1
+        return None
+
+    def store(self, key: str, response: dict) -> bool:
+        """
+        Сохраняет ответ, если он подходит для кэширования.
+
+        :return: True, если ответ сохранён.
+        """
+        if not is_cacheable(response):
+            return False
+        self.set(key, response)
+        return True
+
+    @staticmethod
+    def _check(accept, response: dict) -> dict:
+        """
+        Выполняет проверку accept(response) и возвращает копию ответа с её результатом (ACCEPTED_KEY)
+        или исключением (ACCEPT_ERROR_KEY), см. accepted_result.
+        """
+        try:
+            return {**response, ACCEPTED_KEY: accept(response)}
+        except Exception as e:
+            return {**response, ACCEPT_ERROR_KEY: e}
+
+    async def get_or_request(self, key: str, request_factory, accept=None) -> dict:
+        """
+        Возвращает ответ из кэша либо выполняет request_factory().
+        Одинаковые одновременные запросы ждут результата первого (single-flight),
+        повторно к провайдеру они не уходят. Новый ответ сохраняется, только если его принимает accept
+        (исключение — ответ отвергнут и в кэш не попадает, иначе повторная попытка получила бы тот же ответ).
+        accept выполняется один раз в цикле событий, его результат возвращается вместе с ответом
+        (см. accepted_result). Работа с SQLite выполняется в отдельном потоке, чтобы не блокировать цикл событий.
+        """
+        cached = await asyncio.to_thread(self.lookup, key)
+        if cached is not None:
+            if accept is None:
+                return cached
+            checked = self._check(accept, cached)
+            if ACCEPT_ERROR_KEY not in checked:
+                return checked
+            # Ответ, сохранённый до появления проверки, больше не проходит её — запрашиваем заново
+            await asyncio.to_thread(self.delete, key)
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats["deduplicated"] += 1
+            try:
+                response = await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Если отменили первый запрос, а не нас самих, выполняем запрос заново
+                if inflight.cancelled():
+                    return await self.get_or_request(key, request_factory, accept)
+                raise
+            return {**response, "cost": 0.0, "cache_hit": True}
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await request_factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие запросы; помечаем его как обработанное
+            future.exception()
+            raise
+        else:
+            future.set_result(response)
+            checked = response if accept is None else self._check(accept, response)
+            if ACCEPT_ERROR_KEY not in checked:
+                await asyncio.to_thread(self.store, key, response)
+            return checked
+        finally:
+            self._inflight.pop(key, None)
+
+
+_cache = None
+
+
+def get_llm_cache() -> LLMCache | None:
+    """
+    Возвращает общий для процесса кэш или None, если кэш выключен (LLM_CACHE_ENABLED=0).
+    """
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = LLMCache()
+    return _cache
+
+
+def get_cache_stats() -> dict:
+    """
+    Возвращает счётчики кэша: hits, misses, deduplicated, stored, evicted.
+    """
+    if _cache is None:
+        return {"hits": 0, "misses": 0, "deduplicated": 0, "stored": 0, "evicted": 0}
+    return dict(_cache.stats)
@@ -0,0 +1,139 @@
+import asyncio
+from collections import deque
+from llm_pricing import compute_cost
+from llm_tokens import fits
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_hedging', 'logs/llm_hedging.log')
+
+# Сколько последних задержек модели хранить для расчёта p95
+LATENCY_WINDOW = 500
+# Пока задержек меньше, p95 не считается и дублирующие запросы не отправляются
+MIN_LATENCY_SAMPLES = 20
+HEDGE_PERCENTILE = 0.95
+
+# Равноценные модели других провайдеров, на которые уходит дублирующий запрос (в том числе для моделей
+# из таблицы маршрутов llm_routing.json). Модели без пары не хеджируются: дубль в ту же модель при медленном
+# провайдере только добавляет расходы, не сокращая хвост задержек.
+HEDGE_ALTERNATIVES = {
+    "gpt-4o-mini": "deepseek-chat",
+    "deepseek-chat": "gpt-4o-mini",
+    "gpt-4o": "claude-3-5-sonnet-20241022",
+    "claude-3-5-sonnet-20241022": "gpt-4o",
+    "gpt-5-nano": "deepseek-chat",
+    "gpt-5-mini": "deepseek-chat",
+    "gpt-5": "claude-3-5-sonnet-20241022",
+}
+
+# Бюджеты стадий на дублирующие запросы (сбрасываются каждый цикл сервиса через reset_hedge_budgets):
+#   max_extra_cost — максимум дополнительных расходов в долларах;
+#   max_hedge_ratio — максимальная доля запросов стадии, которые можно продублировать.
+HEDGE_BUDGETS = {
+    "classification": {"max_extra_cost": 0.5, "max_hedge_ratio": 0.1},
+    "criteria": {"max_extra_cost": 1.0, "max_hedge_ratio": 0.1},
+}
+
+_latencies = {}
+_budgets = {}
+
+
+def record_latency(model: str, seconds: float):
+    """
+    Запоминает задержку запроса к модели: успешного или отменённого (проигравший при хеджировании запрос
+    записывается с временем до отмены — это нижняя граница его задержки; без неё p95 смещался бы вниз
+    и дубли отправлялись бы всё чаще).
+    """
+    _latencies.setdefault(model, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+def get_hedge_delay(model: str) -> float | None:
+    """
+    Возвращает p95 задержки модели или None, если данных пока недостаточно.
+    """
+    latencies = _latencies.get(model)
+    if not latencies or len(latencies) < MIN_LATENCY_SAMPLES:
+        return None
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE))]
+
+
+def _get_budget(stage: str) -> dict:
+    return _budgets.setdefault(stage, {"requests": 0, "hedges": 0, "extra_cost": 0.0})
+
+
+def _try_reserve(stage: str, estimated_cost: float) -> bool:
+    """
+    Проверяет бюджет стадии и, если дубль укладывается в него, резервирует estimated_cost.
+    """
+    limits = HEDGE_BUDGETS.get(stage)
+    if limits is None:
+        return False
+    budget = _get_budget(stage)
+    if budget["hedges"] + 1 > budget["requests"] * limits["max_hedge_ratio"]:
+        return False
+    if budget["extra_cost"] + estimated_cost > limits["max_extra_cost"]:
+        return False
+    budget["hedges"] += 1
+    budget["extra_cost"] += estimated_cost
+    return True
+
+
+def reset_hedge_budgets() -> dict:
+    """
+    Сбрасывает бюджеты стадий и возвращает статистику за прошедший период:
+    {stage: {"requests", "hedges", "extra_cost"}}.
+    """
+    global _budgets
+    stats, _budgets = _budgets, {}
+    return stats
+
+
+async def hedged_request(request_factory, model: str, stage: str, estimate: tuple) -> dict:
+    """
+    Выполняет запрос request_factory(model) с хеджированием: если ответа нет дольше p95 задержки
+    модели, отправляет дубль в HEDGE_ALTERNATIVES[model] и возвращает первый успешный ответ, отменяя
+    второй запрос. Дубль отправляется, только если у модели есть альтернатива и он укладывается
+    в бюджет стадии HEDGE_BUDGETS и в окно контекста альтернативной модели.
+
+    :param request_factory: Функция model -> корутина запроса.
+    :param estimate: Оценка (входные, выходные) токенов из llm_tokens.plan_request.
+    """
+    alt_model = HEDGE_ALTERNATIVES.get(model)
+    if alt_model is None:
+        return await request_factory(model)
+
+    _get_budget(stage)["requests"] += 1
+    primary = asyncio.create_task(request_factory(model))
+    pending = {primary}
+    try:
+        delay = get_hedge_delay(model)
+        if delay is None:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        input_tokens, output_tokens = estimate
+        estimated_cost = compute_cost(alt_model, {"input_tokens": input_tokens, "output_tokens": output_tokens})
+        if not fits(alt_model, input_tokens, output_tokens) or not _try_reserve(stage, estimated_cost):
+            return await primary
+
+        logger.info(f"Стадия {stage}: запрос к {model} дольше p95 ({delay:.1f} с), дублирую в {alt_model}")
+        hedge = asyncio.create_task(request_factory(alt_model))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        logger.info(f"Стадия {stage}: дубль в {alt_model} ответил первым")
+                    return task.result()
+        # Оба запроса завершились ошибкой — отдаём ошибку основного
+        return primary.result()
+    finally:
+        # Проигравший (или брошенный при отмене) запрос отменяется
+        for task in pending:
+            if not task.done():
+                task.cancel()
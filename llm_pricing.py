@@ -0,0 +1,204 @@
+import json
+import os
+from datetime import datetime, time, timezone
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_pricing', 'logs/llm_pricing.log')
+
+PRICING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_pricing.json")
+
+# Варианты названий тарифов в llm_pricing.json (у каждого провайдера своя схема ключей)
+INPUT_KEYS = ("1M input tokens", "1M TOKENS INPUT (CACHE MISS)", "input_tokens")
+CACHED_INPUT_KEYS = ("1M cached** input tokens", "1M TOKENS INPUT (CACHE HIT)", "cached_input_tokens")
+OUTPUT_KEYS = ("1M output tokens", "1M TOKENS OUTPUT", "output_tokens")
+
+# Множитель стоимости запросов, выполненных через OpenAI Batch API
+BATCH_DISCOUNT = 0.5
+
+# Нормализованная таблица тарифов и mtime файла, из которого она загружена
+_pricing = {}
+_pricing_mtime = None
+
+
+def _first_present(model_pricing: dict, keys: tuple):
+    """
+    Возвращает значение первого найденного ключа из keys или None.
+    """
+    for key in keys:
+        if model_pricing.get(key) is not None:
+            return model_pricing[key]
+    return None
+
+
+def parse_discount_window(discount_time_str: str) -> tuple[time, time] | None:
+    """
+    Разбирает строку скидочного окна формата 'UTC HH:MM-HH:MM' (например, 'UTC 16:30-00:30').
+    Возвращает кортеж (start, end) или None, если строка не распознана.
+    """
+    # Сначала отбросим префикс 'UTC ' и получим '16:30-00:30'
+    if not discount_time_str or not discount_time_str.startswith("UTC "):
+        return None
+
+    time_range_str = discount_time_str.split("UTC ")[1]
+    try:
+        start_str, end_str = time_range_str.split("-")
+        start_h, start_m = map(int, start_str.split(":"))
+        end_h, end_m = map(int, end_str.split(":"))
+    except ValueError:
+        return None
+
+    return time(hour=start_h, minute=start_m), time(hour=end_h, minute=end_m)
+
+
+def _normalize(model: str, model_pricing: dict) -> dict:
+    """
+    Приводит тариф модели к единой схеме:
+    {"input": ..., "cached_input": ..., "output": ..., "discount_window": (start, end) | None, "discount": ...}
+    Все ставки указаны в долларах за 1M токенов.
+    """
+    input_rate = _first_present(model_pricing, INPUT_KEYS)
+    cached_rate = _first_present(model_pricing, CACHED_INPUT_KEYS)
+    output_rate = _first_present(model_pricing, OUTPUT_KEYS)
+
+    if input_rate is None or output_rate is None:
+        raise Exception(f"Не указаны тарифы для входных или выходных токенов для модели: {model}")
+
+    discount_window = parse_discount_window(model_pricing.get("DISCOUNT TIME"))
+    discount = model_pricing.get("DISCOUNT")
+
+    return {
+        "input": float(input_rate),
+        # Если тариф на кэшированные токены не указан, считаем их по обычной цене
+        "cached_input": float(cached_rate) if cached_rate is not None else float(input_rate),
+        "output": float(output_rate),
+        "discount_window": discount_window if discount is not None else None,
+        "discount": float(discount) if discount is not None else None
+    }
+
+
+def get_pricing() -> dict:
+    """
+    Возвращает нормализованную таблицу тарифов {model: {...}}.
+    Файл llm_pricing.json перечитывается только при изменении его mtime.
+    """
+    global _pricing, _pricing_mtime
+
+    mtime = os.stat(PRICING_PATH).st_mtime
+    if mtime != _pricing_mtime:
+        with open(PRICING_PATH, "r", encoding="utf-8") as f:
+            raw_pricing = json.load(f)
+        _pricing = {model: _normalize(model, model_pricing) for model, model_pricing in raw_pricing.items()}
+        _pricing_mtime = mtime
+        logger.info(f"Загружены тарифы для {len(_pricing)} моделей из {PRICING_PATH}")
+
+    return _pricing
+
+
+def get_model_pricing(model: str) -> dict:
+    """
+    Возвращает нормализованный тариф модели или выбрасывает исключение, если модели нет в таблице.
+    """
+    model_pricing = get_pricing().get(model)
+    if not model_pricing:
+        raise Exception(f"Отсутствует информация о стоимости для модели: {model}")
+    return model_pricing
+
+
+def is_in_discount_time(model: str, now: datetime = None) -> bool:
+    """
+    Проверяет, попадает ли момент now (по умолчанию текущее время UTC) в скидочное окно модели.
+    Для моделей без скидочного окна возвращает False.
+    """
+    discount_window = get_model_pricing(model)["discount_window"]
+    if discount_window is None:
+        return False
+
+    start_time, end_time = discount_window
+    now_utc = (now or datetime.now(timezone.utc)).astimezone(timezone.utc).time()
+
+    if start_time < end_time:
+        return start_time <= now_utc < end_time
+    else:
+        # Интервал переходит через полночь
+        return (now_utc >= start_time) or (now_utc < end_time)
+
+
+def _usage_value(usage, name: str) -> int:
+    """
+    Достаёт поле usage как из объекта SDK, так и из словаря (например, из ответа Batch API).
+    """
+    if usage is None:
+        return 0
+    value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+    return value or 0
+
+
+def normalize_usage(usage) -> dict:
+    """
+    Приводит usage любого провайдера к виду
+    {"input_tokens": некэшированные входные, "cached_tokens": кэшированные входные, "output_tokens": выходные}.
+
+    Поддерживаются схемы:
+      - OpenAI: prompt_tokens, completion_tokens, prompt_tokens_details.cached_tokens;
+      - DeepSeek: prompt_cache_hit_tokens, prompt_cache_miss_tokens, completion_tokens;
+      - Anthropic: input_tokens, output_tokens, cache_read_input_tokens, cache_creation_input_tokens.
+    """
+    # DeepSeek сообщает кэшированные и некэшированные входные токены отдельно
+    if _usage_value(usage, "prompt_cache_hit_tokens") or _usage_value(usage, "prompt_cache_miss_tokens"):
+        return {
+            "input_tokens": _usage_value(usage, "prompt_cache_miss_tokens"),
+            "cached_tokens": _usage_value(usage, "prompt_cache_hit_tokens"),
+            "output_tokens": _usage_value(usage, "completion_tokens")
+        }
+
+    # OpenAI: cached_tokens входят в prompt_tokens
+    if _usage_value(usage, "prompt_tokens"):
+        details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = _usage_value(details, "cached_tokens")
+        return {
+            "input_tokens": _usage_value(usage, "prompt_tokens") - cached_tokens,
+            "cached_tokens": cached_tokens,
+            "output_tokens": _usage_value(usage, "completion_tokens")
+        }
+
+    # Anthropic: input_tokens не включают чтение из кэша, запись в кэш тарифицируется как обычный вход
+    return {
+        "input_tokens": _usage_value(usage, "input_tokens") + _usage_value(usage, "cache_creation_input_tokens"),
+        "cached_tokens": _usage_value(usage, "cache_read_input_tokens"),
+        "output_tokens": _usage_value(usage, "output_tokens")
+    }
+
+
+def compute_cost(model: str, usage, now: datetime = None, batch: bool = False) -> float:
+    """
+    Рассчитывает стоимость запроса в долларах по usage любого провайдера.
+    Если момент now попадает в скидочное окно модели (DISCOUNT TIME), применяется множитель DISCOUNT.
+    Для запросов через Batch API (batch=True) применяется множитель BATCH_DISCOUNT.
+    """
+    model_pricing = get_model_pricing(model)
+    tokens = normalize_usage(usage)
+
+    # Стоимость некэшированных входных токенов
+    cost_input = (tokens["input_tokens"] / 1_000_000) * model_pricing["input"]
+    # Стоимость кэшированных входных токенов
+    cost_cached = (tokens["cached_tokens"] / 1_000_000) * model_pricing["cached_input"]
+    # Стоимость output токенов
+    cost_output = (tokens["output_tokens"] / 1_000_000) * model_pricing["output"]
+    total_cost = cost_input + cost_cached + cost_output
+
+    if model_pricing["discount"] is not None and is_in_discount_time(model, now):
+        total_cost *= model_pricing["discount"]
+
+    if batch:
+        total_cost *= BATCH_DISCOUNT
+
+    return total_cost
+
+
+if __name__ == "__main__":
+    print(compute_cost("gpt-4o", {"prompt_tokens": 1000, "completion_tokens": 500,
+                                  "prompt_tokens_details": {"cached_tokens": 200}}))
+    print(compute_cost("deepseek-chat", {"prompt_cache_hit_tokens": 200, "prompt_cache_miss_tokens": 800,
+                                         "completion_tokens": 500}))
+    print(compute_cost("claude-3-5-sonnet-20241022", {"input_tokens": 1000, "output_tokens": 500}))
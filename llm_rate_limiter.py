@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+import re
+import time
+from llm_tokens import LIMITS_PATH, count_message_tokens
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_rate_limiter', 'logs/llm_rate_limiter.log')
+
+# Лимиты для моделей, отсутствующих в llm_limits.json
+DEFAULT_RPM = 500
+DEFAULT_TPM = 200_000
+
+# Пауза после 429 без заголовка retry-after
+DEFAULT_RETRY_AFTER = 1.0
+
+
+def get_provider(model: str) -> str:
+    """
+    Возвращает имя провайдера по названию модели.
+    """
+    if model.startswith("gpt-"):
+        return "openai"
+    elif model.startswith("deepseek-"):
+        return "deepseek"
+    elif model.startswith("claude-"):
+        return "anthropic"
+    return "unknown"
+
+
+def _parse_duration(value: str) -> float | None:
+    """
+    Разбирает длительность из заголовков провайдера: '1s', '6m0s', '20ms', '0.5' (секунды).
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        matched = True
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total if matched else None
+
+
+def _header(headers, *names):
+    """
+    Возвращает значение первого найденного заголовка из names или None.
+    """
+    if not headers:
+        return None
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            return value
+    return None
+
+
+class TokenBucket:
+    """
+    Два ведра (запросы и токены в минуту) для одной пары провайдер/модель.
+    Ёмкость ведра равна минутному лимиту, пополнение идёт равномерно.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.blocked_until = 0.0
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        """
+        Ждёт, пока в ведрах появится один запрос и tokens токенов, и списывает их.
+        Ожидающие обслуживаются по очереди (FIFO), поэтому ни одна стадия не голодает.
+        """
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                now = time.monotonic()
+                if self.blocked_until > now:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait_requests = (1 - self.requests) * 60 / self.rpm if self.requests < 1 else 0
+                wait_tokens = (tokens - self.tokens) * 60 / self.tpm if self.tokens < tokens else 0
+                await asyncio.sleep(max(wait_requests, wait_tokens, 0.01))
+
+    def update_from_headers(self, headers):
+        """
+        Подстраивает лимиты и остатки по заголовкам x-ratelimit-* (OpenAI, DeepSeek)
+        и anthropic-ratelimit-* (Anthropic).
+        """
+        limit_requests = _header(headers, "x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit")
+        limit_tokens = _header(headers, "x-ratelimit-limit-tokens", "anthropic-ratelimit-tokens-limit")
+        remaining_requests = _header(headers, "x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining")
+        remaining_tokens = _header(headers, "x-ratelimit-remaining-tokens", "anthropic-ratelimit-tokens-remaining")
+
+        self._refill()
+        try:
+            if limit_requests is not None and int(limit_requests) != self.rpm:
+                self.rpm = int(limit_requests)
+                logger.info(f"{self.name}: лимит запросов по заголовкам провайдера — {self.rpm} RPM")
+            if limit_tokens is not None and int(limit_tokens) != self.tpm:
+                self.tpm = int(limit_tokens)
+                logger.info(f"{self.name}: лимит токенов по заголовкам провайдера — {self.tpm} TPM")
+            # Провайдер знает об остатке лучше нас: не даём ведру быть полнее, чем он сообщает
+            if remaining_requests is not None:
+                self.requests = min(self.requests, float(remaining_requests))
+            if remaining_tokens is not None:
+                self.tokens = min(self.tokens, float(remaining_tokens))
+        except ValueError:
+            pass
+
+    def penalize(self, headers):
+        """
+        Реакция на ответ 429: блокирует ведро на retry-after секунд и обнуляет остатки.
+        """
+        retry_after = _parse_duration(_header(headers, "retry-after", "x-ratelimit-reset-requests",
+                                              "x-ratelimit-reset-tokens"))
+        if retry_after is None:
+            retry_after = DEFAULT_RETRY_AFTER
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.requests = 0.0
+        self.tokens = 0.0
+        logger.warning(f"{self.name}: получен 429, пауза {retry_after:.2f} с")
+
+
+class RateLimiter:
+    """
+    Общий для всех стадий ограничитель запросов к LLM с ведрами по (провайдер, модель).
+    """
+
+    def __init__(self, limits_path: str = LIMITS_PATH):
+        self.limits = {}
+        if os.path.exists(limits_path):
+            with open(limits_path, "r", encoding="utf-8") as f:
+                self.limits = json.load(f)
+        self.buckets = {}
+
+    def get_bucket(self, model: str) -> TokenBucket:
+        key = (get_provider(model), model)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            model_limits = self.limits.get(model, {})
+            bucket = TokenBucket(
+                name=f"{key[0]}/{model}",
+                rpm=model_limits.get("rpm", DEFAULT_RPM),
+                tpm=model_limits.get("tpm", DEFAULT_TPM)
+            )
+            self.buckets[key] = bucket
+        return bucket
+
+    async def acquire(self, model: str, messages: list):
+        # Та же оценка, что и у проверки окна контекста (llm_tokens.plan_request)
+        await self.get_bucket(model).acquire(count_message_tokens(messages))
+
+    def update_from_headers(self, model: str, headers):
+        self.get_bucket(model).update_from_headers(headers)
+
+    def penalize(self, model: str, headers):
+        self.get_bucket(model).penalize(headers)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    Возвращает общий для процесса ограничитель запросов.
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
@@ -1,32 +1,182 @@
-from gpt_request import request_gpt
-from deepseek_request import request_deepseek
-from claude_request import request_claude
+import asyncio
+import time
+from gpt_request import request_gpt, arequest_gpt
+from deepseek_request import request_deepseek, arequest_deepseek
+from claude_request import request_claude, arequest_claude
+from llm_cache import get_llm_cache, make_cache_key
+from llm_rate_limiter import get_rate_limiter
+from llm_tokens import plan_request, record_usage, adapt_params
+from llm_hedging import hedged_request, record_latency
+from logger_config import setup_logger
 
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_router', 'logs/llm_router.log')
 
-def llm_request(model: str, messages: list) -> dict:
+# Сколько раз повторять запрос, получивший 429, прежде чем отдать ошибку стадии
+RATE_LIMIT_RETRIES = 5
+
+
+def _request(model: str, messages: list, response_format: dict = None, estimate: tuple = (0, 0),
+             stage: str = None, params: dict = None) -> dict:
     """
-    Принимает название модели и список сообщений.
     Вызывает соответствующую функцию запроса в зависимости от названия модели.
+    params — параметры генерации (max_tokens, reasoning_effort, temperature), см. llm_routing.
+    estimate — оценка (входные, выходные) токенов из plan_request, сверяется с фактическим usage;
+    usage учитывается по стадии stage.
+    """
+    if model.startswith("gpt-"):
+        response = request_gpt(model, messages, response_format, params)
+    elif model.startswith("deepseek-"):
+        response = request_deepseek(model, messages, response_format, params)
+    elif model.startswith("claude-"):
+        response = request_claude(model, messages, response_format, params)
+    else:
+        raise Exception(f"Модель {model} не поддерживается.")
+    record_usage(model, *estimate, response.get("usage"), stage)
+    return response
+
+
+async def _arequest(model: str, messages: list, response_format: dict = None, estimate: tuple = (0, 0),
+                    stage: str = None, params: dict = None) -> dict:
+    """
+    Асинхронно вызывает соответствующую функцию запроса в зависимости от названия модели.
+    Перед отправкой запрос проходит через общий ограничитель (RPM/TPM по провайдеру и модели),
+    ответы 429 приостанавливают ведро модели на retry-after и повторяются.
+    estimate — оценка (входные, выходные) токенов из plan_request, сверяется с фактическим usage;
+    usage учитывается по стадии stage.
     """
     if model.startswith("gpt-"):
-        return request_gpt(model, messages)
+        request_func = arequest_gpt
     elif model.startswith("deepseek-"):
-        return request_deepseek(model, messages)
+        request_func = arequest_deepseek
     elif model.startswith("claude-"):
-        return request_claude(model, messages)
+        request_func = arequest_claude
     else:
         raise Exception(f"Модель {model} не поддерживается.")
 
+    rate_limiter = get_rate_limiter()
+    for attempt in range(1, RATE_LIMIT_RETRIES + 1):
+        await rate_limiter.acquire(model, messages)
+        started = time.monotonic()
+        try:
+            response = await request_func(model, messages, response_format, params)
+        except asyncio.CancelledError:
+            # Отменённый (проигравший при хеджировании) запрос — нижняя граница задержки модели
+            record_latency(model, time.monotonic() - started)
+            raise
+        except Exception as e:
+            if getattr(e, "status_code", None) != 429 or attempt == RATE_LIMIT_RETRIES:
+                raise
+            error_response = getattr(e, "response", None)
+            rate_limiter.penalize(model, error_response.headers if error_response is not None else None)
+            logger.warning(f"429 от {model}, попытка {attempt} из {RATE_LIMIT_RETRIES}")
+            continue
+        # Задержка без учёта ожидания в ограничителе — по ней считается порог хеджирования
+        record_latency(model, time.monotonic() - started)
+        record_usage(model, *estimate, response.get("usage"), stage)
+        return response
+
+
+def _cache_params(response_format: dict = None, params: dict = None) -> dict | None:
+    """
+    Параметры запроса, влияющие на ответ и поэтому входящие в ключ кэша.
+    """
+    cache_params = {}
+    if response_format:
+        cache_params["response_format"] = response_format
+    if params:
+        cache_params["params"] = params
+    return cache_params or None
+
+
+def llm_request(model: str, messages: list, response_format: dict = None,
+                expected_output_tokens: int = None, stage: str = None, params: dict = None) -> dict:
+    """
+    Принимает название модели и список сообщений.
+    Вызывает соответствующую функцию запроса в зависимости от названия модели.
+    Ответ сначала ищется в дисковом кэше llm_cache (повторный запрос не оплачивается).
+
+    Если передана схема ответа response_format вида {"name": ..., "schema": <JSON Schema>},
+    используется нативный структурированный вывод провайдера (json_schema у OpenAI,
+    JSON-режим у DeepSeek, вызов инструмента у Anthropic), а в ответе есть ключ "parsed"
+    с уже разобранным объектом.
+
+    Перед отправкой размер запроса оценивается локальным токенизатором (llm_tokens.plan_request):
+    если вместе с ожидаемым ответом expected_output_tokens он не помещается в окно модели,
+    запрос уходит на более крупную модель (параметры генерации приводятся к ней, см. llm_tokens.adapt_params),
+    а если не помещается никуда — выбрасывается ContextWindowExceeded, и стадия должна разбить входные данные.
+
+    stage — название стадии анализа, по которой учитывается usage (в том числе доля кэшированных
+    входных токенов, см. llm_tokens.reset_stage_token_stats).
+
+    params — параметры генерации из таблицы маршрутов (см. llm_routing.get_route):
+    max_tokens, reasoning_effort, temperature; провайдер передаёт только поддерживаемые им.
+    """
+    routed_model = model
+    model, *estimate = plan_request(model, messages, expected_output_tokens)
+    params = adapt_params(routed_model, model, params)
+
+    cache = get_llm_cache()
+    if cache is None:
+        return _request(model, messages, response_format, estimate, stage, params)
+
+    key = make_cache_key(model, messages, _cache_params(response_format, params))
+    cached = cache.lookup(key)
+    if cached is not None:
+        return cached
+
+    response = _request(model, messages, response_format, estimate, stage, params)
+    cache.store(key, response)
+    return response
+
+
+async def allm_request(model: str, messages: list, response_format: dict = None,
+                      expected_output_tokens: int = None, stage: str = None, hedge: bool = False,
+                      params: dict = None, accept=None) -> dict:
+    """
+    Асинхронный аналог llm_request.
+    Запрос выполняется через общий для процесса асинхронный клиент провайдера,
+    поэтому реальный параллелизм ограничивается только семафорами стадий, а не пулом потоков.
+    Ответ сначала ищется в дисковом кэше llm_cache, одинаковые одновременные запросы
+    объединяются в один. Схема ответа response_format, параметры генерации params и проверка
+    окна контекста — как в llm_request.
+
+    При hedge=True (по желанию стадии stage) запрос хеджируется: если он выполняется дольше p95
+    задержки модели, отправляется дубль в равноценную модель и берётся первый ответ
+    (см. llm_hedging.hedged_request, бюджеты стадий — HEDGE_BUDGETS).
+
+    accept — проверка ответа вызывающим кодом (исключение — ответ отвергнут): отвергнутые ответы
+    не кэшируются, поэтому повторная попытка уходит к провайдеру (см. llm_routing.route_request).
+    """
+    routed_model = model
+    model, *estimate = plan_request(model, messages, expected_output_tokens)
+    params = adapt_params(routed_model, model, params)
+
+    def request_factory():
+        if hedge and stage:
+            return hedged_request(
+                lambda m: _arequest(m, messages, response_format, estimate, stage, adapt_params(model, m, params)),
+                model, stage, estimate
+            )
+        return _arequest(model, messages, response_format, estimate, stage, params)
+
+    cache = get_llm_cache()
+    if cache is None:
+        return await request_factory()
+
+    key = make_cache_key(model, messages, _cache_params(response_format, params))
+    return await cache.get_or_request(key, request_factory, accept)
+
 
 if __name__ == "__main__":
     import json
 
     # Выполняем запрос к выбранной модели
-    response = llm_request(model="deepseek-reasoner",
-                           messages=[
-                               {"role": "user", "content": "Сколько будет два плюс два?"}
-                           ]
-                           )
+    response = asyncio.run(allm_request(model="deepseek-reasoner",
+                                        messages=[
+                                            {"role": "user", "content": "Сколько будет два плюс два?"}
+                                        ]
+                                        ))
 
     # Выводим ответ в формате JSON
     print(json.dumps(response, ensure_ascii=False, indent=2))
@@ -0,0 +1,87 @@
+import json
+import os
+from llm_router import allm_request
+from llm_cache import accepted_result
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_routing', 'logs/llm_routing.log')
+
+ROUTING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_routing.json")
+
+# Уровни моделей (значения criteria.llm_type, см. db_create_table.py)
+STANDARD = "standard"
+PREMIUM = "premium"
+
+# Таблица маршрутов и mtime файла, из которого она загружена
+_routing = {}
+_routing_mtime = None
+
+
+def get_routing() -> dict:
+    """
+    Возвращает таблицу маршрутов из llm_routing.json:
+    {"stages": {stage: {llm_type: {"model", ...параметры}}}, "portals": {portal: {stage: {llm_type: {...}}}}}.
+    Файл перечитывается только при изменении его mtime, поэтому модели стадий меняются без перезапуска.
+    """
+    global _routing, _routing_mtime
+
+    mtime = os.stat(ROUTING_PATH).st_mtime
+    if mtime != _routing_mtime:
+        with open(ROUTING_PATH, "r", encoding="utf-8") as f:
+            _routing = json.load(f)
+        _routing_mtime = mtime
+        logger.info(f"Загружены маршруты для {len(_routing.get('stages', {}))} стадий из {ROUTING_PATH}")
+
+    return _routing
+
+
+def get_route(stage: str, llm_type: str = STANDARD, portal: str = None) -> dict:
+    """
+    Возвращает маршрут запроса стадии: {"model": ..., "params": {"max_tokens", "reasoning_effort", ...}}.
+    Настройки портала (portals) дополняют и переопределяют общие настройки стадии.
+    Неизвестный llm_type считается standard.
+    """
+    routing = get_routing()
+    stage_routes = routing.get("stages", {}).get(stage)
+    if not stage_routes:
+        raise Exception(f"В {ROUTING_PATH} нет маршрута для стадии: {stage}")
+    portal_routes = routing.get("portals", {}).get(portal, {}).get(stage, {})
+
+    if llm_type not in stage_routes and llm_type not in portal_routes:
+        llm_type = STANDARD
+    route = {**stage_routes.get(llm_type, {}), **portal_routes.get(llm_type, {})}
+    if "model" not in route:
+        raise Exception(f"Не указана модель для стадии {stage} ({llm_type}, портал {portal})")
+
+    model = route.pop("model")
+    return {"model": model, "params": route}
+
+
+async def route_request(stage: str, messages: list, parse, llm_type: str = STANDARD, portal: str = None,
+                        response_format: dict = None, expected_output_tokens: int = None,
+                        hedge: bool = False, escalate: bool = True) -> tuple:
+    """
+    Выполняет запрос стадии по таблице маршрутов и проверяет ответ функцией parse (response -> результат;
+    исключение означает, что ответ не прошёл проверку). Запрос уходит на модель уровня llm_type,
+    а на premium повторяется, только если ответ standard не прошёл проверку.
+    escalate=False — без повтора на premium (у вызывающего есть свой запасной вариант).
+    Ответы, не прошедшие parse, не сохраняются в кэш llm_cache: повторная попытка уходит к провайдеру.
+    parse выполняется один раз на ответ: результат проверки в кэше используется повторно (accepted_result).
+
+    :return: Кортеж (результат parse, ответ модели, использованной последней).
+    """
+    tiers = [PREMIUM] if llm_type == PREMIUM else [llm_type, PREMIUM]
+    if not escalate:
+        tiers = tiers[:1]
+    for tier in tiers:
+        route = get_route(stage, tier, portal)
+        response = await allm_request(model=route["model"], messages=messages, response_format=response_format,
+                                      expected_output_tokens=expected_output_tokens, stage=stage, hedge=hedge,
+                                      params=route["params"], accept=parse)
+        try:
+            return accepted_result(response, parse), response
+        except Exception as e:
+            if tier == tiers[-1]:
+                raise
+            logger.warning(f"Стадия {stage}: ответ {route['model']} не прошёл проверку ({e}), повторяю на {PREMIUM}")
@@ -0,0 +1,152 @@
+import json
+from datetime import datetime, timedelta, timezone
+from db_client import get_db_client
+from llm_pricing import get_model_pricing, is_in_discount_time
+from llm_routing import get_route
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_scheduler', 'logs/llm_scheduler.log')
+
+URGENT = "urgent"
+DEFERRABLE = "deferrable"
+
+# Приоритеты стадий анализа (модели стадий задаются в llm_routing.json).
+# Срочные стадии отправляются сразу, несрочные копятся в очереди deferred_jobs
+# и выполняются в скидочное окно своей модели (см. DISCOUNT TIME в llm_pricing.json).
+STAGES = {
+    "dialog_fix": {"priority": URGENT},
+    "classification": {"priority": URGENT},
+    "criteria": {"priority": URGENT},
+    "entity_summary": {"priority": URGENT},
+    "entity_summary_aggregation": {"priority": DEFERRABLE},
+    "reanalysis": {"priority": DEFERRABLE},
+}
+
+_table_ready = False
+
+
+def get_stage_model(stage: str) -> str:
+    """
+    Возвращает модель, на которой выполняется стадия (standard-маршрут из llm_routing.json).
+    """
+    return get_route(stage)["model"]
+
+
+def is_deferrable(stage: str) -> bool:
+    """
+    Проверяет, можно ли отложить стадию до скидочного окна.
+    Неизвестные стадии считаются срочными.
+    """
+    return STAGES.get(stage, {}).get("priority") == DEFERRABLE
+
+
+def should_run_now(stage: str, now: datetime = None) -> bool:
+    """
+    Срочные стадии и стадии на моделях без скидочного окна выполняются сразу,
+    несрочные — только внутри скидочного окна своей модели.
+    """
+    if not is_deferrable(stage):
+        return True
+    model = get_stage_model(stage)
+    if get_model_pricing(model)["discount_window"] is None:
+        return True
+    return is_in_discount_time(model, now)
+
+
+def seconds_until_window(stage: str, now: datetime = None) -> float:
+    """
+    Возвращает число секунд до начала ближайшего скидочного окна модели стадии
+    (0, если окно уже открыто или у модели его нет).
+    """
+    if should_run_now(stage, now):
+        return 0.0
+    start_time, _ = get_model_pricing(get_stage_model(stage))["discount_window"]
+    now_utc = (now or datetime.now(timezone.utc)).astimezone(timezone.utc)
+    start = now_utc.replace(hour=start_time.hour, minute=start_time.minute, second=0, microsecond=0)
+    if start <= now_utc:
+        start += timedelta(days=1)
+    return (start - now_utc).total_seconds()
+
+
+def ensure_deferred_table():
+    """
+    Создаёт таблицу deferred_jobs (очередь отложенных задач), если её ещё нет.
+    """
+    global _table_ready
+    if _table_ready:
+        return
+
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS deferred_jobs (
+                    stage TEXT NOT NULL,                  -- Стадия анализа (entity_summary_aggregation, ...)
+                    portal TEXT NOT NULL,                 -- Портал (имя таблицы)
+                    job_key TEXT NOT NULL,                -- Ключ задачи внутри стадии (например, id сущности)
+                    payload JSONB NOT NULL,               -- Накопленные входные данные задачи (JSON-массив)
+                    created_at TIMESTAMP DEFAULT now(),
+                    updated_at TIMESTAMP DEFAULT now(),
+                    PRIMARY KEY (stage, portal, job_key)
+                );
+            """)
+        conn.commit()
+    _table_ready = True
+
+
+def defer_job(stage: str, portal: str, job_key, items: list):
+    """
+    Ставит задачу в очередь отложенных. Если задача с тем же ключом уже ждёт,
+    новые элементы items дописываются в её payload.
+    """
+    ensure_deferred_table()
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO deferred_jobs (stage, portal, job_key, payload) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (stage, portal, job_key)
+                DO UPDATE SET payload = deferred_jobs.payload || EXCLUDED.payload, updated_at = now();
+            """, (stage, portal, str(job_key), json.dumps(items, ensure_ascii=False)))
+        conn.commit()
+    logger.debug(f"Стадия {stage}: задача {portal}/{job_key} отложена до скидочного окна")
+
+
+def fetch_deferred_jobs(stage: str) -> list[dict]:
+    """
+    Возвращает отложенные задачи стадии в порядке постановки: [{"portal", "job_key", "payload", "updated_at"}, ...].
+    """
+    ensure_deferred_table()
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT portal, job_key, payload, updated_at FROM deferred_jobs
+                WHERE stage = %s ORDER BY created_at;
+            """, (stage,))
+            rows = cur.fetchall()
+    return [{"portal": portal, "job_key": job_key, "payload": payload, "updated_at": updated_at}
+            for portal, job_key, payload, updated_at in rows]
+
+
+def complete_deferred_job(stage: str, job: dict):
+    """
+    Удаляет выполненную задачу из очереди, если с момента fetch_deferred_jobs в неё ничего не дописали
+    (updated_at не изменился). Иначе из payload удаляются только выполненные элементы, а дописанные
+    defer_job после выборки остаются в очереди.
+    """
+    with get_db_client() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM deferred_jobs
+                WHERE stage = %s AND portal = %s AND job_key = %s AND updated_at = %s;
+            """, (stage, job["portal"], job["job_key"], job["updated_at"]))
+            if cur.rowcount == 0:
+                # defer_job дописывает элементы в конец payload, поэтому выполненные — первые len(payload)
+                cur.execute("""
+                    UPDATE deferred_jobs
+                    SET payload = jsonb_path_query_array(payload, ('$[' || %s || ' to last]')::jsonpath)
+                    WHERE stage = %s AND portal = %s AND job_key = %s;
+                """, (len(job["payload"]), stage, job["portal"], job["job_key"]))
+                if cur.rowcount:
+                    logger.info(f"Стадия {stage}: в задачу {job['portal']}/{job['job_key']} дописаны новые элементы, "
+                                f"она остаётся в очереди")
+        conn.commit()
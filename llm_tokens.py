@@ -0,0 +1,226 @@
+import json
+import os
+from logger_config import setup_logger
+
+try:
+    import tiktoken
+except ImportError:  # Без tiktoken оценка идёт по числу символов
+    tiktoken = None
+
+# Настройка логгера для этого модуля
+logger = setup_logger('llm_tokens', 'logs/llm_tokens.log')
+
+LIMITS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_limits.json")
+
+# Среднее число символов на токен для оценки без tiktoken (русский текст)
+CHARS_PER_TOKEN = 3
+
+# Кодировка токенизатора: o200k_base у gpt-4o/gpt-5, для DeepSeek и Claude используется как приближение
+ENCODING_NAME = "o200k_base"
+
+# Служебные токены на каждое сообщение (роль, разделители)
+TOKENS_PER_MESSAGE = 4
+
+# Значения для моделей без context_window/max_output_tokens в llm_limits.json
+DEFAULT_CONTEXT_WINDOW = 128_000
+DEFAULT_MAX_OUTPUT_TOKENS = 8_000
+DEFAULT_OUTPUT_TOKENS = 1_000
+
+# Запас на неточность оценки (доля от окна контекста)
+SAFETY_MARGIN = 0.05
+
+_encoding = None
+_limits = None
+
+# Накопленные оценки и фактическое usage по моделям для калибровки
+_estimate_stats = {}
+# Фактическое usage по стадиям (доля кэшированных входных токенов)
+_stage_stats = {}
+
+
+class ContextWindowExceeded(Exception):
+    """
+    Запрос не помещается в окно контекста ни исходной, ни более крупной модели —
+    вызывающая стадия должна разбить входные данные на части.
+    """
+
+    def __init__(self, model: str, input_tokens: int, output_tokens: int):
+        self.model = model
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        super().__init__(
+            f"Запрос ~{input_tokens} входных и ~{output_tokens} выходных токенов не помещается в окно модели {model}"
+        )
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        _encoding = tiktoken.get_encoding(ENCODING_NAME)
+    return _encoding
+
+
+def get_model_limits(model: str) -> dict:
+    """
+    Возвращает {"context_window", "max_output_tokens", "larger_model", "params"} модели из llm_limits.json.
+    params — параметры генерации, которые принимает модель (None — не ограничены).
+    """
+    global _limits
+    if _limits is None:
+        _limits = {}
+        if os.path.exists(LIMITS_PATH):
+            with open(LIMITS_PATH, "r", encoding="utf-8") as f:
+                _limits = json.load(f)
+
+    model_limits = _limits.get(model, {})
+    return {
+        "context_window": model_limits.get("context_window", DEFAULT_CONTEXT_WINDOW),
+        "max_output_tokens": model_limits.get("max_output_tokens", DEFAULT_MAX_OUTPUT_TOKENS),
+        "larger_model": model_limits.get("larger_model"),
+        "params": model_limits.get("params")
+    }
+
+
+def count_tokens(text: str) -> int:
+    """
+    Считает токены текста локальным токенизатором (или по числу символов, если tiktoken не установлен).
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list) -> int:
+    """
+    Оценивает число входных токенов списка сообщений.
+    """
+    total = 0
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            total += sum(count_tokens(part.get("text", "")) for part in content if isinstance(part, dict))
+        else:
+            total += count_tokens(content)
+        total += TOKENS_PER_MESSAGE
+    return total
+
+
+def fits(model: str, input_tokens: int, output_tokens: int) -> bool:
+    """
+    Проверяет, помещается ли запрос в окно контекста и лимит выходных токенов модели.
+    """
+    limits = get_model_limits(model)
+    context_budget = limits["context_window"] * (1 - SAFETY_MARGIN)
+    return output_tokens <= limits["max_output_tokens"] and input_tokens + output_tokens <= context_budget
+
+
+def plan_request(model: str, messages: list, expected_output_tokens: int = None) -> tuple[str, int, int]:
+    """
+    Решает до отправки, куда направить запрос:
+      - отправить как есть, если он помещается в окно модели;
+      - перенаправить на более крупную модель (larger_model в llm_limits.json, по цепочке);
+      - выбросить ContextWindowExceeded, чтобы стадия разбила входные данные.
+
+    :return: Кортеж (модель, оценка входных токенов, прогноз выходных токенов).
+    """
+    input_tokens = count_message_tokens(messages)
+    output_tokens = expected_output_tokens or DEFAULT_OUTPUT_TOKENS
+
+    candidate = model
+    while candidate is not None:
+        if fits(candidate, input_tokens, output_tokens):
+            if candidate != model:
+                logger.warning(
+                    f"Запрос ~{input_tokens}+{output_tokens} токенов не помещается в {model}, "
+                    f"перенаправлен на {candidate}"
+                )
+            return candidate, input_tokens, output_tokens
+        candidate = get_model_limits(candidate)["larger_model"]
+
+    raise ContextWindowExceeded(model, input_tokens, output_tokens)
+
+
+def adapt_params(source_model: str, target_model: str, params: dict = None) -> dict | None:
+    """
+    Приводит параметры генерации маршрута модели source_model к модели target_model, на которую запрос
+    перенаправлен (plan_request) или продублирован (llm_hedging): параметры, которых target_model не принимает
+    (например, reasoning_effort у gpt-4.1-nano), отбрасываются, а max_tokens ограничивается её лимитом;
+    max_tokens, равный лимиту source_model («сколько позволяет модель»), заменяется лимитом target_model.
+    """
+    if not params or source_model == target_model:
+        return params
+
+    target = get_model_limits(target_model)
+    adapted = {key: value for key, value in params.items()
+               if target["params"] is None or key in target["params"]}
+    if adapted.get("max_tokens"):
+        if adapted["max_tokens"] == get_model_limits(source_model)["max_output_tokens"]:
+            adapted["max_tokens"] = target["max_output_tokens"]
+        adapted["max_tokens"] = min(adapted["max_tokens"], target["max_output_tokens"])
+
+    dropped = sorted(set(params) - set(adapted))
+    if dropped:
+        logger.debug(f"Параметры {dropped} не поддерживаются {target_model}, отброшены")
+    return adapted or None
+
+
+def record_usage(model: str, estimated_input: int, predicted_output: int, usage: dict, stage: str = None):
+    """
+    Логирует оценку рядом с фактическим usage ({"input_tokens", "cached_tokens", "output_tokens"}),
+    накапливает отношения факт/оценка по модели для калибровки и usage по стадии.
+    """
+    if not usage:
+        return
+
+    stage_stats = _stage_stats.setdefault(stage or "other", {"requests": 0, "input_tokens": 0,
+                                                             "cached_tokens": 0, "output_tokens": 0})
+    stage_stats["requests"] += 1
+    for key in ("input_tokens", "cached_tokens", "output_tokens"):
+        stage_stats[key] += usage.get(key, 0)
+
+    actual_input = usage.get("input_tokens", 0) + usage.get("cached_tokens", 0)
+    actual_output = usage.get("output_tokens", 0)
+
+    stats = _estimate_stats.setdefault(model, {"requests": 0, "estimated_input": 0, "actual_input": 0,
+                                               "predicted_output": 0, "actual_output": 0})
+    stats["requests"] += 1
+    stats["estimated_input"] += estimated_input
+    stats["actual_input"] += actual_input
+    stats["predicted_output"] += predicted_output
+    stats["actual_output"] += actual_output
+
+    logger.debug(
+        f"{model}: вход оценка {estimated_input} / факт {actual_input}, "
+        f"выход прогноз {predicted_output} / факт {actual_output}"
+    )
+
+
+def get_estimate_stats() -> dict:
+    """
+    Возвращает по каждой модели отношения факт/оценка для входных и выходных токенов.
+    """
+    return {
+        model: {
+            "requests": stats["requests"],
+            "input_ratio": round(stats["actual_input"] / stats["estimated_input"], 3) if stats["estimated_input"] else None,
+            "output_ratio": round(stats["actual_output"] / stats["predicted_output"], 3) if stats["predicted_output"] else None
+        }
+        for model, stats in _estimate_stats.items()
+    }
+
+
+def reset_stage_token_stats() -> dict:
+    """
+    Сбрасывает usage по стадиям и возвращает статистику за прошедший период:
+    {stage: {"requests", "input_tokens", "cached_tokens", "output_tokens", "cache_hit_rate"}},
+    где cache_hit_rate — доля входных токенов, прочитанных из кэша префиксов провайдера.
+    """
+    global _stage_stats
+    stats, _stage_stats = _stage_stats, {}
+    for stage_stats in stats.values():
+        total_input = stage_stats["input_tokens"] + stage_stats["cached_tokens"]
+        stage_stats["cache_hit_rate"] = round(stage_stats["cached_tokens"] / total_input, 3) if total_input else None
+    return stats
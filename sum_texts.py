@@ -1,6 +1,5 @@
 import asyncio
-from functools import partial
-from llm_router import llm_request
+from llm_routing import route_request
 import ast
 
 def calculate_evaluation(*evaluations):
@@ -22,13 +21,94 @@ def calculate_evaluation(*evaluations):
     average = sum(float(eval) for eval in valid_evaluations) / len(valid_evaluations)
     return round(average, 2)
 
-async def sum_text_blocks(text_evaluation_pairs, max_size):
+
+# Стадия по умолчанию: модель суммирования выбирается по таблице маршрутов (см. llm_routing)
+STAGE = "entity_summary"
+
+# Схема ответа для структурированного вывода (см. llm_router.allm_request)
+SUM_SCHEMA = {
+    "name": "summary_block",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "text": {"type": "string"}
+        },
+        "required": ["text"],
+        "additionalProperties": False
+    }
+}
+
+
+def build_sum_messages(non_empty_texts: list, max_size: int) -> list:
+    """
+    Формирует сообщения запроса на суммирование непустых блоков текста:
+    инструкции (не зависят от блоков и попадают в кэш префиксов провайдера) — в system,
+    сами блоки — в user.
+
+    :param non_empty_texts: Список непустых текстов для суммирования.
+    :param max_size: Максимально допустимый размер итогового блока в количестве слов.
+    """
+    # Инструкции для суммирования множественных блоков
+    instructions = (
+        "Выполни суммирование блоков текста/списков/других структур данных."
+        "ВАЖНО: сохрани структуру и тип составляющих блоков в итоговом ответе."
+        "То есть если в исходных данных были тексты, то результатом должен быть общий текст, если списки — то результатом должен быть общий список и т.д."
+        "Повторяющиеся или пересекающиеся пункты должны быть объединены."
+        f"Итоговый блок не должен превышать {max_size} слов. Если суммированный блок превышает {max_size} слов, постарайтесь уплотнить его, сохраняя все основные идеи и смысл всех блоков, не теряя важной информации.\n"
+        "Ответ выдай строго в виде словаря следующего синтаксиса (без доп символов и кавычек, синтаксис словаря должен быть с "
+        "таким же набором фигурных скобок и двойных кавычек, обрамлять словарь в доп символы запрещено):\n"
+        "{\"text\": \"суммирующий блок\"}\n"
+        "Кроме словаря вставлять что-то в ответ запрещено.\n"
+        "Кавычки внутри ответа на промпт экранируй.\n"
+    )
+    
+    # Добавляем все блоки
+    blocks = f"Количество блоков: {len(non_empty_texts)}\n"
+    for i, text in enumerate(non_empty_texts, 1):
+        blocks += f"Блок {i}:\n{text}\n"
+
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": blocks}
+    ]
+
+
+def parse_sum_response(response: dict) -> str:
+    """
+    Извлекает суммирующий текст из ответа нейросети. При ошибке разбора возвращает пустую строку.
+    Ответы структурированного вывода (ключ "parsed") не требуют разбора.
+    """
+    if response.get("parsed") is not None:
+        return response["parsed"].get("text", "")
+    try:
+        raw = response["content"].strip()
+        result_dict = ast.literal_eval(raw)
+        return result_dict['text']
+    except Exception as e:
+        print(f"Ошибка при парсинге ответа: {e}\nОтвет модели: {response}")
+        return ''
+
+
+def _parse_valid_sum_response(response: dict) -> str:
+    """
+    Извлекает суммирующий текст и выбрасывает ValueError, если он пуст
+    (непрошедший проверку ответ повторяется на premium-модели).
+    """
+    text = parse_sum_response(response)
+    if not text or not text.strip():
+        raise ValueError("Пустой суммирующий блок")
+    return text
+
+
+async def sum_text_blocks(text_evaluation_pairs, max_size, stage=STAGE, portal=None):
     """
     Суммирует любое количество блоков текста через LLM.
 
     :param text_evaluation_pairs: Список кортежей (text, evaluation) для суммирования.
                                   Например: [("текст1", 4.5), ("текст2", None), ("текст3", 3.8)]
     :param max_size: Максимально допустимый размер итогового блока в количестве слов.
+    :param stage: Стадия анализа: по ней выбирается модель (см. llm_routing) и учитывается usage.
+    :param portal: Портал, маршрут которого используется (если для него заданы свои модели).
     :return: Словарь с ключами:
         - "text_result": строка с суммированным блоком данных;
         - "evaluation_result": итоговая средняя оценка всех блоков.
@@ -52,42 +132,10 @@ async def sum_text_blocks(text_evaluation_pairs, max_size):
             "evaluation_result": calculate_evaluation(*evaluations)
         }
     
-    # Создаем промпт для суммирования множественных блоков
-    prompt = (
-        f"Выполни суммирование {len(non_empty_texts)} блоков текста/списков/других структур данных."
-        "ВАЖНО: сохрани структуру и тип составляющих блоков в итоговом ответе."
-        "То есть если в исходных данных были тексты, то результатом должен быть общий текст, если списки — то результатом должен быть общий список и т.д."
-        "Повторяющиеся или пересекающиеся пункты должны быть объединены."
-        f"Итоговый блок не должен превышать {max_size} слов. Если суммированный блок превышает {max_size} слов, постарайтесь уплотнить его, сохраняя все основные идеи и смысл всех блоков, не теряя важной информации.\n"
-    )
-    
-    # Добавляем все блоки в промпт
-    for i, text in enumerate(non_empty_texts, 1):
-        prompt += f"Блок {i}:\n{text}"
-    
-    prompt += (
-        "Ответ выдай строго в виде словаря следующего синтаксиса (без доп символов и кавычек, синтаксис словаря должен быть с "
-        "таким же набором фигурных скобок и двойных кавычек, обрамлять словарь в доп символы запрещено):\n"
-        "{\"text\": \"суммирующий блок\"}\n"
-        "Кроме словаря вставлять что-то в ответ запрещено.\n"
-        "Кавычки внутри ответа на промпт экранируй.\n"
-    )
-
-    messages = [{"role": "user", "content": prompt}]
-    
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(
-        None,
-        partial(llm_request, model="gpt-4o-mini", messages=messages)
-    )
-    
-    try:
-        raw = response["content"].strip()
-        result_dict = ast.literal_eval(raw)
-        text_result = result_dict['text']
-    except Exception as e:
-        print(f"Ошибка при парсинге ответа: {e}\nОтвет модели: {response}")
-        text_result = ''
+    messages = build_sum_messages(non_empty_texts, max_size)
+    # Прогноз размера ответа: max_size слов русского текста (около 3 токенов на слово)
+    text_result, _ = await route_request(stage, messages, _parse_valid_sum_response, portal=portal,
+                                         response_format=SUM_SCHEMA, expected_output_tokens=max_size * 3)
 
     return {
         "text_result": text_result,
@@ -0,0 +1,87 @@
+import asyncio
+import inspect
+from logger_config import setup_logger
+
+# Настройка логгера для этого модуля
+logger = setup_logger('worker_pool', 'logs/worker_pool.log')
+
+# Сколько элементов может ждать в очереди на одного обработчика
+QUEUE_SIZE_PER_WORKER = 2
+
+# Маркер конца очереди для обработчиков
+_DONE = object()
+
+
+async def retry_call(func, *args, retries: int = 1, retry_delay: float = 0.0, description: str = "", **kwargs):
+    """
+    Вызывает корутинную функцию func(*args, **kwargs) до retries раз. Задержка перед повтором
+    удваивается с каждой попыткой (retry_delay, 2 * retry_delay, ...); после последней неудачной
+    попытки исключение пробрасывается.
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            delay = retry_delay * 2 ** (attempt - 1)
+            logger.warning(f"{description}: попытка {attempt} из {retries} не удалась ({e}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+
+async def run_pool(items, worker, concurrency: int, sink=None, retries: int = 1, retry_delay: float = 0.0,
+                   name: str = "pool") -> dict:
+    """
+    Обрабатывает элементы пулом из concurrency обработчиков, читающих общую ограниченную очередь.
+    Источник items (обычно генератор) читается по мере освобождения места в очереди, поэтому
+    в памяти одновременно находится порядка concurrency элементов, а не весь объём работы.
+
+    :param items: Итерируемый источник элементов.
+    :param worker: Корутинная функция item -> результат.
+    :param concurrency: Число обработчиков (одновременно обрабатываемых элементов).
+    :param sink: Функция (item, result, error), обычная или корутинная. Вызывается сразу по завершении
+                 каждого элемента: result — результат worker (None при ошибке), error — последнее
+                 исключение (None при успехе).
+    :param retries: Число попыток на элемент (см. retry_call).
+    :param retry_delay: Базовая задержка перед повтором в секундах.
+    :param name: Название пула для логов.
+    :return: Словарь {"processed": успешно обработано, "failed": с ошибкой}.
+    """
+    queue = asyncio.Queue(maxsize=concurrency * QUEUE_SIZE_PER_WORKER)
+    stats = {"processed": 0, "failed": 0}
+
+    async def produce():
+        for item in items:
+            await queue.put(item)
+        for _ in range(concurrency):
+            await queue.put(_DONE)
+
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            result, error = None, None
+            try:
+                result = await retry_call(worker, item, retries=retries, retry_delay=retry_delay, description=name)
+                stats["processed"] += 1
+            except Exception as e:
+                error = e
+                stats["failed"] += 1
+                logger.error(f"{name}: элемент не обработан за {retries} попыток: {e}")
+            if sink is not None:
+                outcome = sink(item, result, error)
+                if inspect.isawaitable(outcome):
+                    await outcome
+
+    tasks = [asyncio.create_task(produce())] + [asyncio.create_task(consume()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # При ошибке в источнике или sink останавливаем остальные обработчики
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    logger.info(f"{name}: обработано {stats['processed']}, ошибок {stats['failed']}")
+    return stats